@@ -1,11 +1,37 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import os
+import time
+import json
+import base64
+import re
+import unicodedata
+import io
+import csv
+import zipfile
+import zlib
+import mmap
+import struct
+import tempfile
+import threading
+import click
+import numpy as np
+import heapq
+from xml.sax.saxutils import escape as echapper_xml
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from contextlib import contextmanager
 import logging
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+
+try:
+    import fcntl
+except ImportError:
+    # Windows : pas de verrou entre processus (serveur de développement mono-processus)
+    fcntl = None
 
 app = Flask(__name__)
 
@@ -27,6 +53,30 @@ else:
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'flem_hospital_secret_key_2024_dev')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Durée de mise en cache des statistiques du tableau de bord (secondes)
+app.config['STATS_CACHE_SECONDES'] = float(os.environ.get('STATS_CACHE_SECONDES', 5))
+
+# Pagination des listes (nombre de lignes par page)
+app.config['TAILLE_PAGE'] = int(os.environ.get('TAILLE_PAGE', 50))
+app.config['TAILLE_PAGE_MAX'] = int(os.environ.get('TAILLE_PAGE_MAX', 200))
+
+# Autocomplétion des formulaires (nombre maximal de suggestions)
+app.config['TYPEAHEAD_LIMITE'] = int(os.environ.get('TYPEAHEAD_LIMITE', 10))
+app.config['TYPEAHEAD_LIMITE_MAX'] = int(os.environ.get('TYPEAHEAD_LIMITE_MAX', 25))
+
+# Import en masse des patients (nombre de lignes insérées par lot)
+app.config['IMPORT_TAILLE_LOT'] = int(os.environ.get('IMPORT_TAILLE_LOT', 5000))
+
+# Carte de disponibilité des chambres en mémoire partagée (fichier, et
+# intervalle de vérification de sa version en secondes)
+app.config['CARTE_CHAMBRES_FICHIER'] = os.environ.get('CARTE_CHAMBRES_FICHIER')
+app.config['CARTE_CHAMBRES_VALIDATION'] = float(os.environ.get('CARTE_CHAMBRES_VALIDATION', 5))
+
+# Facturation automatique des séjours (nuits non facturées avant d'émettre une
+# facture intermédiaire pour un séjour en cours, nombre de séjours par lot)
+app.config['FACTURATION_SEJOUR_NUITS'] = int(os.environ.get('FACTURATION_SEJOUR_NUITS', 7))
+app.config['FACTURATION_TAILLE_LOT'] = int(os.environ.get('FACTURATION_TAILLE_LOT', 1000))
+
 # Gestionnaire d'erreurs global
 @app.errorhandler(Exception)
 def handle_exception(e):
@@ -118,6 +168,14 @@ class Patient(db.Model):
     numero_securite_sociale = db.Column(db.String(20), unique=True)
     date_inscription = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Index composites utilisés par la pagination par curseur (tri, id)
+    __table_args__ = (
+        db.Index('ix_patient_nom_id', 'nom', 'id'),
+        db.Index('ix_patient_prenom_id', 'prenom', 'id'),
+        db.Index('ix_patient_date_naissance_id', 'date_naissance', 'id'),
+        db.Index('ix_patient_date_inscription_id', 'date_inscription', 'id'),
+    )
+    
     # Relations
     rendez_vous = db.relationship('RendezVous', backref='patient', lazy=True)
     consultations = db.relationship('Consultation', backref='patient', lazy=True)
@@ -131,6 +189,13 @@ class Personnel(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     date_embauche = db.Column(db.Date, nullable=False)
     statut = db.Column(db.String(20), default='actif')  # actif, inactif
+    # Horaires enregistrés par un administrateur (aucune plage = aucun créneau) ;
+    # sinon les horaires par défaut s'appliquent
+    horaires_configures = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    
+    __table_args__ = (
+        db.Index('ix_personnel_nom_id', 'nom', 'id'),
+    )
     
     # Relations
     rendez_vous = db.relationship('RendezVous', backref='personnel', lazy=True)
@@ -141,10 +206,54 @@ class RendezVous(db.Model):
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     personnel_id = db.Column(db.Integer, db.ForeignKey('personnel.id'), nullable=False)
     date_rdv = db.Column(db.DateTime, nullable=False)
+    duree = db.Column(db.Integer, nullable=False, default=30, server_default='30')  # minutes
+    date_fin = db.Column(db.DateTime, default=lambda contexte: fin_rendez_vous(contexte.get_current_parameters()))  # date_rdv + duree
     type_consultation = db.Column(db.String(100), nullable=False)
     statut = db.Column(db.String(20), default='programme')  # programme, confirme, annule, termine
     notes = db.Column(db.Text)
+    serie_id = db.Column(db.Integer, db.ForeignKey('serie_rendez_vous.id'))
+    date_creation = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_rendez_vous_date_rdv', 'date_rdv'),
+        db.Index('ix_rendez_vous_serie_date', 'serie_id', 'date_rdv'),
+        db.Index('ix_rendez_vous_patient_date', 'patient_id', 'date_rdv'),
+        db.Index('ix_rendez_vous_personnel_date', 'personnel_id', 'date_rdv'),
+    )
+
+class SerieRendezVous(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False, index=True)
+    personnel_id = db.Column(db.Integer, db.ForeignKey('personnel.id'), nullable=False)
+    jours_semaine = db.Column(db.String(20), nullable=False)  # ex. "0,2,4" = lundi, mercredi, vendredi
+    intervalle = db.Column(db.Integer, default=1)  # toutes les N semaines
+    heure = db.Column(db.Time, nullable=False)
+    duree = db.Column(db.Integer, nullable=False, default=30)
+    date_debut = db.Column(db.Date, nullable=False)
+    date_fin = db.Column(db.Date, nullable=False)
+    type_consultation = db.Column(db.String(100), nullable=False)
+    notes = db.Column(db.Text)
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    patient = db.relationship('Patient', backref='series_rendez_vous')
+    personnel = db.relationship('Personnel', backref='series_rendez_vous')
+    rendez_vous = db.relationship('RendezVous', backref='serie', lazy='dynamic')
+
+class HoraireTravail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    personnel_id = db.Column(db.Integer, db.ForeignKey('personnel.id'), nullable=False)
+    jour_semaine = db.Column(db.Integer, nullable=False)  # 0 = lundi ... 6 = dimanche
+    heure_debut = db.Column(db.Time, nullable=False)
+    heure_fin = db.Column(db.Time, nullable=False)
+    
+    personnel = db.relationship('Personnel', backref=db.backref('horaires', cascade='all, delete-orphan'))
+    
+    __table_args__ = (
+        db.Index('ix_horaire_travail_personnel_jour', 'personnel_id', 'jour_semaine'),
+    )
+
+def fin_rendez_vous(valeurs):
+    return valeurs['date_rdv'] + timedelta(minutes=valeurs.get('duree') or DUREE_RDV_DEFAUT)
 
 class Consultation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -156,6 +265,11 @@ class Consultation(db.Model):
     ordonnance = db.Column(db.Text)
     notes_medecin = db.Column(db.Text)
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_consultation_patient_date', 'patient_id', 'date_consultation'),
+        db.Index('ix_consultation_personnel_id', 'personnel_id'),
+    )
 
 class Chambre(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -163,6 +277,10 @@ class Chambre(db.Model):
     type_chambre = db.Column(db.String(50), nullable=False)  # simple, double, VIP
     statut = db.Column(db.String(20), default='libre')  # libre, occupee, maintenance
     prix_nuit = db.Column(db.Float, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_chambre_statut_type', 'statut', 'type_chambre'),
+    )
 
 class Medicament(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -176,60 +294,2636 @@ class Medicament(db.Model):
     fournisseur = db.Column(db.String(100))
     date_ajout = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Relations
-    prescriptions = db.relationship('Prescription', backref='medicament', lazy=True)
+    # Relations
+    prescriptions = db.relationship('Prescription', backref='medicament', lazy=True)
+    lots = db.relationship('LotMedicament', backref='medicament', lazy=True, cascade='all, delete-orphan')
+    # Journal des mouvements en ajout seul : jamais supprimé avec le médicament
+    # (voir supprimer_medicament)
+    mouvements = db.relationship('MouvementStock', lazy=True, passive_deletes='all')
+    instantanes = db.relationship('InstantaneStock', lazy=True, passive_deletes='all')
+    
+    __table_args__ = (
+        # Index partiel : seuls les médicaments sous le seuil y figurent
+        db.Index('ix_medicament_stock_bas', 'nom', 'id',
+                 postgresql_where=db.text('quantite_stock <= seuil_minimum'),
+                 sqlite_where=db.text('quantite_stock <= seuil_minimum')),
+        db.Index('ix_medicament_date_expiration', 'date_expiration'),
+    )
+
+class LotMedicament(db.Model):
+    __tablename__ = 'lot_medicament'
+    id = db.Column(db.Integer, primary_key=True)
+    medicament_id = db.Column(db.Integer, db.ForeignKey('medicament.id'), nullable=False)
+    numero_lot = db.Column(db.String(50), nullable=False)
+    quantite_initiale = db.Column(db.Integer, nullable=False)
+    quantite = db.Column(db.Integer, nullable=False)  # Quantité restante
+    date_expiration = db.Column(db.Date)
+    fournisseur = db.Column(db.String(100))
+    date_reception = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Ordre FEFO (premier expiré, premier sorti) des lots non épuisés
+        db.Index('ix_lot_medicament_fefo', 'medicament_id', 'date_expiration', 'id',
+                 postgresql_where=db.text('quantite > 0'),
+                 sqlite_where=db.text('quantite > 0')),
+    )
+
+class MouvementStock(db.Model):
+    __tablename__ = 'mouvement_stock'
+    id = db.Column(db.Integer, primary_key=True)
+    medicament_id = db.Column(db.Integer, db.ForeignKey('medicament.id'), nullable=False)
+    lot_id = db.Column(db.Integer, db.ForeignKey('lot_medicament.id'))
+    prescription_id = db.Column(db.Integer, db.ForeignKey('prescription.id'))
+    type_mouvement = db.Column(db.String(20), nullable=False)  # reception, delivrance, ajustement, peremption
+    quantite = db.Column(db.Integer, nullable=False)  # Positive en entrée, négative en sortie
+    date_mouvement = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    lot = db.relationship('LotMedicament')
+    
+    __table_args__ = (
+        db.Index('ix_mouvement_stock_date', 'date_mouvement'),
+        db.Index('ix_mouvement_stock_medicament_date', 'medicament_id', 'date_mouvement', 'id'),
+    )
+
+class InstantaneStock(db.Model):
+    # Stock d'un médicament au début du mois date_instantane, avec les sorties
+    # du mois précédent
+    __tablename__ = 'instantane_stock'
+    id = db.Column(db.Integer, primary_key=True)
+    medicament_id = db.Column(db.Integer, db.ForeignKey('medicament.id'), nullable=False)
+    date_instantane = db.Column(db.Date, nullable=False)
+    quantite = db.Column(db.Integer, nullable=False)
+    consommation = db.Column(db.Integer, nullable=False, default=0)
+    pertes = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_instantane_stock_date_medicament', 'date_instantane', 'medicament_id', unique=True),
+    )
+
+class Prescription(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    medecin_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    medicament_id = db.Column(db.Integer, db.ForeignKey('medicament.id'), nullable=False)
+    quantite = db.Column(db.Integer, nullable=False)
+    posologie = db.Column(db.Text, nullable=False)  # Comment prendre le médicament
+    date_prescription = db.Column(db.DateTime, default=datetime.utcnow)
+    statut = db.Column(db.String(20), default='en_attente')  # en_attente, delivre, annule
+    notes = db.Column(db.Text)
+    
+    # Relations
+    patient = db.relationship('Patient', backref='prescriptions')
+    medecin = db.relationship('User')
+    
+    __table_args__ = (
+        db.Index('ix_prescription_patient_date', 'patient_id', 'date_prescription'),
+        db.Index('ix_prescription_date', 'date_prescription'),
+        db.Index('ix_prescription_statut_date', 'statut', 'date_prescription'),
+        db.Index('ix_prescription_medicament_id', 'medicament_id'),
+    )
+
+class Hospitalisation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    chambre_id = db.Column(db.Integer, db.ForeignKey('chambre.id'), nullable=False)
+    date_admission = db.Column(db.DateTime, default=datetime.utcnow)
+    date_sortie = db.Column(db.DateTime)
+    motif_admission = db.Column(db.Text)
+    statut = db.Column(db.String(20), default='hospitalise')  # hospitalise, sorti, transfere
+    notes = db.Column(db.Text)
+    facture_jusqu_au = db.Column(db.Date)  # Nuits facturées jusqu'à cette date (exclue)
+    facturation_terminee = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    
+    __table_args__ = (
+        db.Index('ix_hospitalisation_statut', 'statut'),
+        db.Index('ix_hospitalisation_chambre_id', 'chambre_id'),
+        db.Index('ix_hospitalisation_patient_date', 'patient_id', 'date_admission'),
+        # Index partiels : hospitalisations en cours uniquement
+        db.Index('ix_hospitalisation_actives_date', 'date_admission',
+                 postgresql_where=db.text("statut = 'hospitalise'"), sqlite_where=db.text("statut = 'hospitalise'")),
+        db.Index('ix_hospitalisation_actives_patient', 'patient_id',
+                 postgresql_where=db.text("statut = 'hospitalise'"), sqlite_where=db.text("statut = 'hospitalise'")),
+        db.Index('ix_hospitalisation_date_sortie', 'date_sortie'),
+        # Index partiel : séjours restant à facturer
+        db.Index('ix_hospitalisation_a_facturer', 'id',
+                 postgresql_where=db.text('NOT facturation_terminee'), sqlite_where=db.text('NOT facturation_terminee')),
+    )
+    
+    # Relations
+    patient = db.relationship('Patient', backref='hospitalisations')
+    chambre = db.relationship('Chambre', backref='hospitalisations')
+    factures = db.relationship('Facture', backref='hospitalisation', lazy=True)
+
+class OccupationJour(db.Model):
+    # Agrégat quotidien de l'occupation des lits par type de chambre (jours clos)
+    __tablename__ = 'occupation_jour'
+    id = db.Column(db.Integer, primary_key=True)
+    jour = db.Column(db.Date, nullable=False)
+    type_chambre = db.Column(db.String(50), nullable=False)
+    lits_occupes = db.Column(db.Float, nullable=False, default=0)  # Moyenne sur la journée (patients-jours)
+    admissions = db.Column(db.Integer, nullable=False, default=0)
+    sorties = db.Column(db.Integer, nullable=False, default=0)
+    capacite = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_occupation_jour_jour_type', 'jour', 'type_chambre', unique=True),
+    )
+
+class Facture(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    numero_facture = db.Column(db.String(50), unique=True, nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    hospitalisation_id = db.Column(db.Integer, db.ForeignKey('hospitalisation.id'))
+    date_facture = db.Column(db.DateTime, default=datetime.utcnow)
+    date_echeance = db.Column(db.Date)
+    montant_total = db.Column(db.Float, nullable=False)
+    montant_paye = db.Column(db.Float, default=0.0)
+    statut = db.Column(db.String(20), default='en_attente')  # en_attente, payee, partielle, annulee
+    type_facture = db.Column(db.String(30), nullable=False)  # hospitalisation, consultation, medicaments
+    notes = db.Column(db.Text)
+    periode_debut = db.Column(db.Date)  # Facturation automatique des séjours : nuits de [debut, fin[
+    periode_fin = db.Column(db.Date)
+    
+    __table_args__ = (
+        db.Index('ix_facture_statut_date', 'statut', 'date_facture'),
+        db.Index('ix_facture_date', 'date_facture'),
+        db.Index('ix_facture_patient_date', 'patient_id', 'date_facture'),
+        db.Index('ix_facture_hospitalisation_id', 'hospitalisation_id'),
+        # Une seule facture par séjour et par période facturée automatiquement
+        db.Index('ix_facture_hospitalisation_periode', 'hospitalisation_id', 'periode_debut', unique=True),
+    )
+    
+    # Relations
+    patient = db.relationship('Patient', backref='factures')
+    details = db.relationship('DetailFacture', backref='facture', lazy=True, cascade='all, delete-orphan')
+
+class DetailFacture(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    facture_id = db.Column(db.Integer, db.ForeignKey('facture.id'), nullable=False)
+    description = db.Column(db.String(200), nullable=False)
+    quantite = db.Column(db.Integer, default=1)
+    prix_unitaire = db.Column(db.Float, nullable=False)
+    montant = db.Column(db.Float, nullable=False)
+    type_service = db.Column(db.String(50))  # chambre, consultation, medicament, examen
+    
+    __table_args__ = (
+        db.Index('ix_detail_facture_facture_id', 'facture_id'),
+    )
+
+class Compteur(db.Model):
+    # Indicateurs maintenus dans la même transaction que les écritures
+    cle = db.Column(db.String(50), primary_key=True)
+    valeur = db.Column(db.Float, nullable=False, default=0)
+    date_maj = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SequenceFacture(db.Model):
+    # Dernier numéro de facture attribué pour chaque jour
+    __tablename__ = 'sequence_facture'
+    jour = db.Column(db.Date, primary_key=True)
+    dernier = db.Column(db.Integer, nullable=False, default=0)
+
+class CleDoublon(db.Model):
+    # Clés de blocage pour la détection des doublons (maintenues à l'écriture)
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False, index=True)
+    cle = db.Column(db.String(120), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_cle_doublon_cle_patient', 'cle', 'patient_id'),
+    )
+
+class DoublonCandidat(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    patient_a_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False, index=True)
+    patient_b_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)
+    statut = db.Column(db.String(20), default='a_verifier')  # a_verifier, ignore
+    date_detection = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relations
+    patient_a = db.relationship('Patient', foreign_keys=[patient_a_id])
+    patient_b = db.relationship('Patient', foreign_keys=[patient_b_id])
+    
+    __table_args__ = (
+        db.UniqueConstraint('patient_a_id', 'patient_b_id', name='uq_doublon_candidat_paire'),
+        db.Index('ix_doublon_candidat_statut_score', 'statut', 'score'),
+    )
+
+# Compteurs des indicateurs (patients, chambres libres, factures par statut,
+# montant impayé, rendez-vous par jour) : chaque route d'écriture ajuste les
+# compteurs concernés dans sa propre transaction, la lecture ne coûte qu'une
+# requête par clé primaire. reconcilier_compteurs() recalcule tout et corrige
+# une éventuelle dérive
+STATUTS_FACTURE = ['en_attente', 'payee', 'partielle', 'annulee']
+STATUTS_IMPAYES = ['en_attente', 'partielle']
+FENETRE_RECONCILIATION_RDV = (-7, 90)  # jours avant / après aujourd'hui
+
+def insert_dialecte():
+    if est_postgresql():
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+def cle_rdv_jour(jour):
+    return f'rdv:{jour.isoformat()}'
+
+def compteurs_facture(statut, montant_total, montant_paye):
+    return {
+        f'factures:{statut}': 1,
+        'montant_impaye': (montant_total or 0) - (montant_paye or 0) if statut in STATUTS_IMPAYES else 0
+    }
+
+def compteurs_medicament(quantite_stock, seuil_minimum):
+    return {'medicaments_stock_bas': 1 if (quantite_stock or 0) <= (seuil_minimum or 0) else 0}
+
+def difference_compteurs(avant, apres):
+    deltas = dict(apres)
+    for cle, valeur in avant.items():
+        deltas[cle] = deltas.get(cle, 0) - valeur
+    return deltas
+
+def ajuster_compteurs(deltas):
+    # Clés triées : deux transactions verrouillent les lignes dans le même ordre
+    lignes = [{'cle': cle, 'valeur': valeur} for cle, valeur in sorted(deltas.items()) if valeur]
+    if not lignes:
+        return
+    instruction = insert_dialecte()(Compteur.__table__)
+    instruction = instruction.on_conflict_do_update(
+        index_elements=['cle'],
+        set_={'valeur': Compteur.__table__.c.valeur + instruction.excluded.valeur, 'date_maj': datetime.utcnow()}
+    )
+    db.session.execute(instruction, lignes)
+
+def lire_compteurs(cles):
+    # Lecture seule : les compteurs sont initialisés par migrer_base ; une clé
+    # absente (jour sans rendez-vous...) vaut 0
+    valeurs = dict(db.session.query(Compteur.cle, Compteur.valeur).filter(Compteur.cle.in_(cles)).all())
+    return {cle: valeurs.get(cle, 0) for cle in cles}
+
+def reconcilier_compteurs():
+    # Sans verrou de table : les comptages et les compteurs stockés sont lus dans
+    # un même instantané (REPEATABLE READ), puis l'écart est appliqué en
+    # incrément ; les ajustements validés entre-temps par les routes d'écriture
+    # s'y ajoutent sans être écrasés
+    db.session.commit()
+    if est_postgresql():
+        db.session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+    
+    reels = {
+        'patients': db.session.query(db.func.count(Patient.id)).scalar(),
+        'personnel': db.session.query(db.func.count(Personnel.id)).scalar(),
+        'chambres_libres': db.session.query(db.func.count(Chambre.id)).filter(Chambre.statut == 'libre').scalar(),
+        'medicaments_stock_bas': db.session.query(db.func.count(Medicament.id)).filter(
+            Medicament.quantite_stock <= Medicament.seuil_minimum
+        ).scalar(),
+        'montant_impaye': 0
+    }
+    for statut in STATUTS_FACTURE:
+        reels[f'factures:{statut}'] = 0
+    for statut, nombre, reste in db.session.query(
+        Facture.statut, db.func.count(Facture.id), db.func.sum(Facture.montant_total - Facture.montant_paye)
+    ).group_by(Facture.statut):
+        reels[f'factures:{statut}'] = nombre
+        if statut in STATUTS_IMPAYES:
+            reels['montant_impaye'] += reste or 0
+    
+    aujourd_hui = date.today()
+    debut = aujourd_hui + timedelta(days=FENETRE_RECONCILIATION_RDV[0])
+    fin = aujourd_hui + timedelta(days=FENETRE_RECONCILIATION_RDV[1])
+    for jour in range((fin - debut).days):
+        reels[cle_rdv_jour(debut + timedelta(days=jour))] = 0
+    jour_rdv = db.func.date(RendezVous.date_rdv)
+    for jour, nombre in db.session.query(jour_rdv, db.func.count(RendezVous.id)).filter(
+        RendezVous.date_rdv >= datetime.combine(debut, datetime.min.time()),
+        RendezVous.date_rdv < datetime.combine(fin, datetime.min.time())
+    ).group_by(jour_rdv):
+        reels[f'rdv:{jour}'] = nombre
+    
+    stockes = dict(db.session.query(Compteur.cle, Compteur.valeur).filter(Compteur.cle.in_(list(reels))).all())
+    derives = {cle: (stockes.get(cle), valeur) for cle, valeur in reels.items()
+               if abs(stockes.get(cle, 0) - valeur) > 1e-6}
+    db.session.commit()
+    
+    ajuster_compteurs({cle: reel - (stocke or 0) for cle, (stocke, reel) in derives.items()})
+    db.session.commit()
+    invalider_stats_tableau_de_bord()
+    return derives
+
+# Statistiques du tableau de bord : lues dans les compteurs en une requête et
+# gardées quelques secondes par processus ; les routes d'écriture invalident le
+# cache local, les autres workers le rafraîchissent à l'expiration
+_cache_stats = {'valeur': None, 'expire': 0.0, 'jour': None}
+
+def calculer_stats_tableau_de_bord(jour):
+    compteurs = lire_compteurs(['patients', 'personnel', cle_rdv_jour(jour)])
+    return {
+        'total_patients': int(compteurs['patients']),
+        'total_personnel': int(compteurs['personnel']),
+        'rdv_aujourd_hui': int(compteurs[cle_rdv_jour(jour)])
+    }
+
+def stats_tableau_de_bord():
+    jour = date.today()
+    maintenant = time.monotonic()
+    if _cache_stats['valeur'] is None or _cache_stats['jour'] != jour or maintenant >= _cache_stats['expire']:
+        _cache_stats['valeur'] = calculer_stats_tableau_de_bord(jour)
+        _cache_stats['jour'] = jour
+        _cache_stats['expire'] = maintenant + app.config['STATS_CACHE_SECONDES']
+    return _cache_stats['valeur']
+
+def invalider_stats_tableau_de_bord():
+    _cache_stats['valeur'] = None
+
+# Pagination par curseur (keyset) : chaque page reprend après la dernière ligne
+# affichée au lieu d'utiliser OFFSET, le coût d'une page ne dépend donc pas de
+# la taille de la table
+def taille_page():
+    taille = request.args.get('taille', app.config['TAILLE_PAGE'], type=int)
+    return max(1, min(taille, app.config['TAILLE_PAGE_MAX']))
+
+def encoder_curseur(*valeurs):
+    valeurs = [v.isoformat() if isinstance(v, (date, datetime)) else v for v in valeurs]
+    brut = json.dumps(valeurs).encode()
+    return base64.urlsafe_b64encode(brut).decode().rstrip('=')
+
+def lire_curseur(curseur):
+    brut = base64.urlsafe_b64decode(curseur + '=' * (-len(curseur) % 4))
+    valeurs = json.loads(brut)
+    if not isinstance(valeurs, list):
+        raise ValueError('curseur invalide')
+    return valeurs
+
+def decoder_curseur(curseur, colonne):
+    try:
+        valeur, id = lire_curseur(curseur)
+        type_python = colonne.type.python_type
+        if valeur is not None and type_python is datetime:
+            valeur = datetime.fromisoformat(valeur)
+        elif valeur is not None and type_python is date:
+            valeur = date.fromisoformat(valeur)
+        return valeur, int(id)
+    except (ValueError, TypeError):
+        return None
+
+def condition_keyset(colonne, colonne_id, curseur, ordre_desc):
+    # Les NULL sont rangés après toutes les valeurs en ordre croissant (avant
+    # en ordre décroissant) : une comparaison de tuples seule les ignorerait
+    valeur, id = curseur
+    if not colonne.nullable:
+        cle, borne = db.tuple_(colonne, colonne_id), db.tuple_(valeur, id)
+        return cle < borne if ordre_desc else cle > borne
+    if valeur is None:
+        if ordre_desc:
+            return db.or_(db.and_(colonne.is_(None), colonne_id < id), colonne.isnot(None))
+        return db.and_(colonne.is_(None), colonne_id > id)
+    cle, borne = db.tuple_(colonne, colonne_id), db.tuple_(valeur, id)
+    return cle < borne if ordre_desc else db.or_(cle > borne, colonne.is_(None))
+
+def paginer_keyset(query, colonne, colonne_id, taille, apres=None, avant=None, descendant=False):
+    # En remontant (curseur "avant"), on lit dans l'ordre inverse puis on
+    # retourne la page pour l'afficher dans l'ordre demandé
+    recule = bool(avant) and not apres
+    curseur = decoder_curseur(avant if recule else apres, colonne) if (apres or avant) else None
+    ordre_desc = descendant != recule
+    
+    if curseur:
+        query = query.filter(condition_keyset(colonne, colonne_id, curseur, ordre_desc))
+    if ordre_desc:
+        tri = colonne.desc().nulls_first() if colonne.nullable else colonne.desc()
+        query = query.order_by(tri, colonne_id.desc())
+    else:
+        tri = colonne.asc().nulls_last() if colonne.nullable else colonne.asc()
+        query = query.order_by(tri, colonne_id.asc())
+    
+    lignes = query.limit(taille + 1).all()
+    encore = len(lignes) > taille
+    lignes = lignes[:taille]
+    if recule:
+        lignes.reverse()
+        a_suivant, a_precedent = curseur is not None, encore
+    else:
+        a_suivant, a_precedent = encore, curseur is not None
+    
+    def curseur_de(ligne):
+        return encoder_curseur(getattr(ligne, colonne.key), getattr(ligne, colonne_id.key))
+    
+    return {
+        'elements': lignes,
+        'suivant': curseur_de(lignes[-1]) if lignes and a_suivant else None,
+        'precedent': curseur_de(lignes[0]) if lignes and a_precedent else None,
+        'taille': taille
+    }
+
+def parcourir_par_lots(query, colonne_id, taille):
+    # Parcours complet d'une table par lots successifs sur la clé primaire :
+    # contrairement à yield_per, on peut valider la transaction entre deux lots
+    dernier = None
+    while True:
+        requete = query if dernier is None else query.filter(colonne_id > dernier)
+        lot = requete.order_by(colonne_id).limit(taille).all()
+        if not lot:
+            return
+        yield lot
+        dernier = getattr(lot[-1], colonne_id.key)
+
+# Colonnes de tri autorisées pour la liste des patients
+TRIS_PATIENTS = {
+    'nom': Patient.nom,
+    'prenom': Patient.prenom,
+    'date_naissance': Patient.date_naissance,
+    'date_inscription': Patient.date_inscription
+}
+
+def page_patients():
+    tri = request.args.get('tri', 'nom')
+    if tri not in TRIS_PATIENTS:
+        tri = 'nom'
+    ordre = 'desc' if request.args.get('ordre') == 'desc' else 'asc'
+    page = paginer_keyset(
+        Patient.query, TRIS_PATIENTS[tri], Patient.id, taille_page(),
+        apres=request.args.get('apres'), avant=request.args.get('avant'),
+        descendant=(ordre == 'desc')
+    )
+    page['tri'] = tri
+    page['ordre'] = ordre
+    return page
+
+# Chronologie d'un patient : rendez-vous, consultations, hospitalisations,
+# prescriptions et factures fusionnés en une seule requête UNION ALL, paginée
+# par curseur sur (date, type, id) en ordre décroissant. Chaque branche est
+# elle-même bornée par le curseur et la taille de page
+LIBELLES_EVENEMENTS = {
+    'consultation': 'Consultation',
+    'facture': 'Facture',
+    'hospitalisation': 'Hospitalisation',
+    'prescription': 'Prescription',
+    'rendez_vous': 'Rendez-vous'
+}
+
+def branches_chronologie():
+    praticien = Personnel.nom + ' ' + Personnel.prenom
+    return [
+        ('consultation', Consultation.id, Consultation.date_consultation, praticien,
+         Consultation.diagnostic, db.null(), Consultation.patient_id,
+         [(Personnel, Consultation.personnel_id == Personnel.id)]),
+        ('facture', Facture.id, Facture.date_facture, Facture.numero_facture,
+         Facture.type_facture, Facture.statut, Facture.patient_id, []),
+        ('hospitalisation', Hospitalisation.id, Hospitalisation.date_admission, 'Chambre ' + Chambre.numero,
+         Hospitalisation.motif_admission, Hospitalisation.statut, Hospitalisation.patient_id,
+         [(Chambre, Hospitalisation.chambre_id == Chambre.id)]),
+        ('prescription', Prescription.id, Prescription.date_prescription, Medicament.nom,
+         Prescription.posologie, Prescription.statut, Prescription.patient_id,
+         [(Medicament, Prescription.medicament_id == Medicament.id)]),
+        ('rendez_vous', RendezVous.id, RendezVous.date_rdv, RendezVous.type_consultation,
+         praticien, RendezVous.statut, RendezVous.patient_id,
+         [(Personnel, RendezVous.personnel_id == Personnel.id)]),
+    ]
+
+def chronologie_patient(patient_id, taille, apres=None):
+    curseur = None
+    if apres:
+        try:
+            date_c, type_c, id_c = lire_curseur(apres)
+            curseur = (datetime.fromisoformat(date_c), str(type_c), int(id_c))
+        except (ValueError, TypeError):
+            curseur = None
+    
+    selections = []
+    for type_evt, col_id, col_date, titre, detail, statut, col_patient, jointures in branches_chronologie():
+        requete = db.select(
+            db.literal(type_evt).label('type'),
+            col_id.label('id'),
+            col_date.label('date'),
+            db.cast(titre, db.Text).label('titre'),
+            db.cast(detail, db.Text).label('detail'),
+            db.cast(statut, db.String(20)).label('statut')
+        ).select_from(col_id.class_)
+        for cible, condition in jointures:
+            requete = requete.join(cible, condition)
+        requete = requete.where(col_patient == patient_id)
+        if curseur:
+            date_c, type_c, id_c = curseur
+            if type_evt < type_c:
+                requete = requete.where(col_date <= date_c)
+            elif type_evt == type_c:
+                requete = requete.where(db.tuple_(col_date, col_id) < db.tuple_(date_c, id_c))
+            else:
+                requete = requete.where(col_date < date_c)
+        requete = requete.order_by(col_date.desc(), col_id.desc()).limit(taille + 1)
+        selections.append(db.select(requete.subquery()))
+    
+    union = db.union_all(*selections).subquery()
+    requete = db.select(union).order_by(union.c.date.desc(), union.c.type.desc(), union.c.id.desc()).limit(taille + 1)
+    lignes = db.session.execute(requete).all()
+    
+    suivant = None
+    if len(lignes) > taille:
+        lignes = lignes[:taille]
+        dernier = lignes[-1]
+        suivant = encoder_curseur(dernier.date, dernier.type, dernier.id)
+    return {'evenements': lignes, 'suivant': suivant}
+
+# Moteur de recherche des patients (nom, prénom, téléphone, NSS, email)
+# Les termes sont normalisés en Python (minuscules, sans accents) puis indexés
+# dans la table patient_recherche : index GIN plein texte + trigrammes sur
+# PostgreSQL, table virtuelle FTS5 sur SQLite
+def est_postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+def normaliser_texte(texte):
+    texte = unicodedata.normalize('NFKD', texte or '')
+    texte = ''.join(c for c in texte if not unicodedata.combining(c)).lower()
+    return ' '.join(re.findall(r'[a-z0-9]+', texte))
+
+def normaliser_numero(numero):
+    return re.sub(r'[^0-9a-z]', '', (numero or '').lower())
+
+def trigrammes(texte):
+    resultat = []
+    for mot in texte.split():
+        grams = [mot] if len(mot) < 3 else [mot[i:i + 3] for i in range(len(mot) - 2)]
+        for gram in grams:
+            if gram not in resultat:
+                resultat.append(gram)
+    return resultat
+
+def similarite_trigrammes(a, b):
+    ga, gb = set(trigrammes(a)), set(trigrammes(b))
+    if not ga or not gb:
+        return 0.0
+    return len(ga & gb) / len(ga | gb)
+
+def termes_patient(patient):
+    return ' '.join(t for t in [
+        normaliser_texte(patient.nom),
+        normaliser_texte(patient.prenom),
+        normaliser_numero(patient.telephone),
+        normaliser_numero(patient.numero_securite_sociale),
+        normaliser_texte(patient.email)
+    ] if t)
+
+def initialiser_recherche():
+    if est_postgresql():
+        db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        db.session.execute(text(
+            'CREATE TABLE IF NOT EXISTS patient_recherche ('
+            'patient_id INTEGER PRIMARY KEY, termes TEXT NOT NULL, nom_complet TEXT NOT NULL)'
+        ))
+        db.session.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_patient_recherche_fts ON patient_recherche '
+            "USING gin (to_tsvector('simple', termes))"
+        ))
+        db.session.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_patient_recherche_trgm ON patient_recherche '
+            'USING gin (nom_complet gin_trgm_ops)'
+        ))
+    else:
+        db.session.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS patient_recherche USING fts5('
+            "termes, nom_complet, trigrammes, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        ))
+    db.session.commit()
+
+def indexer_patients(patients):
+    lignes = []
+    for patient in patients:
+        nom_complet = normaliser_texte(f'{patient.nom} {patient.prenom}')
+        lignes.append({
+            'id': patient.id,
+            'termes': termes_patient(patient),
+            'nom_complet': nom_complet,
+            'trigrammes': ' '.join(trigrammes(nom_complet))
+        })
+    if not lignes:
+        return
+    if est_postgresql():
+        db.session.execute(text(
+            'INSERT INTO patient_recherche (patient_id, termes, nom_complet) '
+            'VALUES (:id, :termes, :nom_complet) '
+            'ON CONFLICT (patient_id) DO UPDATE SET termes = EXCLUDED.termes, nom_complet = EXCLUDED.nom_complet'
+        ), lignes)
+    else:
+        db.session.execute(text(
+            'INSERT OR REPLACE INTO patient_recherche (rowid, termes, nom_complet, trigrammes) '
+            'VALUES (:id, :termes, :nom_complet, :trigrammes)'
+        ), lignes)
+
+def reindexer_patients(taille=1000):
+    total = 0
+    for lot in parcourir_par_lots(Patient.query, Patient.id, taille):
+        indexer_patients(lot)
+        db.session.commit()
+        total += len(lot)
+    return total
+
+def completer_index_recherche(afficher=logger.info):
+    # Patients antérieurs à l'index ou insérés hors des routes : l'index est
+    # reconstruit dès qu'il compte moins de lignes que la table patient
+    indexes = db.session.execute(text('SELECT count(*) FROM patient_recherche')).scalar()
+    patients = db.session.query(db.func.count(Patient.id)).scalar()
+    if indexes < patients:
+        afficher(f"Indexation de {patients} patients pour la recherche")
+        reindexer_patients()
+
+def desindexer_patient(patient_id):
+    colonne = 'patient_id' if est_postgresql() else 'rowid'
+    db.session.execute(text(f'DELETE FROM patient_recherche WHERE {colonne} = :id'), {'id': patient_id})
+
+def rechercher_patients(requete, limite=20):
+    mots = normaliser_texte(requete).split()
+    if not mots:
+        return []
+    ids = []
+    
+    # 1. Recherche par préfixe : chaque mot doit commencer un des termes indexés
+    if est_postgresql():
+        lignes = db.session.execute(text(
+            'SELECT patient_id FROM patient_recherche '
+            "WHERE to_tsvector('simple', termes) @@ to_tsquery('simple', :q) LIMIT :limite"
+        ), {'q': ' & '.join(f'{m}:*' for m in mots), 'limite': limite})
+    else:
+        lignes = db.session.execute(text(
+            'SELECT rowid FROM patient_recherche WHERE patient_recherche MATCH :q ORDER BY rank LIMIT :limite'
+        ), {'q': 'termes : (' + ' '.join(f'"{m}"*' for m in mots) + ')', 'limite': limite})
+    ids.extend(ligne[0] for ligne in lignes)
+    
+    # 2. Complément approximatif par similarité de trigrammes sur nom + prénom
+    if len(ids) < limite:
+        cible = ' '.join(mots)
+        if est_postgresql():
+            lignes = db.session.execute(text(
+                'SELECT patient_id FROM patient_recherche WHERE :q <% nom_complet '
+                'ORDER BY word_similarity(:q, nom_complet) DESC LIMIT :limite'
+            ), {'q': cible, 'limite': limite})
+            candidats = [ligne[0] for ligne in lignes]
+        else:
+            grams = trigrammes(cible)
+            lignes = db.session.execute(text(
+                'SELECT rowid, nom_complet FROM patient_recherche WHERE patient_recherche MATCH :q '
+                'ORDER BY rank LIMIT :limite'
+            ), {'q': 'trigrammes : (' + ' OR '.join(f'"{g}"' for g in grams) + ')', 'limite': limite * 5})
+            scores = [(similarite_trigrammes(cible, nom), id) for id, nom in lignes]
+            candidats = [id for score, id in sorted(scores, key=lambda s: -s[0]) if score >= 0.3]
+        ids.extend(id for id in candidats if id not in ids)
+    
+    ids = ids[:limite]
+    if not ids:
+        return []
+    par_id = {p.id: p for p in Patient.query.filter(Patient.id.in_(ids)).all()}
+    return [par_id[id] for id in ids if id in par_id]
+
+# Détection des doublons de patients : chaque patient reçoit quelques clés de
+# blocage (début du nom ou du prénom + date de naissance, téléphone + date de
+# naissance, début du nom + téléphone). Seuls les patients partageant une clé
+# sont comparés, puis les paires candidates sont notées par lots avec NumPy
+SEUIL_DOUBLON = 0.7
+TAILLE_LOT_DOUBLONS = 5000
+
+def cles_doublon(patient):
+    nom = normaliser_texte(patient.nom).replace(' ', '')
+    prenom = normaliser_texte(patient.prenom).replace(' ', '')
+    naissance = patient.date_naissance.isoformat() if patient.date_naissance else ''
+    telephone = re.sub(r'[^0-9]', '', patient.telephone or '')[-8:]
+    cles = set()
+    if naissance:
+        cles.add(f'nd:{nom[:3]}:{naissance}')
+        cles.add(f'pd:{prenom[:3]}:{naissance}')
+        if telephone:
+            cles.add(f'td:{telephone}:{naissance}')
+    if telephone:
+        cles.add(f'nt:{nom[:3]}:{telephone}')
+    return cles
+
+def indexer_cles_doublons(patients):
+    lignes = [{'patient_id': p.id, 'cle': cle} for p in patients for cle in cles_doublon(p)]
+    ids = [p.id for p in patients]
+    if not ids:
+        return
+    db.session.execute(db.delete(CleDoublon).where(CleDoublon.patient_id.in_(ids)))
+    if lignes:
+        db.session.execute(db.insert(CleDoublon), lignes)
+
+def empreinte_nom(nom_complet):
+    # Ensemble des trigrammes du nom sous forme de masque de 128 bits
+    bits = 0
+    for gram in trigrammes(nom_complet):
+        bits |= 1 << (zlib.crc32(gram.encode()) % 128)
+    return bits & 0xFFFFFFFFFFFFFFFF, bits >> 64
+
+def nombre_bits(tableau):
+    return np.unpackbits(np.ascontiguousarray(tableau).view(np.uint8), axis=-1).sum(axis=-1)
+
+def noter_paires(paires):
+    ids = sorted({id for paire in paires for id in paire})
+    patients = db.session.execute(db.select(
+        Patient.id, Patient.nom, Patient.prenom, Patient.date_naissance,
+        Patient.telephone, Patient.email, Patient.numero_securite_sociale
+    ).where(Patient.id.in_(ids))).all()
+    position = {p.id: i for i, p in enumerate(patients)}
+    paires = [(a, b) for a, b in paires if a in position and b in position]
+    if not paires:
+        return []
+    
+    empreintes = np.array([empreinte_nom(normaliser_texte(f'{p.nom} {p.prenom}')) for p in patients], dtype=np.uint64)
+    naissances = np.array([p.date_naissance.toordinal() if p.date_naissance else -1 for p in patients])
+    telephones = np.array([re.sub(r'[^0-9]', '', p.telephone or '')[-8:] for p in patients], dtype=object)
+    emails = np.array([(p.email or '').strip().lower() for p in patients], dtype=object)
+    numeros = np.array([normaliser_numero(p.numero_securite_sociale) for p in patients], dtype=object)
+    
+    ia = np.array([position[a] for a, _ in paires])
+    ib = np.array([position[b] for _, b in paires])
+    union = nombre_bits(empreintes[ia] | empreintes[ib])
+    similarite_nom = np.where(union > 0, nombre_bits(empreintes[ia] & empreintes[ib]) / np.maximum(union, 1), 0.0)
+    meme_naissance = (naissances[ia] == naissances[ib]) & (naissances[ia] >= 0)
+    meme_telephone = (telephones[ia] == telephones[ib]) & (telephones[ia] != '')
+    meme_email = (emails[ia] == emails[ib]) & (emails[ia] != '')
+    nss_renseignes = (numeros[ia] != '') & (numeros[ib] != '')
+    
+    scores = 0.55 * similarite_nom + 0.2 * meme_naissance + 0.15 * meme_telephone + 0.1 * meme_email
+    scores = np.where(nss_renseignes & (numeros[ia] != numeros[ib]), scores * 0.5, scores)
+    scores = np.where(nss_renseignes & (numeros[ia] == numeros[ib]), 1.0, scores)
+    return [(a, b, float(score)) for (a, b), score in zip(paires, scores)]
+
+def detecter_doublons(seuil=SEUIL_DOUBLON):
+    a, b = db.aliased(CleDoublon), db.aliased(CleDoublon)
+    requete = db.select(a.patient_id, b.patient_id).distinct().join(
+        b, db.and_(a.cle == b.cle, a.patient_id < b.patient_id)
+    ).execution_options(yield_per=TAILLE_LOT_DOUBLONS)
+    ignores = {(x, y) for x, y in db.session.query(
+        DoublonCandidat.patient_a_id, DoublonCandidat.patient_b_id
+    ).filter(DoublonCandidat.statut == 'ignore')}
+    
+    # Les candidats sont calculés à part puis remplacent les anciens d'un bloc
+    candidats = []
+    for lot in db.session.execute(requete).partitions():
+        paires = [(x, y) for x, y in lot if (x, y) not in ignores]
+        candidats.extend(c for c in noter_paires(paires) if c[2] >= seuil)
+    
+    db.session.execute(db.delete(DoublonCandidat).where(DoublonCandidat.statut == 'a_verifier'))
+    if candidats:
+        db.session.execute(db.insert(DoublonCandidat), [
+            {'patient_a_id': x, 'patient_b_id': y, 'score': score, 'statut': 'a_verifier', 'date_detection': datetime.utcnow()}
+            for x, y, score in candidats
+        ])
+    db.session.commit()
+    return len(candidats)
+
+MODELES_LIES_PATIENT = [RendezVous, SerieRendezVous, Consultation, Hospitalisation, Prescription, Facture]
+
+def fusionner_patients(garde, doublon):
+    # Rattache toutes les lignes liées au patient conservé (un UPDATE par table)
+    for modele in MODELES_LIES_PATIENT:
+        db.session.execute(
+            db.update(modele).where(modele.patient_id == doublon.id).values(patient_id=garde.id),
+            execution_options={'synchronize_session': False}
+        )
+    
+    # Compléter les champs manquants du patient conservé
+    transferts = {}
+    for champ in ('email', 'adresse', 'numero_securite_sociale'):
+        if not getattr(garde, champ) and getattr(doublon, champ):
+            transferts[champ] = getattr(doublon, champ)
+            setattr(doublon, champ, None)
+    db.session.flush()
+    for champ, valeur in transferts.items():
+        setattr(garde, champ, valeur)
+    
+    db.session.execute(db.delete(DoublonCandidat).where(db.or_(
+        DoublonCandidat.patient_a_id == doublon.id, DoublonCandidat.patient_b_id == doublon.id
+    )))
+    db.session.execute(db.delete(CleDoublon).where(CleDoublon.patient_id == doublon.id))
+    desindexer_patient(doublon.id)
+    db.session.expire(doublon)
+    db.session.delete(doublon)
+    ajuster_compteurs({'patients': -1})
+    db.session.flush()
+    indexer_patients([garde])
+    indexer_cles_doublons([garde])
+
+# Calendrier des rendez-vous : seule la fenêtre affichée (jour, semaine, mois)
+# est lue, par parcours d'index sur (personnel_id, date_rdv) ou date_rdv, avec
+# les noms du patient et du médecin joints dans la même requête
+VUES_CALENDRIER = ('jour', 'semaine', 'mois')
+
+def fenetre_calendrier(vue, jour):
+    if vue == 'jour':
+        debut = jour
+        fin = jour + timedelta(days=1)
+    elif vue == 'mois':
+        debut = jour.replace(day=1)
+        fin = (debut + timedelta(days=32)).replace(day=1)
+    else:
+        debut = jour - timedelta(days=jour.weekday())
+        fin = debut + timedelta(days=7)
+    return debut, fin
+
+def parametres_calendrier():
+    vue = request.args.get('vue', 'semaine')
+    if vue not in VUES_CALENDRIER:
+        vue = 'semaine'
+    try:
+        jour = date.fromisoformat(request.args.get('date', ''))
+    except ValueError:
+        jour = date.today()
+    personnel_id = request.args.get('personnel_id', type=int)
+    return vue, jour, personnel_id
+
+def rendez_vous_periode(debut, fin, personnel_id=None):
+    query = db.session.query(
+        RendezVous.id, RendezVous.date_rdv, RendezVous.date_fin, RendezVous.duree, RendezVous.type_consultation,
+        RendezVous.statut, RendezVous.notes, RendezVous.serie_id,
+        RendezVous.patient_id, Patient.nom.label('patient_nom'), Patient.prenom.label('patient_prenom'),
+        RendezVous.personnel_id, Personnel.nom.label('personnel_nom'), Personnel.prenom.label('personnel_prenom')
+    ).join(Patient, RendezVous.patient_id == Patient.id
+    ).join(Personnel, RendezVous.personnel_id == Personnel.id
+    ).filter(
+        RendezVous.date_rdv >= datetime.combine(debut, datetime.min.time()),
+        RendezVous.date_rdv < datetime.combine(fin, datetime.min.time())
+    )
+    if personnel_id:
+        query = query.filter(RendezVous.personnel_id == personnel_id)
+    return query.order_by(RendezVous.date_rdv, RendezVous.id).all()
+
+def rendez_vous_json(rdv):
+    return {
+        'id': rdv.id,
+        'date_rdv': rdv.date_rdv.isoformat(),
+        'duree': rdv.duree,
+        'type_consultation': rdv.type_consultation,
+        'statut': rdv.statut,
+        'notes': rdv.notes,
+        'serie_id': rdv.serie_id,
+        'patient': {'id': rdv.patient_id, 'nom': rdv.patient_nom, 'prenom': rdv.patient_prenom},
+        'personnel': {'id': rdv.personnel_id, 'nom': rdv.personnel_nom, 'prenom': rdv.personnel_prenom}
+    }
+
+# Détection des doubles réservations : un médecin ne peut pas avoir deux
+# rendez-vous actifs qui se chevauchent. La durée étant bornée, la recherche
+# se limite à la plage [début - durée max, fin[ de l'index (personnel_id,
+# date_rdv). L'agenda du médecin est verrouillé avant la vérification pour que
+# deux réservations simultanées soient sérialisées ; sur PostgreSQL une
+# contrainte d'exclusion garantit en plus l'absence de chevauchement en base
+DUREE_RDV_DEFAUT = 30
+DUREE_RDV_MAX = 480
+CONTRAINTE_CHEVAUCHEMENT_RDV = 'ex_rendez_vous_chevauchement'
+
+class ConflitRendezVous(Exception):
+    def __init__(self, conflit=None):
+        super().__init__('Chevauchement de rendez-vous')
+        self.conflit = conflit
+
+def lire_duree_rdv(valeur):
+    try:
+        duree = int(valeur or DUREE_RDV_DEFAUT)
+    except ValueError:
+        duree = DUREE_RDV_DEFAUT
+    return max(5, min(duree, DUREE_RDV_MAX))
+
+def verrouiller_agenda(personnel_id):
+    if est_postgresql():
+        db.session.execute(text('SELECT id FROM personnel WHERE id = :id FOR UPDATE'), {'id': personnel_id})
+    else:
+        # Prend le verrou d'écriture SQLite avant la lecture
+        db.session.execute(text('UPDATE personnel SET id = id WHERE id = :id'), {'id': personnel_id})
+
+def rendez_vous_en_conflit(personnel_id, debut, fin, exclure_id=None):
+    query = RendezVous.query.filter(
+        RendezVous.personnel_id == personnel_id,
+        RendezVous.date_rdv > debut - timedelta(minutes=DUREE_RDV_MAX),
+        RendezVous.date_rdv < fin,
+        RendezVous.date_fin > debut,
+        RendezVous.statut != 'annule'
+    )
+    if exclure_id:
+        query = query.filter(RendezVous.id != exclure_id)
+    return query.order_by(RendezVous.date_rdv).first()
+
+def reserver_rendez_vous(rdv):
+    rdv.duree = lire_duree_rdv(rdv.duree)
+    rdv.date_fin = rdv.date_rdv + timedelta(minutes=rdv.duree)
+    if rdv.statut == 'annule':
+        return
+    with db.session.no_autoflush:
+        verrouiller_agenda(rdv.personnel_id)
+        conflit = rendez_vous_en_conflit(rdv.personnel_id, rdv.date_rdv, rdv.date_fin, rdv.id)
+    if conflit:
+        raise ConflitRendezVous(conflit)
+
+def enregistrer_rendez_vous(rdv, deltas):
+    reserver_rendez_vous(rdv)
+    db.session.add(rdv)
+    ajuster_compteurs(deltas)
+    try:
+        db.session.commit()
+    except IntegrityError as e:
+        # Violation de la contrainte d'exclusion (PostgreSQL)
+        if CONTRAINTE_CHEVAUCHEMENT_RDV not in str(e.orig):
+            raise
+        raise ConflitRendezVous() from e
+
+def message_conflit_rdv(erreur):
+    conflit = erreur.conflit
+    if conflit:
+        return (f"Le médecin a déjà un rendez-vous de {conflit.date_rdv.strftime('%H:%M')} à "
+                f"{conflit.date_fin.strftime('%H:%M')} le {conflit.date_rdv.strftime('%d/%m/%Y')}")
+    return 'Le médecin a déjà un rendez-vous sur ce créneau'
+
+def installer_contrainte_chevauchement():
+    if not est_postgresql():
+        return
+    existe = db.session.execute(text(
+        'SELECT 1 FROM pg_constraint WHERE conname = :nom'
+    ), {'nom': CONTRAINTE_CHEVAUCHEMENT_RDV}).scalar()
+    if existe:
+        return
+    try:
+        db.session.execute(text('CREATE EXTENSION IF NOT EXISTS btree_gist'))
+        db.session.execute(text(
+            f'ALTER TABLE rendez_vous ADD CONSTRAINT {CONTRAINTE_CHEVAUCHEMENT_RDV} '
+            "EXCLUDE USING gist (personnel_id WITH =, tsrange(date_rdv, date_fin) WITH &&) "
+            "WHERE (statut <> 'annule')"
+        ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"Contrainte d'exclusion des rendez-vous non installée "
+                       f"(chevauchements existants à corriger ?) : {str(e)}")
+
+# Recherche de créneaux libres : pour chaque médecin, les plages de travail
+# du jour sont balayées avec ses rendez-vous triés (une seule requête pour
+# tout l'horizon) ; les intervalles libres sont découpés en créneaux et les
+# générateurs des différents médecins sont fusionnés par date (heapq.merge).
+# L'horizon est parcouru par fenêtres d'une semaine : la recherche s'arrête
+# dès que les N premiers créneaux sont trouvés
+DUREES_TYPE_CONSULTATION = {
+    'Consultation générale': 30,
+    'Consultation spécialisée': 45,
+    'Contrôle': 15,
+    'Urgence': 30,
+    'Vaccination': 15,
+    'Bilan de santé': 60,
+}
+JOURS_SEMAINE = ('Lundi', 'Mardi', 'Mercredi', 'Jeudi', 'Vendredi', 'Samedi', 'Dimanche')
+# Horaires appliqués aux médecins dont les horaires n'ont jamais été configurés : du lundi au vendredi
+HORAIRES_DEFAUT = {jour: [(datetime.strptime('08:00', '%H:%M').time(), datetime.strptime('12:00', '%H:%M').time()),
+                          (datetime.strptime('14:00', '%H:%M').time(), datetime.strptime('18:00', '%H:%M').time())]
+                   for jour in range(5)}
+PAS_CRENEAU = 15  # minutes
+HORIZON_CRENEAUX_MAX = 92  # jours
+FENETRE_CRENEAUX = timedelta(days=7)
+
+def duree_type_consultation(type_consultation):
+    return DUREES_TYPE_CONSULTATION.get(type_consultation, DUREE_RDV_DEFAUT)
+
+def horaires_personnel(personnel_ids):
+    horaires = {personnel_id: {} for personnel_id in personnel_ids}
+    lignes = HoraireTravail.query.filter(HoraireTravail.personnel_id.in_(personnel_ids)).order_by(
+        HoraireTravail.personnel_id, HoraireTravail.jour_semaine, HoraireTravail.heure_debut
+    ).all()
+    for ligne in lignes:
+        horaires[ligne.personnel_id].setdefault(ligne.jour_semaine, []).append((ligne.heure_debut, ligne.heure_fin))
+    configures = {personnel_id for (personnel_id,) in db.session.query(Personnel.id).filter(
+        Personnel.id.in_(personnel_ids), Personnel.horaires_configures.is_(True))}
+    return {personnel_id: jours if personnel_id in configures else HORAIRES_DEFAUT
+            for personnel_id, jours in horaires.items()}
+
+def occupations_personnel(personnel_ids, debut, fin):
+    occupations = {personnel_id: [] for personnel_id in personnel_ids}
+    lignes = db.session.query(RendezVous.personnel_id, RendezVous.date_rdv, RendezVous.date_fin).filter(
+        RendezVous.personnel_id.in_(personnel_ids),
+        RendezVous.date_rdv > debut - timedelta(minutes=DUREE_RDV_MAX),
+        RendezVous.date_rdv < fin,
+        RendezVous.date_fin > debut,
+        RendezVous.statut != 'annule'
+    ).order_by(RendezVous.personnel_id, RendezVous.date_rdv)
+    for personnel_id, date_debut, date_fin in lignes:
+        occupations[personnel_id].append((date_debut, date_fin))
+    return occupations
+
+def intervalles_libres(horaires, occupations, debut, fin):
+    # Balayage : les plages de travail et les occupations sont toutes deux
+    # triées, l'indice des occupations ne fait qu'avancer
+    i = 0
+    jour = debut.date()
+    while datetime.combine(jour, datetime.min.time()) < fin:
+        for heure_debut, heure_fin in horaires.get(jour.weekday(), ()):
+            curseur = max(datetime.combine(jour, heure_debut), debut)
+            plage_fin = min(datetime.combine(jour, heure_fin), fin)
+            while i < len(occupations) and occupations[i][1] <= curseur:
+                i += 1
+            j = i
+            while curseur < plage_fin and j < len(occupations) and occupations[j][0] < plage_fin:
+                occupation_debut, occupation_fin = occupations[j]
+                if occupation_debut > curseur:
+                    yield curseur, occupation_debut
+                curseur = max(curseur, occupation_fin)
+                j += 1
+            if curseur < plage_fin:
+                yield curseur, plage_fin
+        jour += timedelta(days=1)
+
+def creneaux_personnel(personnel, horaires, occupations, debut, fin, duree):
+    pas = timedelta(minutes=PAS_CRENEAU)
+    longueur = timedelta(minutes=duree)
+    for libre_debut, libre_fin in intervalles_libres(horaires, occupations, debut, fin):
+        # Alignement sur la grille des créneaux
+        decalage = (libre_debut - datetime.combine(libre_debut.date(), datetime.min.time())) % pas
+        creneau = libre_debut + (pas - decalage if decalage else timedelta(0))
+        while creneau + longueur <= libre_fin:
+            yield creneau, personnel.id, creneau + longueur, personnel
+            creneau += pas
+
+def creneaux_libres(personnels, debut, fin, duree, nombre):
+    personnel_ids = [p.id for p in personnels]
+    if not personnel_ids:
+        return []
+    horaires = horaires_personnel(personnel_ids)
+    creneaux = []
+    fenetre_debut = debut
+    while fenetre_debut < fin and len(creneaux) < nombre:
+        # Fenêtres bornées à minuit : les plages de travail ne franchissent pas
+        # minuit, aucun créneau n'est donc coupé entre deux fenêtres
+        fenetre_fin = min(datetime.combine(fenetre_debut.date(), datetime.min.time()) + FENETRE_CRENEAUX, fin)
+        occupations = occupations_personnel(personnel_ids, fenetre_debut, fenetre_fin)
+        generateurs = [creneaux_personnel(p, horaires[p.id], occupations[p.id], fenetre_debut, fenetre_fin, duree)
+                       for p in personnels]
+        for creneau_debut, _, creneau_fin, personnel in heapq.merge(*generateurs, key=lambda c: (c[0], c[1])):
+            creneaux.append({'debut': creneau_debut, 'fin': creneau_fin, 'personnel': personnel})
+            if len(creneaux) >= nombre:
+                break
+        fenetre_debut = fenetre_fin
+    return creneaux
+
+def specialites_personnel():
+    return [ligne[0] for ligne in db.session.query(Personnel.specialite).filter(
+        Personnel.statut == 'actif'
+    ).distinct().order_by(Personnel.specialite)]
+
+def lire_horaires_jour(valeur):
+    # Format saisi : "08:00-12:00, 14:00-18:00"
+    plages = []
+    for morceau in filter(None, (m.strip() for m in valeur.split(','))):
+        heure_debut, heure_fin = (datetime.strptime(h.strip(), '%H:%M').time() for h in morceau.split('-'))
+        if heure_fin <= heure_debut:
+            raise ValueError(morceau)
+        plages.append((heure_debut, heure_fin))
+    plages.sort()
+    for (_, fin_precedente), (debut_suivant, _) in zip(plages, plages[1:]):
+        if debut_suivant < fin_precedente:
+            raise ValueError(valeur)
+    return plages
+
+# Alertes pharmacie : stock sous le seuil (compteur maintenu à chaque
+# mouvement de stock, liste servie par l'index partiel ix_medicament_stock_bas)
+# et péremption proche (parcours de l'index sur date_expiration)
+DELAI_ALERTE_EXPIRATION = 30  # jours
+
+def alerte_sortie_stock(stock_apres, seuil, quantite):
+    # La sortie fait-elle passer le médicament sous le seuil ?
+    return difference_compteurs(compteurs_medicament(stock_apres + quantite, seuil),
+                                compteurs_medicament(stock_apres, seuil))
+
+def nombre_expirations(jour=None):
+    limite = (jour or date.today()) + timedelta(days=DELAI_ALERTE_EXPIRATION)
+    return db.session.query(db.func.count(Medicament.id)).filter(
+        Medicament.date_expiration.isnot(None),
+        Medicament.date_expiration <= limite
+    ).scalar()
+
+def alertes_pharmacie(limite=20):
+    date_limite = date.today() + timedelta(days=DELAI_ALERTE_EXPIRATION)
+    stock_bas = Medicament.query.filter(
+        Medicament.quantite_stock <= Medicament.seuil_minimum
+    ).order_by(Medicament.nom, Medicament.id).limit(limite).all()
+    expirations = Medicament.query.filter(
+        Medicament.date_expiration.isnot(None),
+        Medicament.date_expiration <= date_limite
+    ).order_by(Medicament.date_expiration, Medicament.id).limit(limite).all()
+    return {'stock_bas': stock_bas, 'expirations': expirations}
+
+# Stock par lot : chaque réception crée un lot (numéro, quantité, péremption).
+# Les sorties consomment d'abord les lots qui expirent le plus tôt (FEFO), lus
+# par l'index partiel ix_lot_medicament_fefo ; les lots périmés ne sont jamais
+# délivrés. Medicament.quantite_stock (somme des lots) et
+# Medicament.date_expiration (prochaine péremption) sont dénormalisés et mis à
+# jour dans la même transaction, les pages du catalogue n'agrègent pas les
+# lots. Le verrou de la ligne medicament protège aussi ses lots
+def lots_disponibles(medicament_ids):
+    lots = {medicament_id: [] for medicament_id in medicament_ids}
+    lignes = db.session.execute(
+        db.select(LotMedicament.id, LotMedicament.medicament_id, LotMedicament.quantite,
+                  LotMedicament.date_expiration).where(
+            LotMedicament.medicament_id.in_(medicament_ids),
+            LotMedicament.quantite > 0
+        ).order_by(LotMedicament.medicament_id, LotMedicament.date_expiration.nulls_last(), LotMedicament.id)
+    )
+    for lot in lignes:
+        lots[lot.medicament_id].append(lot)
+    return lots
+
+def lot_perime(lot, jour):
+    return lot.date_expiration is not None and lot.date_expiration < jour
+
+def quantite_delivrable(lots, jour):
+    return sum(lot.quantite for lot in lots if not lot_perime(lot, jour))
+
+def sortir_stock(sorties, lots, jour):
+    # sorties : [(prescription_id, medicament_id, quantité)] par ordre de
+    # délivrance, déjà vérifiées contre quantite_delivrable
+    restants = {medicament_id: {lot.id: lot.quantite for lot in lots_medicament}
+                for medicament_id, lots_medicament in lots.items()}
+    mouvements = []
+    totaux = {}
+    for prescription_id, medicament_id, quantite in sorties:
+        totaux[medicament_id] = totaux.get(medicament_id, 0) + quantite
+        for lot in lots[medicament_id]:
+            if not quantite:
+                break
+            if lot_perime(lot, jour) or not restants[medicament_id][lot.id]:
+                continue
+            prise = min(quantite, restants[medicament_id][lot.id])
+            restants[medicament_id][lot.id] -= prise
+            quantite -= prise
+            mouvements.append({'medicament_id': medicament_id, 'lot_id': lot.id, 'prescription_id': prescription_id,
+                               'type_mouvement': 'delivrance', 'quantite': -prise})
+    
+    alertes = {}
+    lots_modifies = []
+    for medicament_id in sorted(totaux):
+        prochaine_expiration = None
+        for lot in lots[medicament_id]:
+            restant = restants[medicament_id][lot.id]
+            if restant != lot.quantite:
+                lots_modifies.append({'id': lot.id, 'quantite': restant})
+            if restant and lot.date_expiration is not None and prochaine_expiration is None:
+                prochaine_expiration = lot.date_expiration
+        stock = db.session.execute(
+            db.update(Medicament).where(Medicament.id == medicament_id).values(
+                quantite_stock=Medicament.quantite_stock - totaux[medicament_id],
+                date_expiration=prochaine_expiration
+            ).returning(Medicament.quantite_stock, Medicament.seuil_minimum),
+            execution_options={'synchronize_session': False}
+        ).first()
+        for cle, delta in alerte_sortie_stock(stock.quantite_stock, stock.seuil_minimum, totaux[medicament_id]).items():
+            alertes[cle] = alertes.get(cle, 0) + delta
+    if lots_modifies:
+        # UPDATE groupé par clé primaire (executemany)
+        db.session.execute(db.update(LotMedicament), lots_modifies)
+    enregistrer_mouvements(mouvements)
+    ajuster_compteurs(alertes)
+
+def recalculer_stock(medicament_id):
+    # Après une réception ou un ajustement d'inventaire : quantite_stock et
+    # date_expiration sont recalculés à partir des lots en un seul UPDATE
+    avant = db.session.execute(
+        db.select(Medicament.quantite_stock, Medicament.seuil_minimum).where(Medicament.id == medicament_id)
+    ).first()
+    restants = db.select(LotMedicament).where(
+        LotMedicament.medicament_id == medicament_id, LotMedicament.quantite > 0
+    ).subquery()
+    apres = db.session.execute(
+        db.update(Medicament).where(Medicament.id == medicament_id).values(
+            quantite_stock=db.select(db.func.coalesce(db.func.sum(restants.c.quantite), 0)).scalar_subquery(),
+            date_expiration=db.select(db.func.min(restants.c.date_expiration)).scalar_subquery()
+        ).returning(Medicament.quantite_stock, Medicament.seuil_minimum),
+        execution_options={'synchronize_session': False}
+    ).first()
+    ajuster_compteurs(difference_compteurs(compteurs_medicament(*avant), compteurs_medicament(*apres)))
+
+def reprendre_lots_medicaments():
+    # Stock existant avant la gestion par lots : un lot par médicament
+    sans_lot = ~db.exists().where(LotMedicament.medicament_id == Medicament.id)
+    db.session.execute(db.insert(LotMedicament).from_select(
+        ['medicament_id', 'numero_lot', 'quantite_initiale', 'quantite', 'date_expiration', 'fournisseur'],
+        db.select(Medicament.id, db.literal('INITIAL'), Medicament.quantite_stock, Medicament.quantite_stock,
+                  Medicament.date_expiration, Medicament.fournisseur).where(Medicament.quantite_stock > 0, sans_lot)
+    ))
+    db.session.commit()
+
+# Journal des mouvements de stock : chaque entrée ou sortie d'un lot est
+# ajoutée (jamais modifiée) dans mouvement_stock. Un instantané par médicament
+# est pris au début de chaque mois (commande instantanes-stock) avec les
+# sorties du mois écoulé : le stock à une date se lit dans le dernier
+# instantané plus au plus un mois de mouvements, et le rapport de
+# consommation mensuelle ne lit que les instantanés (plus le mois en cours)
+def enregistrer_mouvements(mouvements):
+    if mouvements:
+        db.session.execute(db.insert(MouvementStock), mouvements)
+
+def debut_mois(jour):
+    return jour.replace(day=1)
+
+def mois_suivant(jour):
+    return (jour.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+def dernier_instantane(jour=None):
+    query = db.session.query(db.func.max(InstantaneStock.date_instantane))
+    if jour is not None:
+        query = query.filter(InstantaneStock.date_instantane <= jour)
+    return query.scalar()
+
+def sommes_mouvements(debut, fin):
+    # {medicament_id: {type_mouvement: somme}} des mouvements de [debut, fin[
+    query = db.session.query(
+        MouvementStock.medicament_id, MouvementStock.type_mouvement, db.func.sum(MouvementStock.quantite)
+    ).filter(MouvementStock.date_mouvement < fin)
+    if debut is not None:
+        query = query.filter(MouvementStock.date_mouvement >= debut)
+    sommes = {}
+    for medicament_id, type_mouvement, quantite in query.group_by(MouvementStock.medicament_id,
+                                                                   MouvementStock.type_mouvement):
+        sommes.setdefault(medicament_id, {})[type_mouvement] = int(quantite)
+    return sommes
+
+def prendre_instantanes(jusqu_au=None):
+    limite = debut_mois(jusqu_au or date.today())
+    precedent = dernier_instantane()
+    if precedent is None:
+        premier = db.session.query(db.func.min(MouvementStock.date_mouvement)).scalar()
+        if premier is None:
+            return 0
+        coupure = mois_suivant(premier.date())
+        stocks = {}
+    else:
+        coupure = mois_suivant(precedent)
+        stocks = dict(db.session.query(InstantaneStock.medicament_id, InstantaneStock.quantite).filter(
+            InstantaneStock.date_instantane == precedent
+        ))
+    
+    total = 0
+    while coupure <= limite:
+        debut = datetime.combine(precedent, datetime.min.time()) if precedent else None
+        sommes = sommes_mouvements(debut, datetime.combine(coupure, datetime.min.time()))
+        lignes = []
+        for medicament_id in sorted(set(stocks) | set(sommes)):
+            par_type = sommes.get(medicament_id, {})
+            stocks[medicament_id] = stocks.get(medicament_id, 0) + sum(par_type.values())
+            if stocks[medicament_id] or par_type:
+                lignes.append({'medicament_id': medicament_id, 'date_instantane': coupure,
+                               'quantite': stocks[medicament_id],
+                               'consommation': -par_type.get('delivrance', 0),
+                               'pertes': -par_type.get('peremption', 0)})
+        if lignes:
+            db.session.execute(db.insert(InstantaneStock), lignes)
+        db.session.commit()
+        total += len(lignes)
+        precedent, coupure = coupure, mois_suivant(coupure)
+    return total
+
+def stock_a_date(instant):
+    # {medicament_id: quantité} à l'instant donné : dernier instantané
+    # antérieur + mouvements depuis (au plus un mois si les instantanés sont à jour)
+    coupure = dernier_instantane(instant.date())
+    stocks = {}
+    debut = None
+    if coupure is not None:
+        stocks = dict(db.session.query(InstantaneStock.medicament_id, InstantaneStock.quantite).filter(
+            InstantaneStock.date_instantane == coupure
+        ))
+        debut = datetime.combine(coupure, datetime.min.time())
+    for medicament_id, par_type in sommes_mouvements(debut, instant).items():
+        stocks[medicament_id] = stocks.get(medicament_id, 0) + sum(par_type.values())
+    return stocks
+
+def consommation_mensuelle(nombre_mois=12):
+    # {medicament_id: {premier jour du mois: (consommation, pertes)}}
+    mois_courant = debut_mois(date.today())
+    premier = mois_courant
+    for _ in range(nombre_mois - 1):
+        premier = debut_mois(premier - timedelta(days=1))
+    mois = [premier]
+    while mois[-1] < mois_courant:
+        mois.append(mois_suivant(mois[-1]))
+    
+    consommation = {}
+    for ligne in InstantaneStock.query.filter(
+        InstantaneStock.date_instantane > premier,
+        InstantaneStock.date_instantane <= mois_courant
+    ):
+        mois_ecoule = debut_mois(ligne.date_instantane - timedelta(days=1))
+        consommation.setdefault(ligne.medicament_id, {})[mois_ecoule] = (ligne.consommation, ligne.pertes)
+    # Mois pas encore couverts par un instantané (dont le mois en cours) lus
+    # dans le journal
+    couvert = dernier_instantane()
+    manquants = [m for m in mois if couvert is None or m >= couvert]
+    if manquants:
+        debut = datetime.combine(manquants[0], datetime.min.time())
+        query = db.session.query(
+            MouvementStock.medicament_id, MouvementStock.type_mouvement, MouvementStock.date_mouvement,
+            MouvementStock.quantite
+        ).filter(
+            MouvementStock.date_mouvement >= debut,
+            MouvementStock.type_mouvement.in_(['delivrance', 'peremption'])
+        )
+        for medicament_id, type_mouvement, date_mouvement, quantite in query.yield_per(1000):
+            m = debut_mois(date_mouvement.date())
+            if m not in manquants:
+                continue
+            sorties, pertes = consommation.setdefault(medicament_id, {}).get(m, (0, 0))
+            if type_mouvement == 'delivrance':
+                sorties -= quantite
+            else:
+                pertes -= quantite
+            consommation[medicament_id][m] = (sorties, pertes)
+    return mois, consommation
+
+def reprendre_mouvements_stock():
+    # Stock des lots antérieurs au journal : un mouvement d'ouverture par lot
+    sans_mouvement = ~db.exists().where(MouvementStock.lot_id == LotMedicament.id)
+    db.session.execute(db.insert(MouvementStock).from_select(
+        ['medicament_id', 'lot_id', 'type_mouvement', 'quantite', 'date_mouvement'],
+        db.select(LotMedicament.medicament_id, LotMedicament.id, db.literal('ajustement'), LotMedicament.quantite,
+                  db.literal(datetime.utcnow())).where(
+            LotMedicament.quantite > 0, sans_mouvement
+        )
+    ))
+    db.session.commit()
+
+# Délivrance des prescriptions : le passage en_attente -> delivre est un UPDATE
+# conditionnel qui rend la délivrance idempotente (double clic, deux
+# pharmaciens). Un médicament sans lot est décrémenté par un second UPDATE
+# conditionnel (quantite_stock >= quantité), sans lecture préalable ; sinon le
+# médicament est verrouillé, ses lots lus dans l'ordre FEFO et le stock
+# décrémenté. Si le stock ne suffit pas, tout est annulé
+def delivrer_sans_lot(prescription_id, medicament_id, quantite):
+    stock = db.session.execute(
+        db.update(Medicament).where(
+            Medicament.id == medicament_id,
+            Medicament.quantite_stock >= quantite
+        ).values(quantite_stock=Medicament.quantite_stock - quantite).returning(
+            Medicament.quantite_stock, Medicament.seuil_minimum
+        ),
+        execution_options={'synchronize_session': False}
+    ).first()
+    if stock is None:
+        return False
+    enregistrer_mouvements([{'medicament_id': medicament_id, 'lot_id': None, 'prescription_id': prescription_id,
+                             'type_mouvement': 'delivrance', 'quantite': -quantite}])
+    ajuster_compteurs(alerte_sortie_stock(stock.quantite_stock, stock.seuil_minimum, quantite))
+    return True
+
+def delivrer(prescription_id):
+    ligne = db.session.execute(
+        db.update(Prescription).where(
+            Prescription.id == prescription_id,
+            Prescription.statut == 'en_attente'
+        ).values(statut='delivre').returning(Prescription.medicament_id, Prescription.quantite),
+        execution_options={'synchronize_session': False}
+    ).first()
+    if ligne is None:
+        return 'deja_traitee'
+    
+    medicament_id, quantite = ligne
+    if not db.session.query(db.exists().where(LotMedicament.medicament_id == medicament_id)).scalar():
+        if not delivrer_sans_lot(prescription_id, medicament_id, quantite):
+            db.session.rollback()
+            return 'stock_insuffisant'
+        db.session.commit()
+        return 'delivre'
+    
+    jour = date.today()
+    verrouiller_medicaments([medicament_id])
+    lots = lots_disponibles([medicament_id])
+    if quantite_delivrable(lots[medicament_id], jour) < quantite:
+        db.session.rollback()
+        return 'stock_insuffisant'
+    sortir_stock([(prescription_id, medicament_id, quantite)], lots, jour)
+    db.session.commit()
+    return 'delivre'
+
+# Délivrance groupée (tournée de service) : les prescriptions en attente sont
+# d'abord verrouillées par id croissant puis réservées (même ordre de
+# verrouillage que delivrer : prescription puis médicament), les médicaments
+# concernés sont verrouillés par id croissant, le stock délivrable est réparti
+# par ordre d'id de prescription, puis les lots de chaque médicament sont
+# consommés en une fois. Une seule transaction. Sur PostgreSQL un UPDATE ...
+# WHERE id IN (...) verrouille dans l'ordre du parcours : deux tournées qui
+# se recouvrent pourraient s'interbloquer, d'où le SELECT ... ORDER BY id
+# FOR UPDATE préalable (les lignes sont verrouillées après le tri)
+def verrouiller_prescriptions(prescription_ids):
+    if not est_postgresql():
+        # SQLite : l'UPDATE de réservation prend le verrou d'écriture de la base
+        return sorted(prescription_ids)
+    return db.session.execute(
+        db.select(Prescription.id).where(
+            Prescription.id.in_(prescription_ids), Prescription.statut == 'en_attente'
+        ).order_by(Prescription.id).with_for_update()
+    ).scalars().all()
+
+def verrouiller_medicaments(medicament_ids):
+    medicament_ids = sorted(medicament_ids)
+    if est_postgresql():
+        lignes = db.session.execute(
+            db.select(Medicament.id, Medicament.quantite_stock).where(
+                Medicament.id.in_(medicament_ids)
+            ).order_by(Medicament.id).with_for_update()
+        )
+    else:
+        # Prend le verrou d'écriture SQLite avant la lecture des stocks
+        db.session.execute(db.update(Medicament).where(Medicament.id.in_(medicament_ids)).values(id=Medicament.id),
+                           execution_options={'synchronize_session': False})
+        lignes = db.session.execute(
+            db.select(Medicament.id, Medicament.quantite_stock).where(Medicament.id.in_(medicament_ids))
+        )
+    return {medicament_id: stock or 0 for medicament_id, stock in lignes}
+
+def delivrer_lot(prescription_ids):
+    resultats = {prescription_id: 'deja_traitee' for prescription_id in prescription_ids}
+    verrouillees = verrouiller_prescriptions(prescription_ids)
+    reservees = db.session.execute(
+        db.update(Prescription).where(
+            Prescription.id.in_(verrouillees),
+            Prescription.statut == 'en_attente'
+        ).values(statut='delivre').returning(Prescription.id, Prescription.medicament_id, Prescription.quantite),
+        execution_options={'synchronize_session': False}
+    ).all()
+    if not reservees:
+        db.session.rollback()
+        return resultats
+    
+    jour = date.today()
+    medicament_ids = sorted({ligne.medicament_id for ligne in reservees})
+    verrouiller_medicaments(medicament_ids)
+    lots = lots_disponibles(medicament_ids)
+    stocks = {medicament_id: quantite_delivrable(lots[medicament_id], jour) for medicament_id in medicament_ids}
+    sorties = []
+    refusees = []
+    for prescription_id, medicament_id, quantite in sorted(reservees):
+        if stocks[medicament_id] >= quantite:
+            stocks[medicament_id] -= quantite
+            sorties.append((prescription_id, medicament_id, quantite))
+            resultats[prescription_id] = 'delivre'
+        else:
+            refusees.append(prescription_id)
+            resultats[prescription_id] = 'stock_insuffisant'
+    
+    if refusees:
+        db.session.execute(
+            db.update(Prescription).where(Prescription.id.in_(refusees)).values(statut='en_attente'),
+            execution_options={'synchronize_session': False}
+        )
+    sortir_stock(sorties, lots, jour)
+    db.session.commit()
+    return resultats
+
+# Admission : la chambre est réservée par un UPDATE conditionnel (statut
+# libre -> occupee) qui échoue si une autre admission l'a prise entre-temps.
+# En attribution automatique, la chambre libre la moins chère du type demandé
+# est choisie avec FOR UPDATE SKIP LOCKED : les admissions simultanées
+# (afflux massif) prennent chacune une chambre différente sans s'attendre.
+# La ligne du patient est verrouillée d'abord pour empêcher deux admissions
+# en cours du même patient (vérification par l'index partiel des
+# hospitalisations actives)
+def verrouiller_patient(patient_id):
+    if est_postgresql():
+        db.session.execute(text('SELECT id FROM patient WHERE id = :id FOR UPDATE'), {'id': patient_id})
+    else:
+        # Prend le verrou d'écriture SQLite avant la lecture
+        db.session.execute(text('UPDATE patient SET id = id WHERE id = :id'), {'id': patient_id})
+
+def reserver_chambre(chambre_id=None, type_chambre=None):
+    if chambre_id is None:
+        candidate = db.select(Chambre.id).where(Chambre.statut == 'libre')
+        if type_chambre:
+            candidate = candidate.where(Chambre.type_chambre == type_chambre)
+        chambre_id = candidate.order_by(Chambre.prix_nuit, Chambre.numero).limit(1).with_for_update(
+            skip_locked=True
+        ).scalar_subquery()
+    return db.session.execute(
+        db.update(Chambre).where(Chambre.id == chambre_id, Chambre.statut == 'libre').values(
+            statut='occupee'
+        ).returning(Chambre.id),
+        execution_options={'synchronize_session': False}
+    ).scalar()
+
+def admettre(patient_id, motif_admission, notes=None, chambre_id=None, type_chambre=None):
+    verrouiller_patient(patient_id)
+    deja = db.session.query(Hospitalisation.id).filter(
+        Hospitalisation.patient_id == patient_id,
+        Hospitalisation.statut == 'hospitalise'
+    ).first()
+    if deja is not None:
+        db.session.rollback()
+        return 'deja_hospitalise', None
+    
+    chambre_reservee = reserver_chambre(chambre_id, type_chambre)
+    if chambre_reservee is None:
+        db.session.rollback()
+        return ('chambre_indisponible' if chambre_id else 'aucune_chambre'), None
+    
+    hospitalisation = Hospitalisation(patient_id=patient_id, chambre_id=chambre_reservee,
+                                      motif_admission=motif_admission, notes=notes)
+    db.session.add(hospitalisation)
+    ajuster_compteurs({'chambres_libres': -1, 'version_chambres': 1})
+    db.session.commit()
+    carte_chambres.appliquer([chambre_reservee])
+    return 'admis', hospitalisation
+
+def liberer(hospitalisation_id):
+    # Sortie idempotente : seule la première sortie libère la chambre
+    chambre_id = db.session.execute(
+        db.update(Hospitalisation).where(
+            Hospitalisation.id == hospitalisation_id,
+            Hospitalisation.statut == 'hospitalise'
+        ).values(statut='sorti', date_sortie=datetime.utcnow()).returning(Hospitalisation.chambre_id),
+        execution_options={'synchronize_session': False}
+    ).scalar()
+    if chambre_id is None:
+        db.session.rollback()
+        return False
+    liberee = db.session.execute(
+        db.update(Chambre).where(Chambre.id == chambre_id, Chambre.statut == 'occupee').values(
+            statut='libre'
+        ).returning(Chambre.id),
+        execution_options={'synchronize_session': False}
+    ).scalar()
+    ajuster_compteurs({'chambres_libres': 1 if liberee else 0, 'version_chambres': 1 if liberee else 0})
+    db.session.commit()
+    if liberee:
+        carte_chambres.appliquer([chambre_id])
+    return True
+
+# Carte de disponibilité des chambres partagée entre les workers gunicorn :
+# un fichier de /dev/shm projeté en mémoire (mmap) contient, pour chaque type
+# de chambre, un bitmap des chambres existantes et un bitmap des chambres
+# libres (bit n = chambre d'id n). Les lectures ne font aucune requête SQL.
+# Chaque transaction qui modifie une chambre incrémente le compteur
+# version_chambres, puis la carte est mise à jour après le commit (statut relu
+# en base sous verrou de fichier, l'ordre d'application importe donc peu).
+# L'en-tête garde la version de la base lors de la reconstruction et le
+# nombre de changements appliqués depuis : toutes les
+# CARTE_CHAMBRES_VALIDATION secondes, un écart avec version_chambres (mise à
+# jour perdue, base modifiée ailleurs) provoque une reconstruction. La carte
+# est aussi reconstruite au démarrage, pour une chambre au-delà de la capacité
+# ou un nouveau type. Les écrivains incrémentent une séquence (impaire pendant
+# l'écriture) que les lecteurs vérifient avant et après leur copie
+ENTETE_CARTE = struct.Struct('<4sIIdqqq')  # signature, capacité, nombre de types, démarrage, séquence, version de base, appliqués
+TAILLE_NOM_TYPE = 64
+MARGE_CARTE = 256  # chambres ajoutables sans reconstruction
+_DEMARRAGE = time.time()
+
+def version_chambres():
+    return int(db.session.query(Compteur.valeur).filter(Compteur.cle == 'version_chambres').scalar() or 0)
+
+def bits(octets):
+    valeur = int.from_bytes(octets, 'little')
+    while valeur:
+        bas = valeur & -valeur
+        yield bas.bit_length() - 1
+        valeur ^= bas
+
+class CarteChambres:
+    def __init__(self):
+        self.chemin = None
+        self.carte = None
+        self.inode = None
+        self.validation = 0.0
+        self.verrou_local = threading.RLock()
+        self.profondeur = 0
+    
+    def fichier(self):
+        if self.chemin is None:
+            dossier = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            empreinte = zlib.crc32(app.config['SQLALCHEMY_DATABASE_URI'].encode())
+            self.chemin = app.config['CARTE_CHAMBRES_FICHIER'] or os.path.join(dossier, f'flem_chambres_{empreinte:08x}.bin')
+        return self.chemin
+    
+    @contextmanager
+    def verrou(self):
+        # Verrou réentrant dans le processus, flock entre les workers
+        with self.verrou_local:
+            self.profondeur += 1
+            try:
+                if self.profondeur > 1 or fcntl is None:
+                    yield
+                else:
+                    with open(self.fichier() + '.lock', 'a') as fichier_verrou:
+                        fcntl.flock(fichier_verrou, fcntl.LOCK_EX)
+                        yield
+            finally:
+                self.profondeur -= 1
+    
+    def reconstruire(self):
+        with self.verrou():
+            version = version_chambres()
+            chambres = db.session.query(Chambre.id, Chambre.type_chambre, Chambre.statut).all()
+            types = sorted({type_chambre for _, type_chambre, _ in chambres})
+            rang = {type_chambre: k for k, type_chambre in enumerate(types)}
+            capacite = (max((chambre_id for chambre_id, _, _ in chambres), default=0) + MARGE_CARTE) // 64 * 64 + 64
+            existantes = [bytearray(capacite // 8) for _ in types]
+            libres = [bytearray(capacite // 8) for _ in types]
+            for chambre_id, type_chambre, statut in chambres:
+                existantes[rang[type_chambre]][chambre_id >> 3] |= 1 << (chambre_id & 7)
+                if statut == 'libre':
+                    libres[rang[type_chambre]][chambre_id >> 3] |= 1 << (chambre_id & 7)
+            contenu = b''.join([
+                ENTETE_CARTE.pack(b'CHB1', capacite, len(types), _DEMARRAGE, 0, version, 0),
+                *(nom.encode()[:TAILLE_NOM_TYPE].ljust(TAILLE_NOM_TYPE, b'\0') for nom in types),
+                *(bytes(existantes[k]) + bytes(libres[k]) for k in range(len(types)))
+            ])
+            temporaire = f'{self.fichier()}.{os.getpid()}'
+            with open(temporaire, 'wb') as fichier:
+                fichier.write(contenu)
+            self.fermer()
+            os.replace(temporaire, self.fichier())
+    
+    def fermer(self):
+        if self.carte is not None:
+            self.carte.close()
+        self.carte = None
+        self.inode = None
+    
+    def ouvrir(self):
+        # (Ré)ouvre la carte si elle n'existe pas encore, si le fichier a été
+        # remplacé par une reconstruction ou s'il date d'un démarrage précédent
+        try:
+            inode = os.stat(self.fichier()).st_ino
+        except FileNotFoundError:
+            inode = None
+        if self.carte is not None and inode == self.inode:
+            return
+        with self.verrou():
+            if inode is None or not os.path.exists(self.fichier()):
+                self.reconstruire()
+            self.fermer()
+            with open(self.fichier(), 'r+b') as fichier:
+                self.carte = mmap.mmap(fichier.fileno(), 0)
+                self.inode = os.fstat(fichier.fileno()).st_ino
+            if ENTETE_CARTE.unpack_from(self.carte)[3] != _DEMARRAGE:
+                self.reconstruire()
+                self.ouvrir()
+    
+    def valider(self):
+        maintenant = time.monotonic()
+        if maintenant < self.validation:
+            return
+        self.validation = maintenant + app.config['CARTE_CHAMBRES_VALIDATION']
+        _, _, _, _, _, base, appliques = ENTETE_CARTE.unpack_from(self.carte)
+        if base + appliques != version_chambres():
+            self.reconstruire()
+            self.ouvrir()
+    
+    def lire(self):
+        self.ouvrir()
+        self.valider()
+        for _ in range(10000):
+            sequence = ENTETE_CARTE.unpack_from(self.carte)[4]
+            if sequence % 2:
+                continue
+            contenu = self.carte[:]
+            if ENTETE_CARTE.unpack_from(self.carte)[4] == sequence:
+                break
+        else:
+            # Écrivain interrompu au milieu d'une mise à jour
+            self.reconstruire()
+            return self.lire()
+        _, capacite, nombre_types, _, _, _, _ = ENTETE_CARTE.unpack_from(contenu)
+        octets = capacite // 8
+        debut = ENTETE_CARTE.size + nombre_types * TAILLE_NOM_TYPE
+        types = {}
+        for k in range(nombre_types):
+            nom = contenu[ENTETE_CARTE.size + k * TAILLE_NOM_TYPE:ENTETE_CARTE.size + (k + 1) * TAILLE_NOM_TYPE]
+            position = debut + 2 * k * octets
+            types[nom.rstrip(b'\0').decode()] = (contenu[position:position + octets],
+                                                 contenu[position + octets:position + 2 * octets])
+        return types
+    
+    def disponibilite(self):
+        disponibilite = {}
+        for type_chambre, (existantes, libres) in self.lire().items():
+            total = int.from_bytes(existantes, 'little').bit_count()
+            if total:
+                # Un type sans chambre reste dans la carte jusqu'à la prochaine reconstruction
+                disponibilite[type_chambre] = {'libres': int.from_bytes(libres, 'little').bit_count(), 'total': total}
+        return disponibilite
+    
+    def chambres_libres(self, type_chambre=None):
+        return sorted(chambre_id for nom, (_, libres) in self.lire().items()
+                      if type_chambre is None or nom == type_chambre for chambre_id in bits(libres))
+    
+    def appliquer(self, chambre_ids):
+        # Après le commit d'une transaction ayant incrémenté version_chambres
+        with self.verrou():
+            self.ouvrir()
+            lignes = db.session.query(Chambre.id, Chambre.type_chambre, Chambre.statut).filter(
+                Chambre.id.in_(chambre_ids)
+            ).all()
+            entete = list(ENTETE_CARTE.unpack_from(self.carte))
+            capacite, nombre_types = entete[1], entete[2]
+            octets = capacite // 8
+            types = [self.carte[ENTETE_CARTE.size + k * TAILLE_NOM_TYPE:ENTETE_CARTE.size + (k + 1) * TAILLE_NOM_TYPE].rstrip(b'\0').decode()
+                     for k in range(nombre_types)]
+            if any(chambre_id >= capacite for chambre_id in chambre_ids) or any(t not in types for _, t, _ in lignes):
+                self.reconstruire()
+                return
+            
+            debut = ENTETE_CARTE.size + nombre_types * TAILLE_NOM_TYPE
+            entete[4] += 1
+            ENTETE_CARTE.pack_into(self.carte, 0, *entete)
+            for chambre_id in chambre_ids:
+                # Efface la chambre de tous les types (changement de type, suppression)
+                for k in range(nombre_types):
+                    for decalage in (0, octets):
+                        position = debut + 2 * k * octets + decalage + (chambre_id >> 3)
+                        self.carte[position] &= ~(1 << (chambre_id & 7)) & 0xFF
+            for chambre_id, type_chambre, statut in lignes:
+                position = debut + 2 * types.index(type_chambre) * octets + (chambre_id >> 3)
+                self.carte[position] |= 1 << (chambre_id & 7)
+                if statut == 'libre':
+                    self.carte[position + octets] |= 1 << (chambre_id & 7)
+            entete[4] += 1
+            entete[6] += 1
+            ENTETE_CARTE.pack_into(self.carte, 0, *entete)
+
+carte_chambres = CarteChambres()
+
+# Statistiques d'occupation des lits : les séjours d'une période sont
+# balayés avec NumPy (événements d'entrée et de sortie triés, nombre de
+# patients présents par cumul, intégrale interpolée aux bornes des jours)
+# pour obtenir les patients-jours de chaque journée. Les jours (UTC, comme
+# les dates des séjours) clos sont agrégés dans occupation_jour par la
+# commande agreger-occupation uniquement (rattrapage incrémental depuis le
+# dernier jour agrégé, seuls les séjours qui chevauchent la période sont
+# lus) ; les pages ne font que lire, les jours pas encore agrégés y sont
+# calculés à la volée sans être enregistrés. La
+# prévision combine la durée de séjour observée sur un an (fonction de
+# survie) avec les patients présents et le rythme récent des admissions
+HISTORIQUE_DUREE_SEJOUR = 365  # jours
+FENETRE_RYTHME_ADMISSIONS = 28  # jours
+HORIZON_PREVISION = 7  # jours
+
+def secondes_depuis(origine, instants):
+    return np.array([(instant - origine).total_seconds() for instant in instants], dtype=np.float64)
+
+def sejours_periode(debut, fin):
+    # Séjours qui chevauchent [debut, fin[, par type de chambre
+    colonnes = (Chambre.type_chambre, Hospitalisation.date_admission, Hospitalisation.date_sortie)
+    en_cours = db.session.query(*colonnes).join(Chambre, Hospitalisation.chambre_id == Chambre.id).filter(
+        Hospitalisation.date_sortie.is_(None), Hospitalisation.date_admission < fin
+    )
+    termines = db.session.query(*colonnes).join(Chambre, Hospitalisation.chambre_id == Chambre.id).filter(
+        Hospitalisation.date_sortie >= debut, Hospitalisation.date_admission < fin
+    )
+    sejours = {}
+    for type_chambre, admission, sortie in en_cours.union_all(termines):
+        sejours.setdefault(type_chambre, []).append((admission, sortie))
+    return sejours
+
+def occupation_par_jour(sejours, debut, nombre_jours, maintenant):
+    # patients-jours, admissions et sorties de chaque jour de [debut, debut + nombre_jours[
+    origine = datetime.combine(debut, datetime.min.time())
+    bornes = np.arange(nombre_jours + 1, dtype=np.float64) * 86400
+    entrees = secondes_depuis(origine, [admission for admission, _ in sejours])
+    sorties = secondes_depuis(origine, [sortie or maintenant for _, sortie in sejours])
+    sorties = np.maximum(sorties, entrees)
+    
+    instants = np.concatenate([entrees, sorties])
+    variations = np.concatenate([np.ones(len(entrees)), -np.ones(len(sorties))])
+    ordre = np.argsort(instants, kind='stable')
+    instants, variations = instants[ordre], variations[ordre]
+    presents = np.cumsum(variations)  # patients présents juste après chaque événement
+    integrale = np.concatenate([[0.0], np.cumsum(presents[:-1] * np.diff(instants))]) if len(instants) else np.zeros(0)
+    if len(instants):
+        cumul = np.interp(bornes, instants, integrale, left=0.0, right=integrale[-1])
+        # Après le dernier événement plus personne n'est présent ; avant le premier non plus
+        patients_jours = np.diff(cumul) / 86400
+    else:
+        patients_jours = np.zeros(nombre_jours)
+    
+    def compter(secondes, dates):
+        indices = np.floor(secondes[[d is not None for d in dates]] / 86400).astype(np.int64)
+        indices = indices[(indices >= 0) & (indices < nombre_jours)]
+        return np.bincount(indices, minlength=nombre_jours)
+    
+    admissions = compter(entrees, [admission for admission, _ in sejours])
+    sorties_jour = compter(sorties, [sortie for _, sortie in sejours])
+    return patients_jours, admissions, sorties_jour
+
+def capacite_chambres():
+    return {type_chambre: nombre['total'] for type_chambre, nombre in carte_chambres.disponibilite().items()}
+
+def aujourd_hui_utc():
+    # Les dates des séjours sont en UTC (datetime.utcnow) : les jours aussi
+    return datetime.utcnow().date()
+
+def occupation_calculee(debut, nombre_jours, maintenant, type_chambre=None):
+    # {type: [(jour, patients-jours, admissions, sorties, capacité)]} calculés
+    # à partir des séjours, pour les jours de [debut, debut + nombre_jours[
+    debut_periode = datetime.combine(debut, datetime.min.time())
+    fin_periode = min(debut_periode + timedelta(days=nombre_jours), maintenant)
+    capacites = capacite_chambres()
+    sejours = sejours_periode(debut_periode, fin_periode)
+    series = {}
+    for type_sejours in sorted(set(capacites) | set(sejours)):
+        if type_chambre and type_sejours != type_chambre:
+            continue
+        patients_jours, admissions, sorties = occupation_par_jour(sejours.get(type_sejours, []), debut,
+                                                                  nombre_jours, maintenant)
+        series[type_sejours] = [(debut + timedelta(days=k), float(patients_jours[k]), int(admissions[k]),
+                                 int(sorties[k]), capacites.get(type_sejours, 0)) for k in range(nombre_jours)]
+    return series
+
+def agreger_occupation(jusqu_au=None, depuis=None):
+    # Rattrape les jours clos (avant jusqu_au, par défaut aujourd'hui UTC) pas
+    # encore agrégés ; depuis : recalcule les agrégats à partir de ce jour
+    fin = jusqu_au or aujourd_hui_utc()
+    if depuis is not None:
+        db.session.execute(db.delete(OccupationJour).where(OccupationJour.jour >= depuis))
+    dernier = db.session.query(db.func.max(OccupationJour.jour)).scalar()
+    if dernier is not None:
+        debut = dernier + timedelta(days=1)
+    else:
+        premiere = db.session.query(db.func.min(Hospitalisation.date_admission)).scalar()
+        if premiere is None:
+            db.session.commit()
+            return 0
+        debut = premiere.date()
+    if debut >= fin:
+        db.session.commit()
+        return 0
+    
+    series = occupation_calculee(debut, (fin - debut).days, datetime.utcnow())
+    lignes = [{
+        'jour': jour, 'type_chambre': type_chambre, 'lits_occupes': lits, 'admissions': admissions,
+        'sorties': sorties, 'capacite': capacite
+    } for type_chambre, jours in series.items() for jour, lits, admissions, sorties, capacite in jours]
+    try:
+        for k in range(0, len(lignes), 5000):
+            db.session.execute(db.insert(OccupationJour), lignes[k:k + 5000])
+        db.session.commit()
+    except IntegrityError:
+        # Un autre passage a agrégé ces jours en même temps
+        db.session.rollback()
+        return 0
+    return len(lignes)
+
+def serie_occupation(debut, fin, type_chambre=None):
+    # {type: [(jour, lits occupés, admissions, sorties, capacité)]} pour [debut, fin[ ;
+    # lecture seule : les jours agrégés (commande agreger-occupation) viennent
+    # de occupation_jour, les jours clos pas encore agrégés et aujourd'hui sont
+    # calculés à la volée sans être enregistrés
+    query = db.session.query(
+        OccupationJour.type_chambre, OccupationJour.jour, OccupationJour.lits_occupes,
+        OccupationJour.admissions, OccupationJour.sorties, OccupationJour.capacite
+    ).filter(OccupationJour.jour >= debut, OccupationJour.jour < fin)
+    if type_chambre:
+        query = query.filter(OccupationJour.type_chambre == type_chambre)
+    series = {}
+    for type_ligne, *valeurs in query.order_by(OccupationJour.type_chambre, OccupationJour.jour):
+        series.setdefault(type_ligne, []).append(tuple(valeurs))
+    
+    maintenant = datetime.utcnow()
+    aujourd_hui = maintenant.date()
+    dernier = db.session.query(db.func.max(OccupationJour.jour)).scalar()
+    manquants_debut = max(debut, dernier + timedelta(days=1)) if dernier is not None else debut
+    manquants_fin = min(fin, aujourd_hui + timedelta(days=1))
+    if manquants_debut < manquants_fin:
+        calculees = occupation_calculee(manquants_debut, (manquants_fin - manquants_debut).days,
+                                        maintenant, type_chambre)
+        debut_jour = datetime.combine(aujourd_hui, datetime.min.time())
+        # Journée en cours : moyenne depuis minuit
+        ecoule = max((maintenant - debut_jour).total_seconds() / 86400, 1e-9)
+        for type_sejours, jours in calculees.items():
+            series.setdefault(type_sejours, []).extend(
+                (jour, lits / ecoule if jour == aujourd_hui else lits, admissions, sorties, capacite)
+                for jour, lits, admissions, sorties, capacite in jours
+            )
+    return series
+
+def resume_occupation(series):
+    resume = {}
+    for type_chambre, jours in series.items():
+        lits = np.array([j[1] for j in jours])
+        capacite = np.array([j[4] for j in jours], dtype=np.float64)
+        resume[type_chambre] = {
+            'lits_occupes_moyen': float(lits.mean()) if len(lits) else 0.0,
+            'lits_occupes_max': float(lits.max()) if len(lits) else 0.0,
+            'taux_occupation': float(lits.sum() / capacite.sum()) if capacite.sum() else None,
+            'admissions': int(sum(j[2] for j in jours))
+        }
+    return resume
+
+def prevision_lits(horizon=HORIZON_PREVISION):
+    # Lits occupés attendus chaque jour des `horizon` prochains jours, par type :
+    # patients présents (probabilité d'être encore là sachant la durée déjà
+    # passée) + admissions attendues (rythme moyen récent) encore présentes
+    maintenant = datetime.utcnow()
+    aujourd_hui = maintenant.date()
+    debut_historique = maintenant - timedelta(days=HISTORIQUE_DUREE_SEJOUR)
+    durees = {}
+    for type_chambre, admission, sortie in db.session.query(
+        Chambre.type_chambre, Hospitalisation.date_admission, Hospitalisation.date_sortie
+    ).join(Chambre, Hospitalisation.chambre_id == Chambre.id).filter(Hospitalisation.date_sortie >= debut_historique):
+        durees.setdefault(type_chambre, []).append((sortie - admission).total_seconds() / 86400)
+    
+    presents = {}
+    for type_chambre, admission in db.session.query(Chambre.type_chambre, Hospitalisation.date_admission).join(
+        Chambre, Hospitalisation.chambre_id == Chambre.id
+    ).filter(Hospitalisation.date_sortie.is_(None)):
+        presents.setdefault(type_chambre, []).append((maintenant - admission).total_seconds() / 86400)
+    
+    rythme = {type_chambre: sum(jour[2] for jour in jours) for type_chambre, jours in serie_occupation(
+        aujourd_hui - timedelta(days=FENETRE_RYTHME_ADMISSIONS), aujourd_hui
+    ).items()}
+    
+    capacites = capacite_chambres()
+    jours = np.arange(1, horizon + 1, dtype=np.float64)
+    prevision = {}
+    for type_chambre in sorted(set(capacites) | set(presents) | set(durees)):
+        observees = np.sort(np.array(durees.get(type_chambre, []), dtype=np.float64))
+        
+        def survie(t):
+            # P(durée de séjour > t), estimée sur les séjours terminés
+            if not len(observees):
+                return np.ones_like(t)
+            return 1.0 - np.searchsorted(observees, t, side='right') / len(observees)
+        
+        ecoules = np.array(presents.get(type_chambre, []), dtype=np.float64)
+        if len(ecoules):
+            base = survie(ecoules)[:, None]
+            # Séjour déjà plus long que tous ceux observés : le patient est supposé rester
+            restants = np.divide(survie(ecoules[:, None] + jours[None, :]), base,
+                                 out=np.ones((len(ecoules), horizon)), where=base > 0).sum(axis=0)
+        else:
+            restants = np.zeros(horizon)
+        # Arrivées attendues chaque jour, encore présentes au jour j
+        par_jour = float(rythme.get(type_chambre) or 0) / FENETRE_RYTHME_ADMISSIONS
+        arrivees = par_jour * np.array([survie(jours[k] - jours[:k + 1] + 0.5).sum() for k in range(horizon)])
+        attendus = restants + arrivees
+        capacite = capacites.get(type_chambre, 0)
+        prevision[type_chambre] = [{
+            'jour': (aujourd_hui + timedelta(days=k + 1)).isoformat(),
+            'lits_occupes': round(float(attendus[k]), 1),
+            'lits_libres': round(capacite - float(attendus[k]), 1),
+            'capacite': capacite
+        } for k in range(horizon)]
+    return prevision
+
+# Numérotation des factures (FLEM-AAAAMMJJ-NNNN) : une ligne compteur par
+# jour, incrémentée par un upsert ... RETURNING dans sa propre transaction
+# courte. Deux workers ne peuvent pas obtenir le même numéro, le verrou sur
+# la ligne n'est pas gardé pendant la création de la facture ; une facture
+# abandonnée laisse un trou dans la numérotation
+def allouer_numeros_facture(nombre=1, jour=None):
+    jour = jour or datetime.now().date()
+    instruction = insert_dialecte()(SequenceFacture.__table__).values(jour=jour, dernier=nombre)
+    instruction = instruction.on_conflict_do_update(
+        index_elements=['jour'], set_={'dernier': SequenceFacture.__table__.c.dernier + instruction.excluded.dernier}
+    ).returning(SequenceFacture.__table__.c.dernier)
+    with db.engine.begin() as connexion:
+        dernier = connexion.execute(instruction).scalar_one()
+    return [f"FLEM-{jour.strftime('%Y%m%d')}-{numero:04d}" for numero in range(dernier - nombre + 1, dernier + 1)]
+
+def reprendre_numeros_facture():
+    # Factures du jour numérotées avant le compteur : il reprend après la plus grande
+    jour = datetime.now().date()
+    if db.session.get(SequenceFacture, jour) is not None:
+        return
+    prefixe = f"FLEM-{jour.strftime('%Y%m%d')}-"
+    numeros = [numero for (numero,) in db.session.query(Facture.numero_facture).filter(
+        Facture.numero_facture.like(prefixe + '%'))]
+    suffixes = [int(numero[len(prefixe):]) for numero in numeros if numero[len(prefixe):].isdigit()]
+    if suffixes:
+        db.session.add(SequenceFacture(jour=jour, dernier=max(suffixes)))
+        db.session.commit()
+
+# Facturation automatique des séjours : chaque nuit, les séjours pas encore
+# entièrement facturés (index partiel) sont parcourus par lots ; les nuits
+# depuis facture_jusqu_au (ou l'admission) sont facturées au prix de la
+# chambre. Factures et lignes sont insérées en un INSERT par lot. L'index
+# unique (séjour, début de période) rend le traitement idempotent : une
+# période déjà facturée, même par un autre passage concurrent, est ignorée
+# par ON CONFLICT DO NOTHING et le séjour n'avance que pour les factures
+# effectivement créées
+def periode_a_facturer(admission, sortie, facture_jusqu_au, jour):
+    # Nuits [debut, fin[ à facturer au jour `jour` (exclu) et fin de séjour atteinte
+    debut = facture_jusqu_au or admission.date()
+    if sortie is None or sortie.date() > jour:
+        return debut, max(debut, jour), False
+    fin = max(debut, sortie.date())
+    if facture_jusqu_au is None and fin == debut:
+        # Sortie le jour même de l'admission : une nuit facturée
+        fin = debut + timedelta(days=1)
+    return debut, fin, True
+
+def marquer_sejour_facture(hospitalisation_id, patient_id, jour=None):
+    # Facture de séjour saisie à la main : les nuits jusqu'à aujourd'hui (ou
+    # jusqu'à la sortie) sont considérées comme facturées
+    sejour = Hospitalisation.query.filter_by(id=hospitalisation_id, patient_id=patient_id).with_for_update().first()
+    if sejour is None:
+        return False
+    _, fin, termine = periode_a_facturer(sejour.date_admission, sejour.date_sortie, sejour.facture_jusqu_au,
+                                         jour or date.today())
+    sejour.facture_jusqu_au = fin
+    sejour.facturation_terminee = termine
+    return True
+
+def facturer_sejours(jusqu_au=None, taille_lot=None, nuits_minimum=None):
+    jour = jusqu_au or date.today()
+    taille_lot = taille_lot or app.config['FACTURATION_TAILLE_LOT']
+    nuits_minimum = app.config['FACTURATION_SEJOUR_NUITS'] if nuits_minimum is None else nuits_minimum
+    maintenant = datetime.utcnow()
+    resultat = {'sejours': 0, 'factures': 0, 'montant': 0.0}
+    query = db.session.query(
+        Hospitalisation.id, Hospitalisation.patient_id, Hospitalisation.date_admission,
+        Hospitalisation.date_sortie, Hospitalisation.facture_jusqu_au, Chambre.numero, Chambre.prix_nuit
+    ).join(Chambre, Hospitalisation.chambre_id == Chambre.id).filter(Hospitalisation.facturation_terminee.is_(False))
+    
+    for lot in parcourir_par_lots(query, Hospitalisation.id, taille_lot):
+        resultat['sejours'] += len(lot)
+        factures, lignes, avancements = [], {}, {}
+        for sejour in lot:
+            debut, fin, termine = periode_a_facturer(sejour.date_admission, sejour.date_sortie,
+                                                     sejour.facture_jusqu_au, jour)
+            nuits = (fin - debut).days
+            if nuits <= 0:
+                if termine:
+                    avancements[sejour.id] = {'id': sejour.id, 'facturation_terminee': True}
+                continue
+            if not termine and nuits < nuits_minimum:
+                continue
+            montant = nuits * sejour.prix_nuit
+            factures.append({
+                'patient_id': sejour.patient_id, 'hospitalisation_id': sejour.id,
+                'date_facture': maintenant, 'montant_total': montant, 'montant_paye': 0.0,
+                'statut': 'en_attente', 'type_facture': 'hospitalisation',
+                'notes': 'Facturation automatique du séjour', 'periode_debut': debut, 'periode_fin': fin
+            })
+            lignes[sejour.id] = {
+                'description': f"Chambre {sejour.numero} - {nuits} nuit{'s' if nuits > 1 else ''} "
+                               f"du {debut.strftime('%d/%m/%Y')} au {fin.strftime('%d/%m/%Y')}",
+                'quantite': nuits, 'prix_unitaire': sejour.prix_nuit, 'montant': montant, 'type_service': 'chambre'
+            }
+            avancements[sejour.id] = {'id': sejour.id, 'facture_jusqu_au': fin, 'facturation_terminee': termine}
+        
+        creees = []
+        if factures:
+            for facture, numero in zip(factures, allouer_numeros_facture(len(factures))):
+                facture['numero_facture'] = numero
+            instruction = insert_dialecte()(Facture.__table__).on_conflict_do_nothing().returning(
+                Facture.id, Facture.hospitalisation_id, Facture.montant_total
+            )
+            creees = db.session.execute(instruction, factures).all()
+            if creees:
+                db.session.execute(db.insert(DetailFacture), [
+                    dict(lignes[facture.hospitalisation_id], facture_id=facture.id) for facture in creees
+                ])
+        # Période déjà facturée par un autre passage : le séjour n'est pas modifié
+        facturees = {facture.hospitalisation_id for facture in creees}
+        mises_a_jour = [valeurs for sejour_id, valeurs in avancements.items()
+                        if sejour_id in facturees or sejour_id not in lignes]
+        if mises_a_jour:
+            db.session.execute(db.update(Hospitalisation), mises_a_jour)
+        montant = sum(facture.montant_total for facture in creees)
+        ajuster_compteurs({'factures:en_attente': len(creees), 'montant_impaye': montant})
+        db.session.commit()
+        resultat['factures'] += len(creees)
+        resultat['montant'] += montant
+    if resultat['factures']:
+        invalider_stats_tableau_de_bord()
+    return resultat
+
+# Arithmétique de dates en SQL selon le dialecte. Sur SQLite le résultat est
+# écrit au format de stockage de SQLAlchemy pour que les comparaisons de
+# chaînes restent justes
+def sql_ajouter_minutes(expression, minutes):
+    if est_postgresql():
+        return f"({expression}) + ({minutes}) * interval '1 minute'"
+    return f"strftime('%Y-%m-%d %H:%M:%S.000000', {expression}, '+' || ({minutes}) || ' minutes')"
+
+def sql_debut_jour(expression):
+    if est_postgresql():
+        return f"date_trunc('day', {expression})"
+    return f"date({expression})"
+
+# Séries de rendez-vous récurrents (dialyse, kinésithérapie...) : la règle
+# est développée en occurrences, vérifiée d'un bloc contre l'agenda du
+# médecin (balayage des deux listes triées) puis insérée en un seul INSERT.
+# Les modifications et annulations de série sont des UPDATE uniques
+SERIE_OCCURRENCES_MAX = 400
+
+class SerieTropLongue(Exception):
+    pass
+
+def occurrences_serie(serie):
+    # Au-delà de SERIE_OCCURRENCES_MAX la série est refusée plutôt que tronquée :
+    # date_fin doit correspondre aux rendez-vous réellement créés
+    jours = {int(j) for j in serie.jours_semaine.split(',') if j != ''}
+    lundi_debut = serie.date_debut - timedelta(days=serie.date_debut.weekday())
+    occurrences = []
+    jour = serie.date_debut
+    while jour <= serie.date_fin:
+        semaine = (jour - lundi_debut).days // 7
+        if jour.weekday() in jours and semaine % (serie.intervalle or 1) == 0:
+            if len(occurrences) >= SERIE_OCCURRENCES_MAX:
+                raise SerieTropLongue(f'Plus de {SERIE_OCCURRENCES_MAX} occurrences')
+            occurrences.append(datetime.combine(jour, serie.heure))
+        jour += timedelta(days=1)
+    return occurrences
+
+def conflits_intervalles(intervalles, occupations):
+    # Les deux listes sont triées par début : balayage en un seul passage
+    conflits = []
+    i = 0
+    for debut, fin in intervalles:
+        while i < len(occupations) and occupations[i][1] <= debut:
+            i += 1
+        j = i
+        while j < len(occupations) and occupations[j][0] < fin:
+            if occupations[j][1] > debut:
+                conflits.append((debut, fin))
+                break
+            j += 1
+    return conflits
+
+def occupations_hors_serie(personnel_id, debut, fin, serie_id=None):
+    query = db.session.query(RendezVous.date_rdv, RendezVous.date_fin).filter(
+        RendezVous.personnel_id == personnel_id,
+        RendezVous.date_rdv > debut - timedelta(minutes=DUREE_RDV_MAX),
+        RendezVous.date_rdv < fin,
+        RendezVous.date_fin > debut,
+        RendezVous.statut != 'annule'
+    )
+    if serie_id:
+        query = query.filter(db.or_(RendezVous.serie_id.is_(None), RendezVous.serie_id != serie_id))
+    return query.order_by(RendezVous.date_rdv).all()
+
+def verifier_intervalles(personnel_id, intervalles, serie_id=None):
+    if not intervalles:
+        return []
+    with db.session.no_autoflush:
+        verrouiller_agenda(personnel_id)
+        occupations = occupations_hors_serie(personnel_id, intervalles[0][0], intervalles[-1][1], serie_id)
+    return conflits_intervalles(intervalles, occupations)
+
+def creer_serie_rendez_vous(serie, ignorer_conflits=False):
+    duree = timedelta(minutes=serie.duree)
+    intervalles = [(debut, debut + duree) for debut in occurrences_serie(serie)]
+    conflits = verifier_intervalles(serie.personnel_id, intervalles)
+    if conflits and not ignorer_conflits:
+        return [], conflits
+    a_exclure = set(conflits)
+    intervalles = [intervalle for intervalle in intervalles if intervalle not in a_exclure]
+    
+    db.session.add(serie)
+    db.session.flush()
+    if intervalles:
+        db.session.execute(db.insert(RendezVous), [{
+            'patient_id': serie.patient_id,
+            'personnel_id': serie.personnel_id,
+            'date_rdv': debut,
+            'duree': serie.duree,
+            'date_fin': fin,
+            'type_consultation': serie.type_consultation,
+            'statut': 'programme',
+            'notes': serie.notes,
+            'serie_id': serie.id,
+            'date_creation': datetime.utcnow()
+        } for debut, fin in intervalles])
+        deltas = {}
+        for debut, _ in intervalles:
+            cle = cle_rdv_jour(debut.date())
+            deltas[cle] = deltas.get(cle, 0) + 1
+        ajuster_compteurs(deltas)
+    return intervalles, conflits
+
+def filtre_serie_a_venir(serie, a_partir_du):
+    return db.and_(
+        RendezVous.serie_id == serie.id,
+        RendezVous.date_rdv >= datetime.combine(a_partir_du, datetime.min.time()),
+        RendezVous.statut != 'annule'
+    )
+
+def replanifier_serie(serie, a_partir_du, heure, duree, personnel_id):
+    # Les occurrences restent le même jour : seuls l'heure, la durée et le
+    # médecin changent, les compteurs par jour ne bougent donc pas
+    condition = filtre_serie_a_venir(serie, a_partir_du)
+    intervalles = [
+        (datetime.combine(date_rdv.date(), heure), datetime.combine(date_rdv.date(), heure) + timedelta(minutes=duree))
+        for (date_rdv,) in db.session.query(RendezVous.date_rdv).filter(condition).order_by(RendezVous.date_rdv)
+    ]
+    conflits = verifier_intervalles(personnel_id, intervalles, serie.id)
+    if conflits:
+        return 0, conflits
+    minutes = heure.hour * 60 + heure.minute
+    resultat = db.session.execute(
+        db.update(RendezVous).where(condition).values(
+            date_rdv=db.literal_column(sql_ajouter_minutes(sql_debut_jour('date_rdv'), int(minutes))),
+            date_fin=db.literal_column(sql_ajouter_minutes(sql_debut_jour('date_rdv'), int(minutes + duree))),
+            duree=duree,
+            personnel_id=personnel_id
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    serie.heure = heure
+    serie.duree = duree
+    serie.personnel_id = personnel_id
+    return resultat.rowcount, []
+
+def annuler_serie(serie, a_partir_du):
+    resultat = db.session.execute(
+        db.update(RendezVous).where(filtre_serie_a_venir(serie, a_partir_du)).values(statut='annule'),
+        execution_options={'synchronize_session': False}
+    )
+    return resultat.rowcount
+
+# Migration du schéma : crée les tables manquantes puis les index déclarés sur
+# les modèles qui n'existent pas encore en base. Sur PostgreSQL les index sont
+# construits avec CREATE INDEX CONCURRENTLY (hors transaction) pour ne pas
+# bloquer les écritures sur une base en service
+def colonnes_manquantes():
+    inspecteur = db.inspect(db.engine)
+    tables = set(inspecteur.get_table_names())
+    manquantes = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existantes = {colonne['name'] for colonne in inspecteur.get_columns(table.name)}
+        manquantes.extend(colonne for colonne in table.columns if colonne.name not in existantes)
+    return manquantes
+
+def migrer_colonnes(afficher=logger.info):
+    # Les colonnes ajoutées sur une table existante sont toujours nullables ;
+    # les valeurs des lignes existantes viennent du server_default ou d'une
+    # reprise de données (voir REPRISES_COLONNES)
+    ajoutees = []
+    for colonne in colonnes_manquantes():
+        type_sql = colonne.type.compile(dialect=db.engine.dialect)
+        defaut = f" DEFAULT {colonne.server_default.arg}" if colonne.server_default is not None else ''
+        afficher(f"Ajout de la colonne {colonne.table.name}.{colonne.name}")
+        db.session.execute(text(f'ALTER TABLE {colonne.table.name} ADD COLUMN {colonne.name} {type_sql}{defaut}'))
+        ajoutees.append((colonne.table.name, colonne.name))
+    db.session.commit()
+    for cle in ajoutees:
+        if cle in REPRISES_COLONNES:
+            REPRISES_COLONNES[cle]()
+            db.session.commit()
+    return ajoutees
+
+def reprendre_fin_rendez_vous():
+    db.session.execute(text(f"UPDATE rendez_vous SET date_fin = {sql_ajouter_minutes('date_rdv', 'duree')} WHERE date_fin IS NULL"))
+
+def reprendre_facturation_sejours():
+    # Bascule vers la facturation automatique : les séjours terminés avant la
+    # migration ont été facturés à la main (lien hospitalisation_id facultatif),
+    # ils ne sont jamais refacturés. Les séjours en cours sont facturés à partir
+    # du jour de leur dernière facture d'hospitalisation, liée au séjour ou
+    # émise sans lien pour le patient depuis l'admission
+    db.session.execute(db.update(Hospitalisation).where(Hospitalisation.date_sortie.isnot(None)).values(
+        facturation_terminee=True
+    ), execution_options={'synchronize_session': False})
+    derniere = db.select(db.func.max(Facture.date_facture)).where(
+        Facture.type_facture == 'hospitalisation',
+        db.or_(Facture.hospitalisation_id == Hospitalisation.id, db.and_(
+            Facture.hospitalisation_id.is_(None), Facture.patient_id == Hospitalisation.patient_id,
+            Facture.date_facture >= Hospitalisation.date_admission
+        ))
+    ).scalar_subquery()
+    db.session.execute(db.update(Hospitalisation).where(Hospitalisation.date_sortie.is_(None)).values(
+        facture_jusqu_au=db.func.date(derniere)
+    ), execution_options={'synchronize_session': False})
+
+def reprendre_horaires_configures():
+    db.session.execute(db.update(Personnel).where(
+        Personnel.id.in_(db.select(HoraireTravail.personnel_id))
+    ).values(horaires_configures=True), execution_options={'synchronize_session': False})
+
+REPRISES_COLONNES = {
+    ('rendez_vous', 'date_fin'): reprendre_fin_rendez_vous,
+    ('hospitalisation', 'facturation_terminee'): reprendre_facturation_sejours,
+    ('personnel', 'horaires_configures'): reprendre_horaires_configures,
+}
+
+def index_manquants():
+    inspecteur = db.inspect(db.engine)
+    tables = set(inspecteur.get_table_names())
+    manquants = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existants = {index['name'] for index in inspecteur.get_indexes(table.name)}
+        manquants.extend(index for index in table.indexes if index.name not in existants)
+    return manquants
+
+def index_invalides(connexion):
+    # Restes d'un CREATE INDEX CONCURRENTLY interrompu
+    return [ligne[0] for ligne in connexion.execute(text(
+        'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+        'JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'WHERE NOT i.indisvalid AND n.nspname = current_schema()'
+    ))]
+
+def migrer_index(afficher=logger.info):
+    from sqlalchemy.schema import CreateIndex
+    
+    if not est_postgresql():
+        for index in index_manquants():
+            afficher(f"Création de l'index {index.name}")
+            index.create(db.engine, checkfirst=True)
+        return
+    
+    declares = {index.name for table in db.metadata.sorted_tables for index in table.indexes}
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connexion:
+        for nom in index_invalides(connexion):
+            if nom in declares:
+                afficher(f"Suppression de l'index invalide {nom}")
+                connexion.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{nom}"'))
+        for index in index_manquants():
+            afficher(f"Création de l'index {index.name} (CONCURRENTLY)")
+            options = index.dialect_options['postgresql']
+            options['concurrently'] = True
+            try:
+                connexion.execute(CreateIndex(index, if_not_exists=True))
+            finally:
+                options['concurrently'] = False
+
+def migrer_base(afficher=logger.info):
+    db.create_all()
+    migrer_colonnes(afficher)
+    migrer_index(afficher)
+    installer_contrainte_chevauchement()
+    initialiser_recherche()
+    completer_index_recherche(afficher)
+    reprendre_lots_medicaments()
+    reprendre_mouvements_stock()
+    reprendre_numeros_facture()
+    # Initialise les compteurs ajoutés depuis la dernière migration
+    reconcilier_compteurs()
+
+# Import en masse des patients (CSV ou NDJSON) : le fichier est lu en flux,
+# chaque ligne est validée puis insérée par lots avec ON CONFLICT DO NOTHING,
+# les doublons sur email / NSS sont signalés sans interrompre le lot
+CHAMPS_IMPORT_PATIENT = ['nom', 'prenom', 'date_naissance', 'telephone', 'email', 'adresse', 'numero_securite_sociale']
+LONGUEURS_IMPORT_PATIENT = {'nom': 100, 'prenom': 100, 'telephone': 20, 'email': 120, 'numero_securite_sociale': 20}
+
+def lire_fichier_import(flux, format_fichier):
+    texte = io.TextIOWrapper(flux, encoding='utf-8-sig', newline='')
+    if format_fichier == 'ndjson':
+        for numero, ligne in enumerate(texte, start=1):
+            if not ligne.strip():
+                continue
+            try:
+                yield numero, json.loads(ligne)
+            except ValueError:
+                yield numero, None
+    else:
+        entete = texte.readline()
+        separateur = ';' if entete.count(';') > entete.count(',') else ','
+        colonnes = [c.strip().lower() for c in next(csv.reader([entete], delimiter=separateur), [])]
+        lecteur = csv.DictReader(texte, fieldnames=colonnes, delimiter=separateur)
+        for donnees in lecteur:
+            yield lecteur.line_num + 1, donnees
+
+def valider_patient_import(donnees):
+    if not isinstance(donnees, dict):
+        return None, 'Ligne illisible'
+    valeurs = {champ: str(donnees.get(champ) or '').strip() for champ in CHAMPS_IMPORT_PATIENT}
+    
+    manquants = [champ for champ in ('nom', 'prenom', 'date_naissance', 'telephone') if not valeurs[champ]]
+    if manquants:
+        return None, 'Champs obligatoires manquants : ' + ', '.join(manquants)
+    for champ, longueur in LONGUEURS_IMPORT_PATIENT.items():
+        if len(valeurs[champ]) > longueur:
+            return None, f'{champ} dépasse {longueur} caractères'
+    
+    for format_date in ('%Y-%m-%d', '%d/%m/%Y'):
+        try:
+            valeurs['date_naissance'] = datetime.strptime(valeurs['date_naissance'], format_date).date()
+            break
+        except ValueError:
+            continue
+    else:
+        return None, f"Date de naissance invalide : {valeurs['date_naissance']}"
+    
+    for champ in ('email', 'adresse', 'numero_securite_sociale'):
+        valeurs[champ] = valeurs[champ] or None
+    return valeurs, None
 
-class Prescription(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
-    medecin_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    medicament_id = db.Column(db.Integer, db.ForeignKey('medicament.id'), nullable=False)
-    quantite = db.Column(db.Integer, nullable=False)
-    posologie = db.Column(db.Text, nullable=False)  # Comment prendre le médicament
-    date_prescription = db.Column(db.DateTime, default=datetime.utcnow)
-    statut = db.Column(db.String(20), default='en_attente')  # en_attente, delivre, annule
-    notes = db.Column(db.Text)
+def inserer_lot_patients(lot, signaler_erreur):
+    # Doublons à l'intérieur du lot
+    emails, numeros, uniques = set(), set(), []
+    for numero, valeurs in lot:
+        if valeurs['email'] and valeurs['email'] in emails:
+            signaler_erreur(numero, f"Email en double dans le fichier : {valeurs['email']}")
+        elif valeurs['numero_securite_sociale'] and valeurs['numero_securite_sociale'] in numeros:
+            signaler_erreur(numero, f"N° de sécurité sociale en double dans le fichier : {valeurs['numero_securite_sociale']}")
+        else:
+            emails.add(valeurs['email'])
+            numeros.add(valeurs['numero_securite_sociale'])
+            uniques.append((numero, valeurs))
+    if not uniques:
+        return 0
+    
+    # Doublons avec la base : les lignes en conflit sont ignorées par la base
+    # et n'apparaissent pas dans le RETURNING
+    instruction = insert_dialecte()(Patient.__table__).on_conflict_do_nothing().returning(
+        Patient.id, Patient.nom, Patient.prenom, Patient.date_naissance, Patient.telephone,
+        Patient.email, Patient.numero_securite_sociale
+    )
+    inseres = db.session.execute(instruction, [valeurs for _, valeurs in uniques]).all()
+    
+    cles = {(p.email, p.numero_securite_sociale) for p in inseres}
+    rejetes = [(n, v) for n, v in uniques if (v['email'], v['numero_securite_sociale']) not in cles]
+    if rejetes:
+        emails_pris = {e for (e,) in db.session.query(Patient.email).filter(
+            Patient.email.in_([v['email'] for _, v in rejetes if v['email']]))}
+        for numero, valeurs in rejetes:
+            if valeurs['email'] in emails_pris:
+                signaler_erreur(numero, f"Email déjà enregistré : {valeurs['email']}")
+            else:
+                signaler_erreur(numero, f"N° de sécurité sociale déjà enregistré : {valeurs['numero_securite_sociale']}")
+    
+    indexer_patients(inseres)
+    indexer_cles_doublons(inseres)
+    ajuster_compteurs({'patients': len(inseres)})
+    db.session.commit()
+    return len(inseres)
 
-class Hospitalisation(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
-    chambre_id = db.Column(db.Integer, db.ForeignKey('chambre.id'), nullable=False)
-    date_admission = db.Column(db.DateTime, default=datetime.utcnow)
-    date_sortie = db.Column(db.DateTime)
-    motif_admission = db.Column(db.Text)
-    statut = db.Column(db.String(20), default='hospitalise')  # hospitalise, sorti, transfere
-    notes = db.Column(db.Text)
+def importer_patients(lignes, taille_lot, signaler_erreur):
+    resultat = {'lues': 0, 'inserees': 0, 'erreurs': 0}
     
-    # Relations
-    patient = db.relationship('Patient', backref='hospitalisations')
-    chambre = db.relationship('Chambre', backref='hospitalisations')
-    factures = db.relationship('Facture', backref='hospitalisation', lazy=True)
+    def erreur(numero, message):
+        resultat['erreurs'] += 1
+        signaler_erreur(numero, message)
+    
+    lot = []
+    for numero, donnees in lignes:
+        resultat['lues'] += 1
+        valeurs, message = valider_patient_import(donnees)
+        if message:
+            erreur(numero, message)
+            continue
+        lot.append((numero, valeurs))
+        if len(lot) >= taille_lot:
+            resultat['inserees'] += inserer_lot_patients(lot, erreur)
+            lot = []
+    if lot:
+        resultat['inserees'] += inserer_lot_patients(lot, erreur)
+    return resultat
 
-class Facture(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    numero_facture = db.Column(db.String(50), unique=True, nullable=False)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
-    hospitalisation_id = db.Column(db.Integer, db.ForeignKey('hospitalisation.id'))
-    date_facture = db.Column(db.DateTime, default=datetime.utcnow)
-    date_echeance = db.Column(db.Date)
-    montant_total = db.Column(db.Float, nullable=False)
-    montant_paye = db.Column(db.Float, default=0.0)
-    statut = db.Column(db.String(20), default='en_attente')  # en_attente, payee, partielle, annulee
-    type_facture = db.Column(db.String(30), nullable=False)  # hospitalisation, consultation, medicaments
-    notes = db.Column(db.Text)
+def format_import(nom_fichier, format_demande=None):
+    if format_demande in ('csv', 'ndjson'):
+        return format_demande
+    return 'ndjson' if nom_fichier.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+
+# Exports CSV / XLSX : les lignes sont lues avec un curseur côté serveur
+# (yield_per) et envoyées au fur et à mesure, la mémoire reste constante
+TAILLE_BLOC_EXPORT = 1000
+
+def definition_export(entite):
+    if entite == 'patients':
+        colonnes = [
+            ('ID', Patient.id), ('Nom', Patient.nom), ('Prénom', Patient.prenom),
+            ('Date de naissance', Patient.date_naissance), ('Téléphone', Patient.telephone),
+            ('Email', Patient.email), ('Adresse', Patient.adresse),
+            ('N° sécurité sociale', Patient.numero_securite_sociale),
+            ('Date d\'inscription', Patient.date_inscription)
+        ]
+        return colonnes, db.select(*[c for _, c in colonnes]), Patient.date_inscription, Patient.id
+    if entite == 'rendez_vous':
+        colonnes = [
+            ('ID', RendezVous.id), ('Date', RendezVous.date_rdv),
+            ('Patient nom', Patient.nom), ('Patient prénom', Patient.prenom),
+            ('Médecin nom', Personnel.nom), ('Médecin prénom', Personnel.prenom),
+            ('Type', RendezVous.type_consultation), ('Statut', RendezVous.statut), ('Notes', RendezVous.notes)
+        ]
+        requete = db.select(*[c for _, c in colonnes]).join(
+            Patient, RendezVous.patient_id == Patient.id
+        ).join(Personnel, RendezVous.personnel_id == Personnel.id)
+        return colonnes, requete, RendezVous.date_rdv, RendezVous.id
+    if entite == 'prescriptions':
+        colonnes = [
+            ('ID', Prescription.id), ('Date', Prescription.date_prescription),
+            ('Patient nom', Patient.nom), ('Patient prénom', Patient.prenom),
+            ('Médicament', Medicament.nom), ('Quantité', Prescription.quantite),
+            ('Posologie', Prescription.posologie), ('Prescripteur', User.nom),
+            ('Statut', Prescription.statut), ('Notes', Prescription.notes)
+        ]
+        requete = db.select(*[c for _, c in colonnes]).join(
+            Patient, Prescription.patient_id == Patient.id
+        ).join(Medicament, Prescription.medicament_id == Medicament.id
+        ).join(User, Prescription.medecin_id == User.id)
+        return colonnes, requete, Prescription.date_prescription, Prescription.id
+    if entite == 'factures':
+        colonnes = [
+            ('Numéro', Facture.numero_facture), ('Date', Facture.date_facture),
+            ('Patient nom', Patient.nom), ('Patient prénom', Patient.prenom),
+            ('Type', Facture.type_facture), ('Montant total', Facture.montant_total),
+            ('Montant payé', Facture.montant_paye), ('Statut', Facture.statut),
+            ('Échéance', Facture.date_echeance)
+        ]
+        requete = db.select(*[c for _, c in colonnes]).join(Patient, Facture.patient_id == Patient.id)
+        return colonnes, requete, Facture.date_facture, Facture.id
+    return None
+
+def lignes_export(requete, colonne_date, colonne_id, du=None, au=None):
+    if du:
+        requete = requete.where(colonne_date >= du)
+    if au:
+        requete = requete.where(colonne_date < au + timedelta(days=1))
+    requete = requete.order_by(colonne_date, colonne_id).execution_options(yield_per=TAILLE_BLOC_EXPORT)
+    for ligne in db.session.execute(requete):
+        yield ligne
+
+def valeur_export(valeur):
+    if valeur is None:
+        return ''
+    if isinstance(valeur, (date, datetime)):
+        return valeur.isoformat(sep=' ', timespec='seconds') if isinstance(valeur, datetime) else valeur.isoformat()
+    return valeur
+
+def generer_csv(entetes, lignes):
+    tampon = io.StringIO()
+    ecrivain = csv.writer(tampon)
+    tampon.write('\ufeff')
+    ecrivain.writerow(entetes)
+    for numero, ligne in enumerate(lignes, start=1):
+        ecrivain.writerow([valeur_export(v) for v in ligne])
+        if numero % TAILLE_BLOC_EXPORT == 0:
+            yield tampon.getvalue()
+            tampon.seek(0)
+            tampon.truncate()
+    yield tampon.getvalue()
+
+class TamponZip:
+    # Fichier en écriture seule sans seek : zipfile écrit alors des
+    # descripteurs de données et l'archive peut être envoyée en flux
+    def __init__(self):
+        self.morceaux = []
+        self.position = 0
     
-    # Relations
-    patient = db.relationship('Patient', backref='factures')
-    details = db.relationship('DetailFacture', backref='facture', lazy=True, cascade='all, delete-orphan')
+    def write(self, donnees):
+        self.morceaux.append(bytes(donnees))
+        self.position += len(donnees)
+        return len(donnees)
+    
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def vider(self):
+        donnees = b''.join(self.morceaux)
+        self.morceaux = []
+        return donnees
 
-class DetailFacture(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    facture_id = db.Column(db.Integer, db.ForeignKey('facture.id'), nullable=False)
-    description = db.Column(db.String(200), nullable=False)
-    quantite = db.Column(db.Integer, default=1)
-    prix_unitaire = db.Column(db.Float, nullable=False)
-    montant = db.Column(db.Float, nullable=False)
-    type_service = db.Column(db.String(50))  # chambre, consultation, medicament, examen
+XLSX_FICHIERS_FIXES = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Export" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    )
+}
+
+def cellule_xlsx(valeur):
+    if isinstance(valeur, bool) or not isinstance(valeur, (int, float)):
+        texte = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', str(valeur_export(valeur)))
+        return f'<c t="inlineStr"><is><t xml:space="preserve">{echapper_xml(texte)}</t></is></c>'
+    return f'<c><v>{valeur}</v></c>'
+
+def generer_xlsx(entetes, lignes):
+    tampon = TamponZip()
+    with zipfile.ZipFile(tampon, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for nom, contenu in XLSX_FICHIERS_FIXES.items():
+            archive.writestr(nom, contenu)
+        yield tampon.vider()
+        
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as feuille:
+            feuille.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                '<row>' + ''.join(cellule_xlsx(e) for e in entetes) + '</row>'
+            ).encode())
+            for numero, ligne in enumerate(lignes, start=1):
+                feuille.write(('<row>' + ''.join(cellule_xlsx(v) for v in ligne) + '</row>').encode())
+                if numero % TAILLE_BLOC_EXPORT == 0:
+                    yield tampon.vider()
+            feuille.write(b'</sheetData></worksheet>')
+    yield tampon.vider()
 
 # Routes d'authentification
 @app.route('/login', methods=['GET', 'POST'])
@@ -337,26 +3031,57 @@ def admin_register():
     
     return render_template('admin_register.html')
 
+@app.route('/admin/import/patients', methods=['GET', 'POST'])
+@role_required('admin')
+def import_patients():
+    if request.method == 'POST':
+        fichier = request.files.get('fichier')
+        if not fichier or not fichier.filename:
+            flash('Veuillez sélectionner un fichier', 'error')
+            return redirect(url_for('import_patients'))
+        
+        taille_lot = request.form.get('taille_lot', app.config['IMPORT_TAILLE_LOT'], type=int)
+        erreurs = []
+        
+        def signaler_erreur(numero, message):
+            # Seules les premières erreurs sont affichées, le total est compté
+            if len(erreurs) < 200:
+                erreurs.append((numero, message))
+        
+        try:
+            lignes = lire_fichier_import(fichier.stream, format_import(fichier.filename, request.form.get('format')))
+            resultat = importer_patients(lignes, max(1, taille_lot), signaler_erreur)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Erreur lors de l'import des patients: {str(e)}")
+            flash('Erreur lors de la lecture du fichier', 'error')
+            return redirect(url_for('import_patients'))
+        
+        invalider_stats_tableau_de_bord()
+        logger.info(f"Import patients: {resultat['inserees']}/{resultat['lues']} lignes insérées")
+        flash(f"Import terminé : {resultat['inserees']} patient(s) ajouté(s), {resultat['erreurs']} ligne(s) rejetée(s)",
+              'success' if not resultat['erreurs'] else 'warning')
+        return render_template('import_patients.html', resultat=resultat, erreurs=erreurs)
+    
+    return render_template('import_patients.html', resultat=None, erreurs=[])
+
 # Routes principales
 @app.route('/')
 @login_required
 def index():
-    stats = {
-        'total_patients': Patient.query.count(),
-        'total_personnel': Personnel.query.count(),
-        'rdv_aujourd_hui': RendezVous.query.filter(
-            db.func.date(RendezVous.date_rdv) == date.today()
-        ).count(),
-        'chambres_libres': Chambre.query.filter_by(statut='libre').count()
-    }
+    stats = dict(stats_tableau_de_bord())
+    stats['chambres_libres'] = sum(nombre['libres'] for nombre in carte_chambres.disponibilite().values())
     return render_template('index.html', stats=stats)
 
 # Routes pour les patients
 @app.route('/patients')
 @login_required
 def patients():
-    patients = Patient.query.order_by(Patient.nom).all()
-    return render_template('patients.html', patients=patients)
+    q = request.args.get('q', '').strip()
+    if q:
+        return render_template('patients.html', patients=rechercher_patients(q, taille_page()), page=None, q=q)
+    page = page_patients()
+    return render_template('patients.html', patients=page['elements'], page=page, q='')
 
 @app.route('/patients/ajouter', methods=['GET', 'POST'])
 @login_required
@@ -372,7 +3097,12 @@ def ajouter_patient():
             numero_securite_sociale=request.form['numero_securite_sociale']
         )
         db.session.add(patient)
+        db.session.flush()
+        indexer_patients([patient])
+        indexer_cles_doublons([patient])
+        ajuster_compteurs({'patients': 1})
         db.session.commit()
+        invalider_stats_tableau_de_bord()
         flash('Patient ajouté avec succès!', 'success')
         return redirect(url_for('patients'))
     return render_template('ajouter_patient.html')
@@ -381,9 +3111,64 @@ def ajouter_patient():
 @login_required
 def detail_patient(id):
     patient = Patient.query.get_or_404(id)
-    rendez_vous = RendezVous.query.filter_by(patient_id=id).order_by(RendezVous.date_rdv.desc()).all()
-    consultations = Consultation.query.filter_by(patient_id=id).order_by(Consultation.date_consultation.desc()).all()
-    return render_template('detail_patient.html', patient=patient, rendez_vous=rendez_vous, consultations=consultations)
+    chronologie = chronologie_patient(id, taille_page())
+    return render_template('detail_patient.html', patient=patient, chronologie=chronologie,
+                           libelles_evenements=LIBELLES_EVENEMENTS)
+
+@app.route('/api/patients/<int:id>/chronologie')
+@login_required
+def api_chronologie_patient(id):
+    chronologie = chronologie_patient(id, taille_page(), apres=request.args.get('apres'))
+    return jsonify({
+        'evenements': [{
+            'type': e.type,
+            'id': e.id,
+            'date': e.date.strftime('%d/%m/%Y %H:%M') if e.date else '',
+            'titre': e.titre,
+            'detail': e.detail,
+            'statut': e.statut
+        } for e in chronologie['evenements']],
+        'suivant': chronologie['suivant']
+    })
+
+# Routes pour les doublons de patients
+@app.route('/admin/doublons')
+@role_required('admin')
+def doublons():
+    candidats = DoublonCandidat.query.options(
+        joinedload(DoublonCandidat.patient_a), joinedload(DoublonCandidat.patient_b)
+    ).filter_by(statut='a_verifier').order_by(
+        DoublonCandidat.score.desc(), DoublonCandidat.id
+    ).limit(taille_page()).all()
+    return render_template('doublons.html', candidats=candidats)
+
+@app.route('/admin/doublons/<int:id>/fusionner', methods=['POST'])
+@role_required('admin')
+def fusionner_doublon(id):
+    candidat = DoublonCandidat.query.get_or_404(id)
+    if request.form.get('garder') == 'b':
+        garde, doublon = candidat.patient_b, candidat.patient_a
+    else:
+        garde, doublon = candidat.patient_a, candidat.patient_b
+    try:
+        fusionner_patients(garde, doublon)
+        db.session.commit()
+        invalider_stats_tableau_de_bord()
+        flash(f'Patients fusionnés dans le dossier de {garde.nom} {garde.prenom}', 'success')
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Erreur lors de la fusion des patients: {str(e)}")
+        flash('Erreur lors de la fusion des patients', 'error')
+    return redirect(url_for('doublons'))
+
+@app.route('/admin/doublons/<int:id>/ignorer', methods=['POST'])
+@role_required('admin')
+def ignorer_doublon(id):
+    candidat = DoublonCandidat.query.get_or_404(id)
+    candidat.statut = 'ignore'
+    db.session.commit()
+    flash('Paire marquée comme non doublon', 'info')
+    return redirect(url_for('doublons'))
 
 # Routes pour le personnel
 @app.route('/personnel')
@@ -405,7 +3190,9 @@ def ajouter_personnel():
             date_embauche=datetime.strptime(request.form['date_embauche'], '%Y-%m-%d').date()
         )
         db.session.add(personnel)
+        ajuster_compteurs({'personnel': 1})
         db.session.commit()
+        invalider_stats_tableau_de_bord()
         flash('Personnel ajouté avec succès!', 'success')
         return redirect(url_for('personnel'))
     return render_template('ajouter_personnel.html')
@@ -414,8 +3201,38 @@ def ajouter_personnel():
 @app.route('/rendez-vous')
 @login_required
 def rendez_vous():
-    rdv = RendezVous.query.order_by(RendezVous.date_rdv).all()
-    return render_template('rendez_vous.html', rendez_vous=rdv)
+    vue, jour, personnel_id = parametres_calendrier()
+    debut, fin = fenetre_calendrier(vue, jour)
+    rdv = rendez_vous_periode(debut, fin, personnel_id)
+    
+    # Regroupement par jour, jours vides compris
+    jours = {debut + timedelta(days=i): [] for i in range((fin - debut).days)}
+    for r in rdv:
+        jours[r.date_rdv.date()].append(r)
+    
+    return render_template('rendez_vous.html',
+                         jours=jours,
+                         nombre_rdv=len(rdv),
+                         vue=vue,
+                         jour=jour,
+                         debut=debut,
+                         dernier_jour=fin - timedelta(days=1),
+                         precedent=fenetre_calendrier(vue, debut - timedelta(days=1))[0],
+                         suivant=fin,
+                         aujourd_hui=date.today(),
+                         personnel_choisi=Personnel.query.get(personnel_id) if personnel_id else None)
+
+@app.route('/api/rendez-vous')
+@login_required
+def api_rendez_vous():
+    vue, jour, personnel_id = parametres_calendrier()
+    debut, fin = fenetre_calendrier(vue, jour)
+    return jsonify({
+        'vue': vue,
+        'debut': debut.isoformat(),
+        'fin': fin.isoformat(),
+        'rendez_vous': [rendez_vous_json(r) for r in rendez_vous_periode(debut, fin, personnel_id)]
+    })
 
 @app.route('/rendez-vous/ajouter', methods=['GET', 'POST'])
 @login_required
@@ -425,24 +3242,33 @@ def ajouter_rendez_vous():
             patient_id=request.form['patient_id'],
             personnel_id=request.form['personnel_id'],
             date_rdv=datetime.strptime(request.form['date_rdv'], '%Y-%m-%dT%H:%M'),
+            duree=request.form.get('duree'),
             type_consultation=request.form['type_consultation'],
             notes=request.form['notes']
         )
-        db.session.add(rdv)
-        db.session.commit()
+        try:
+            enregistrer_rendez_vous(rdv, {cle_rdv_jour(rdv.date_rdv.date()): 1})
+        except ConflitRendezVous as e:
+            flash(message_conflit_rdv(e), 'error')
+            db.session.rollback()
+            return render_template('ajouter_rendez_vous.html',
+                                 durees=DUREES_TYPE_CONSULTATION,
+                                 specialites=specialites_personnel(),
+                                 saisie=request.form)
+        invalider_stats_tableau_de_bord()
         flash('Rendez-vous ajouté avec succès!', 'success')
-        return redirect(url_for('rendez_vous'))
+        return redirect(url_for('rendez_vous', date=rdv.date_rdv.date().isoformat()))
     
-    patients = Patient.query.order_by(Patient.nom).all()
-    personnel = Personnel.query.order_by(Personnel.nom).all()
-    return render_template('ajouter_rendez_vous.html', patients=patients, personnel=personnel)
+    return render_template('ajouter_rendez_vous.html',
+                         durees=DUREES_TYPE_CONSULTATION,
+                         specialites=specialites_personnel())
 
 # Routes pour les chambres
 @app.route('/chambres')
 @login_required
 def chambres():
     chambres = Chambre.query.order_by(Chambre.numero).all()
-    return render_template('chambres.html', chambres=chambres)
+    return render_template('chambres.html', chambres=chambres, disponibilite=carte_chambres.disponibilite())
 
 @app.route('/chambres/ajouter', methods=['GET', 'POST'])
 @role_required('admin')
@@ -454,7 +3280,10 @@ def ajouter_chambre():
             prix_nuit=float(request.form['prix_nuit'])
         )
         db.session.add(chambre)
+        ajuster_compteurs({'chambres_libres': 1, 'version_chambres': 1})
         db.session.commit()
+        carte_chambres.appliquer([chambre.id])
+        invalider_stats_tableau_de_bord()
         flash('Chambre ajoutée avec succès!', 'success')
         return redirect(url_for('chambres'))
     return render_template('ajouter_chambre.html')
@@ -462,14 +3291,50 @@ def ajouter_chambre():
 # API pour obtenir les données
 @app.route('/api/patients')
 def api_patients():
-    patients = Patient.query.all()
-    return jsonify([{
+    # Sans paramètre de pagination, la liste complète est renvoyée comme avant ;
+    # sinon une page, avec les curseurs des pages voisines dans l'en-tête Link
+    if not any(request.args.get(parametre) for parametre in ('apres', 'avant', 'taille')):
+        return jsonify([{
+            'id': p.id,
+            'nom': p.nom,
+            'prenom': p.prenom,
+            'telephone': p.telephone
+        } for p in Patient.query.order_by(Patient.id)])
+    page = page_patients()
+    reponse = jsonify([{
         'id': p.id,
         'nom': p.nom,
         'prenom': p.prenom,
         'telephone': p.telephone
+    } for p in page['elements']])
+    liens = []
+    for relation, parametre in (('next', 'apres'), ('prev', 'avant')):
+        curseur = page['suivant' if relation == 'next' else 'precedent']
+        if curseur:
+            url = url_for('api_patients', tri=page['tri'], ordre=page['ordre'], taille=page['taille'],
+                          _external=True, **{parametre: curseur})
+            liens.append(f'<{url}>; rel="{relation}"')
+    if liens:
+        reponse.headers['Link'] = ', '.join(liens)
+    return reponse
+
+@app.route('/api/patients/recherche')
+@login_required
+def api_recherche_patients():
+    patients = rechercher_patients(request.args.get('q', ''), taille_page())
+    return jsonify([{
+        'id': p.id,
+        'nom': p.nom,
+        'prenom': p.prenom,
+        'telephone': p.telephone,
+        'date_naissance': p.date_naissance.isoformat()
     } for p in patients])
 
+@app.route('/api/chambres/disponibilite')
+@login_required
+def api_disponibilite_chambres():
+    return jsonify(carte_chambres.disponibilite())
+
 @app.route('/api/personnel')
 def api_personnel():
     personnel = Personnel.query.all()
@@ -480,6 +3345,145 @@ def api_personnel():
         'specialite': p.specialite
     } for p in personnel])
 
+@app.route('/api/creneaux')
+@login_required
+def api_creneaux():
+    # Prochains créneaux libres pour un médecin (personnel_id) ou une spécialité
+    personnel_id = request.args.get('personnel_id', type=int)
+    specialite = request.args.get('specialite', '').strip()
+    type_consultation = request.args.get('type_consultation', '')
+    duree = lire_duree_rdv(request.args.get('duree') or duree_type_consultation(type_consultation))
+    nombre = max(1, min(request.args.get('nombre', 10, type=int), 50))
+    jours = max(1, min(request.args.get('jours', HORIZON_CRENEAUX_MAX, type=int), HORIZON_CRENEAUX_MAX))
+    try:
+        debut = max(datetime.fromisoformat(request.args['debut']), datetime.now())
+    except (KeyError, ValueError):
+        debut = datetime.now()
+    
+    query = Personnel.query.filter(Personnel.statut == 'actif')
+    if personnel_id:
+        query = query.filter(Personnel.id == personnel_id)
+    elif specialite:
+        query = query.filter(Personnel.specialite.ilike(specialite))
+    else:
+        return jsonify({'erreur': 'personnel_id ou specialite requis'}), 400
+    
+    creneaux = creneaux_libres(query.all(), debut, debut + timedelta(days=jours), duree, nombre)
+    return jsonify({
+        'duree': duree,
+        'creneaux': [{
+            'debut': c['debut'].isoformat(),
+            'fin': c['fin'].isoformat(),
+            'personnel': {
+                'id': c['personnel'].id,
+                'nom': c['personnel'].nom,
+                'prenom': c['personnel'].prenom,
+                'specialite': c['personnel'].specialite
+            }
+        } for c in creneaux]
+    })
+
+# API d'autocomplétion pour les formulaires (rendez-vous, admission, facture) :
+# le nombre de suggestions est toujours borné, quel que soit le volume des tables
+def limite_typeahead():
+    limite = request.args.get('limite', app.config['TYPEAHEAD_LIMITE'], type=int)
+    return max(1, min(limite, app.config['TYPEAHEAD_LIMITE_MAX']))
+
+def motif_prefixe(q):
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+@app.route('/api/typeahead/patients')
+@login_required
+def typeahead_patients():
+    patients = rechercher_patients(request.args.get('q', ''), limite_typeahead())
+    return jsonify([{
+        'id': p.id,
+        'libelle': f"{p.nom} {p.prenom} - {p.telephone}"
+    } for p in patients])
+
+@app.route('/api/typeahead/personnel')
+@login_required
+def typeahead_personnel():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify([])
+    motif = motif_prefixe(q)
+    personnel = Personnel.query.filter(db.or_(
+        Personnel.nom.ilike(motif, escape='\\'),
+        Personnel.prenom.ilike(motif, escape='\\'),
+        Personnel.specialite.ilike(motif, escape='\\')
+    )).order_by(Personnel.nom, Personnel.id).limit(limite_typeahead()).all()
+    return jsonify([{
+        'id': p.id,
+        'libelle': f"{p.nom} {p.prenom} - {p.specialite}"
+    } for p in personnel])
+
+@app.route('/api/typeahead/hospitalisations')
+@login_required
+def typeahead_hospitalisations():
+    query = db.session.query(
+        Hospitalisation.id, Patient.nom, Patient.prenom, Chambre.numero, Hospitalisation.date_sortie
+    ).join(Patient, Hospitalisation.patient_id == Patient.id
+    ).join(Chambre, Hospitalisation.chambre_id == Chambre.id)
+    
+    patient_id = request.args.get('patient_id', type=int)
+    q = request.args.get('q', '').strip()
+    if patient_id:
+        # Facture d'un patient : les séjours dont les nuits ne sont pas toutes
+        # facturées restent proposés après la sortie
+        query = query.filter(Hospitalisation.patient_id == patient_id, db.or_(
+            Hospitalisation.statut == 'hospitalise', Hospitalisation.facturation_terminee.is_(False)
+        ))
+    elif q:
+        query = query.filter(Hospitalisation.statut == 'hospitalise',
+                             Patient.nom.ilike(motif_prefixe(q), escape='\\'))
+    else:
+        return jsonify([])
+    
+    lignes = query.order_by(Hospitalisation.date_admission.desc()).limit(limite_typeahead()).all()
+    return jsonify([{
+        'id': id,
+        'libelle': f"{nom} {prenom} - Chambre {numero}" + (f" (sorti le {date_sortie:%d/%m/%Y})" if date_sortie else '')
+    } for id, nom, prenom, numero, date_sortie in lignes])
+
+# Routes pour les exports
+@app.route('/exports')
+@login_required
+def exports():
+    return render_template('exports.html')
+
+@app.route('/exports/<entite>')
+@login_required
+def exporter(entite):
+    definition = definition_export(entite)
+    if not definition:
+        flash('Export inconnu', 'error')
+        return redirect(url_for('exports'))
+    colonnes, requete, colonne_date, colonne_id = definition
+    
+    try:
+        du = datetime.strptime(request.args['du'], '%Y-%m-%d').date() if request.args.get('du') else None
+        au = datetime.strptime(request.args['au'], '%Y-%m-%d').date() if request.args.get('au') else None
+    except ValueError:
+        flash('Période invalide', 'error')
+        return redirect(url_for('exports'))
+    
+    entetes = [entete for entete, _ in colonnes]
+    lignes = lignes_export(requete, colonne_date, colonne_id, du, au)
+    nom_fichier = f"{entite}_{(du or 'debut')}_{(au or date.today())}"
+    if request.args.get('format') == 'xlsx':
+        contenu = generer_xlsx(entetes, lignes)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        nom_fichier += '.xlsx'
+    else:
+        contenu = generer_csv(entetes, lignes)
+        mimetype = 'text/csv'
+        nom_fichier += '.csv'
+    
+    return Response(stream_with_context(contenu), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{nom_fichier}"'
+    })
+
 # Routes pour les utilisateurs
 @app.route('/users')
 @role_required('admin')
@@ -492,8 +3496,29 @@ def users():
 @login_required
 def pharmacie():
     medicaments = Medicament.query.order_by(Medicament.nom).all()
-    prescriptions = Prescription.query.order_by(Prescription.date_prescription.desc()).limit(10).all()
-    return render_template('pharmacie.html', medicaments=medicaments, prescriptions=prescriptions)
+    prescriptions = Prescription.query.options(
+        joinedload(Prescription.patient), joinedload(Prescription.medicament)
+    ).order_by(Prescription.date_prescription.desc()).limit(10).all()
+    return render_template('pharmacie.html', medicaments=medicaments, prescriptions=prescriptions,
+                         alertes=alertes_pharmacie(10), aujourd_hui=date.today())
+
+@app.route('/api/alertes/pharmacie')
+@login_required
+def api_alertes_pharmacie():
+    stock_bas = int(lire_compteurs(['medicaments_stock_bas'])['medicaments_stock_bas'])
+    expirations = nombre_expirations()
+    reponse = {'stock_bas': stock_bas, 'expirations': expirations, 'total': stock_bas + expirations}
+    if request.args.get('details'):
+        alertes = alertes_pharmacie(limite_typeahead())
+        reponse['details'] = {
+            'stock_bas': [{
+                'id': m.id, 'nom': m.nom, 'quantite_stock': m.quantite_stock, 'seuil_minimum': m.seuil_minimum
+            } for m in alertes['stock_bas']],
+            'expirations': [{
+                'id': m.id, 'nom': m.nom, 'date_expiration': m.date_expiration.isoformat()
+            } for m in alertes['expirations']]
+        }
+    return jsonify(reponse)
 
 @app.route('/pharmacie/medicaments')
 @role_required('pharmacien')
@@ -515,94 +3540,261 @@ def ajouter_medicament():
             date_expiration=datetime.strptime(request.form['date_expiration'], '%Y-%m-%d').date() if request.form['date_expiration'] else None,
             fournisseur=request.form['fournisseur']
         )
+        if medicament.quantite_stock > 0:
+            # Le stock initial forme le premier lot
+            lot = LotMedicament(
+                numero_lot=request.form.get('numero_lot') or 'INITIAL',
+                quantite_initiale=medicament.quantite_stock,
+                quantite=medicament.quantite_stock,
+                date_expiration=medicament.date_expiration,
+                fournisseur=medicament.fournisseur
+            )
+            medicament.lots.append(lot)
+            medicament.mouvements.append(MouvementStock(lot=lot, type_mouvement='reception', quantite=lot.quantite))
         db.session.add(medicament)
+        ajuster_compteurs(compteurs_medicament(medicament.quantite_stock, medicament.seuil_minimum))
         db.session.commit()
         flash('Médicament ajouté avec succès!', 'success')
         return redirect(url_for('medicaments'))
     return render_template('ajouter_medicament.html')
 
+@app.route('/pharmacie/medicaments/<int:id>/lots', methods=['GET', 'POST'])
+@role_required('pharmacien')
+def lots_medicament(id):
+    medicament = Medicament.query.get_or_404(id)
+    if request.method == 'POST':
+        try:
+            quantite = int(request.form['quantite'])
+        except ValueError:
+            quantite = 0
+        if quantite <= 0:
+            flash('La quantité reçue doit être positive', 'error')
+            return redirect(url_for('lots_medicament', id=id))
+        verrouiller_medicaments([id])
+        lot = LotMedicament(
+            medicament_id=id,
+            numero_lot=request.form['numero_lot'],
+            quantite_initiale=quantite,
+            quantite=quantite,
+            date_expiration=datetime.strptime(request.form['date_expiration'], '%Y-%m-%d').date() if request.form['date_expiration'] else None,
+            fournisseur=request.form.get('fournisseur') or medicament.fournisseur
+        )
+        db.session.add(lot)
+        db.session.add(MouvementStock(medicament_id=id, lot=lot, type_mouvement='reception', quantite=quantite))
+        db.session.flush()
+        recalculer_stock(id)
+        db.session.commit()
+        invalider_stats_tableau_de_bord()
+        flash('Lot réceptionné avec succès!', 'success')
+        return redirect(url_for('lots_medicament', id=id))
+    
+    lots = LotMedicament.query.filter_by(medicament_id=id).order_by(
+        (LotMedicament.quantite > 0).desc(), LotMedicament.date_expiration.nulls_last(), LotMedicament.id
+    ).all()
+    mouvements = MouvementStock.query.options(joinedload(MouvementStock.lot)).filter_by(medicament_id=id).order_by(
+        MouvementStock.date_mouvement.desc(), MouvementStock.id.desc()
+    ).limit(50).all()
+    return render_template('lots_medicament.html', medicament=medicament, lots=lots, mouvements=mouvements,
+                           aujourd_hui=date.today())
+
+@app.route('/pharmacie/rapport-stock')
+@role_required('pharmacien')
+def rapport_stock():
+    jour = date.today()
+    if request.args.get('date'):
+        try:
+            jour = datetime.strptime(request.args['date'], '%Y-%m-%d').date()
+        except ValueError:
+            flash('Date invalide', 'error')
+    # Stock en fin de journée
+    stocks = stock_a_date(datetime.combine(jour + timedelta(days=1), datetime.min.time()))
+    mois, consommation = consommation_mensuelle()
+    medicaments = Medicament.query.order_by(Medicament.nom).all()
+    return render_template('rapport_stock.html', medicaments=medicaments, stocks=stocks, jour=jour,
+                           mois=mois, consommation=consommation)
+
+@app.route('/pharmacie/lots/<int:id>/ajuster', methods=['POST'])
+@role_required('pharmacien')
+def ajuster_lot(id):
+    lot = LotMedicament.query.get_or_404(id)
+    try:
+        quantite = int(request.form['quantite'])
+    except ValueError:
+        quantite = -1
+    if quantite < 0:
+        flash('Quantité invalide', 'error')
+        return redirect(url_for('lots_medicament', id=lot.medicament_id))
+    # Inventaire ou destruction d'un lot périmé (quantité 0)
+    verrouiller_medicaments([lot.medicament_id])
+    db.session.refresh(lot)
+    if quantite != lot.quantite:
+        perime = lot_perime(lot, date.today()) and quantite < lot.quantite
+        db.session.add(MouvementStock(medicament_id=lot.medicament_id, lot_id=lot.id,
+                                      type_mouvement='peremption' if perime else 'ajustement',
+                                      quantite=quantite - lot.quantite))
+    lot.quantite = quantite
+    db.session.flush()
+    recalculer_stock(lot.medicament_id)
+    db.session.commit()
+    invalider_stats_tableau_de_bord()
+    flash(f'Lot {lot.numero_lot} ajusté', 'success')
+    return redirect(url_for('lots_medicament', id=lot.medicament_id))
+
 @app.route('/pharmacie/prescriptions')
 @login_required
 def prescriptions():
-    prescriptions = Prescription.query.order_by(Prescription.date_prescription.desc()).all()
+    prescriptions = Prescription.query.options(
+        joinedload(Prescription.patient), joinedload(Prescription.medecin), joinedload(Prescription.medicament)
+    ).order_by(Prescription.date_prescription.desc()).all()
     return render_template('prescriptions.html', prescriptions=prescriptions)
 
 @app.route('/pharmacie/prescriptions/<int:id>/delivrer', methods=['POST'])
 @role_required('pharmacien')
 def delivrer_prescription(id):
-    prescription = Prescription.query.get_or_404(id)
-    medicament = prescription.medicament
+    Prescription.query.get_or_404(id)
+    resultat = delivrer(id)
     
-    if medicament.quantite_stock >= prescription.quantite:
-        medicament.quantite_stock -= prescription.quantite
-        prescription.statut = 'delivre'
-        db.session.commit()
+    if resultat == 'delivre':
         flash('Prescription délivrée avec succès!', 'success')
+    elif resultat == 'deja_traitee':
+        flash('Cette prescription a déjà été délivrée ou annulée', 'info')
     else:
         flash('Stock insuffisant pour délivrer cette prescription', 'error')
     
     return redirect(url_for('prescriptions'))
 
+@app.route('/pharmacie/prescriptions/delivrer', methods=['POST'])
+@role_required('pharmacien')
+def delivrer_prescriptions_lot():
+    if request.is_json:
+        ids = (request.get_json(silent=True) or {}).get('prescriptions', [])
+    else:
+        ids = request.form.getlist('prescriptions')
+    try:
+        ids = sorted({int(i) for i in ids})
+    except (TypeError, ValueError):
+        return jsonify({'erreur': 'identifiants de prescription invalides'}), 400
+    
+    resultats = delivrer_lot(ids) if ids else {}
+    if request.is_json:
+        return jsonify({'resultats': {str(i): statut for i, statut in resultats.items()}})
+    
+    delivrees = [i for i, statut in resultats.items() if statut == 'delivre']
+    insuffisantes = [i for i, statut in resultats.items() if statut == 'stock_insuffisant']
+    deja = [i for i, statut in resultats.items() if statut == 'deja_traitee']
+    if delivrees:
+        flash(f'{len(delivrees)} prescription(s) délivrée(s)', 'success')
+    if insuffisantes:
+        flash(f"Stock insuffisant pour les prescriptions n° {', '.join(map(str, insuffisantes))}", 'error')
+    if deja:
+        flash(f"Déjà délivrées ou annulées : n° {', '.join(map(str, deja))}", 'info')
+    return redirect(url_for('prescriptions'))
+
 # Routes pour l'hospitalisation
 @app.route('/hospitalisation')
 @login_required
 def hospitalisation():
-    hospitalisations = Hospitalisation.query.filter_by(statut='hospitalise').order_by(Hospitalisation.date_admission.desc()).all()
+    hospitalisations = Hospitalisation.query.options(
+        joinedload(Hospitalisation.patient), joinedload(Hospitalisation.chambre)
+    ).filter_by(statut='hospitalise').order_by(Hospitalisation.date_admission.desc()).all()
     return render_template('hospitalisation.html', hospitalisations=hospitalisations)
 
+@app.route('/hospitalisation/statistiques')
+@login_required
+def statistiques_occupation():
+    try:
+        periode = min(max(int(request.args.get('jours', 90)), 1), 3660)
+    except ValueError:
+        periode = 90
+    fin = aujourd_hui_utc() + timedelta(days=1)
+    debut = fin - timedelta(days=periode)
+    type_chambre = request.args.get('type') or None
+    series = serie_occupation(debut, fin, type_chambre)
+    return render_template('statistiques_occupation.html', series=series, resume=resume_occupation(series),
+                         prevision=prevision_lits(), periode=periode, type_choisi=type_chambre,
+                         types=sorted(capacite_chambres()))
+
+@app.route('/api/occupation')
+@login_required
+def api_occupation():
+    try:
+        debut = datetime.strptime(request.args['debut'], '%Y-%m-%d').date()
+        fin = datetime.strptime(request.args['fin'], '%Y-%m-%d').date() + timedelta(days=1)
+    except (KeyError, ValueError):
+        return jsonify({'erreur': 'paramètres debut et fin (AAAA-MM-JJ) requis'}), 400
+    series = serie_occupation(debut, fin, request.args.get('type') or None)
+    return jsonify({
+        'resume': resume_occupation(series),
+        'series': {type_chambre: [{
+            'jour': jour.isoformat(), 'lits_occupes': round(lits, 2), 'admissions': admissions,
+            'sorties': sorties, 'capacite': capacite
+        } for jour, lits, admissions, sorties, capacite in jours] for type_chambre, jours in series.items()}
+    })
+
+@app.route('/api/occupation/prevision')
+@login_required
+def api_prevision_occupation():
+    return jsonify(prevision_lits())
+
 @app.route('/hospitalisation/admettre', methods=['GET', 'POST'])
 @login_required
 def admettre_patient():
     if request.method == 'POST':
-        # Vérifier si la chambre est libre
-        chambre = Chambre.query.get(request.form['chambre_id'])
-        if chambre.statut != 'libre':
-            flash('Cette chambre n\'est pas disponible', 'error')
+        try:
+            patient_id = int(request.form['patient_id'])
+            chambre_id = int(request.form['chambre_id']) if request.form.get('chambre_id') else None
+        except ValueError:
+            flash('Patient ou chambre invalide', 'error')
             return redirect(url_for('admettre_patient'))
+        Patient.query.get_or_404(patient_id)
         
-        # Créer l'hospitalisation
-        hospitalisation = Hospitalisation(
-            patient_id=request.form['patient_id'],
-            chambre_id=request.form['chambre_id'],
-            motif_admission=request.form['motif_admission'],
-            notes=request.form['notes']
-        )
-        db.session.add(hospitalisation)
-        
-        # Marquer la chambre comme occupée
-        chambre.statut = 'occupee'
+        # Chambre choisie, ou attribution automatique selon le type demandé
+        resultat, hospitalisation = admettre(patient_id, request.form['motif_admission'], request.form.get('notes'),
+                                             chambre_id=chambre_id, type_chambre=request.form.get('type_chambre'))
+        if resultat == 'deja_hospitalise':
+            flash('Ce patient est déjà hospitalisé', 'error')
+            return redirect(url_for('admettre_patient'))
+        if resultat == 'chambre_indisponible':
+            flash('Cette chambre n\'est pas disponible', 'error')
+            return redirect(url_for('admettre_patient'))
+        if resultat == 'aucune_chambre':
+            flash('Aucune chambre libre de ce type', 'error')
+            return redirect(url_for('admettre_patient'))
         
-        db.session.commit()
-        flash('Patient admis avec succès!', 'success')
+        invalider_stats_tableau_de_bord()
+        flash(f'Patient admis avec succès en chambre {hospitalisation.chambre.numero}!', 'success')
         return redirect(url_for('hospitalisation'))
     
-    patients = Patient.query.order_by(Patient.nom).all()
-    chambres_libres = Chambre.query.filter_by(statut='libre').all()
-    return render_template('admettre_patient.html', patients=patients, chambres=chambres_libres)
+    chambres_libres = Chambre.query.filter(Chambre.id.in_(carte_chambres.chambres_libres())).order_by(
+        Chambre.type_chambre, Chambre.prix_nuit, Chambre.numero
+    ).all()
+    types_libres = [(type_chambre, nombre['libres']) for type_chambre, nombre in sorted(carte_chambres.disponibilite().items())
+                    if nombre['libres']]
+    return render_template('admettre_patient.html', chambres=chambres_libres, types=types_libres)
 
 @app.route('/hospitalisation/<int:id>/sortie', methods=['POST'])
 @login_required
 def sortie_patient(id):
-    hospitalisation = Hospitalisation.query.get_or_404(id)
-    hospitalisation.date_sortie = datetime.utcnow()
-    hospitalisation.statut = 'sorti'
+    Hospitalisation.query.get_or_404(id)
     
     # Libérer la chambre
-    hospitalisation.chambre.statut = 'libre'
-    
-    db.session.commit()
-    flash('Patient sorti avec succès!', 'success')
+    if liberer(id):
+        invalider_stats_tableau_de_bord()
+        flash('Patient sorti avec succès!', 'success')
+    else:
+        flash('Ce patient est déjà sorti', 'info')
     return redirect(url_for('hospitalisation'))
 
 # Routes pour la facturation
 @app.route('/facturation')
 @login_required
 def facturation():
-    factures = Facture.query.order_by(Facture.date_facture.desc()).all()
+    factures = Facture.query.options(joinedload(Facture.patient)).order_by(Facture.date_facture.desc()).all()
+    compteurs = lire_compteurs([f'factures:{statut}' for statut in STATUTS_FACTURE] + ['montant_impaye'])
     stats = {
-        'total_factures': Facture.query.count(),
-        'factures_impayees': Facture.query.filter(Facture.statut.in_(['en_attente', 'partielle'])).count(),
-        'montant_impaye': db.session.query(db.func.sum(Facture.montant_total - Facture.montant_paye)).filter(Facture.statut.in_(['en_attente', 'partielle'])).scalar() or 0
+        'total_factures': int(sum(compteurs[f'factures:{statut}'] for statut in STATUTS_FACTURE)),
+        'factures_impayees': int(sum(compteurs[f'factures:{statut}'] for statut in STATUTS_IMPAYES)),
+        'montant_impaye': compteurs['montant_impaye']
     }
     return render_template('facturation.html', factures=factures, stats=stats)
 
@@ -610,13 +3802,27 @@ def facturation():
 @login_required
 def nouvelle_facture():
     if request.method == 'POST':
-        # Générer un numéro de facture unique
-        numero_facture = f"FLEM-{datetime.now().strftime('%Y%m%d')}-{Facture.query.count() + 1:04d}"
+        services = request.form.getlist('services[]')
+        quantites = request.form.getlist('quantites[]')
+        prix = request.form.getlist('prix[]')
+        descriptions = request.form.getlist('descriptions[]')
         
+        hospitalisation_id = request.form.get('hospitalisation_id', type=int)
+        if request.form['type_facture'] == 'hospitalisation':
+            # Une facture de séjour fait avancer la facturation automatique du
+            # séjour : sans lien, les mêmes nuits seraient facturées deux fois
+            if not hospitalisation_id or not marquer_sejour_facture(hospitalisation_id, request.form.get('patient_id', type=int)):
+                db.session.rollback()
+                flash('Une facture d\'hospitalisation doit être liée au séjour du patient', 'error')
+                return render_template('nouvelle_facture.html',
+                                     chambres=Chambre.query.all(),
+                                     medicaments=Medicament.query.all(),
+                                     saisie=request.form,
+                                     lignes=list(zip(services, descriptions, quantites, prix)))
         facture = Facture(
-            numero_facture=numero_facture,
+            numero_facture=allouer_numeros_facture()[0],
             patient_id=request.form['patient_id'],
-            hospitalisation_id=request.form.get('hospitalisation_id') or None,
+            hospitalisation_id=hospitalisation_id,
             type_facture=request.form['type_facture'],
             date_echeance=datetime.strptime(request.form['date_echeance'], '%Y-%m-%d').date() if request.form['date_echeance'] else None,
             notes=request.form['notes']
@@ -624,11 +3830,6 @@ def nouvelle_facture():
         
         # Calculer le montant total
         montant_total = 0
-        services = request.form.getlist('services[]')
-        quantites = request.form.getlist('quantites[]')
-        prix = request.form.getlist('prix[]')
-        descriptions = request.form.getlist('descriptions[]')
-        
         for i, service in enumerate(services):
             if service and quantites[i] and prix[i]:
                 detail = DetailFacture(
@@ -643,21 +3844,22 @@ def nouvelle_facture():
         
         facture.montant_total = montant_total
         db.session.add(facture)
+        ajuster_compteurs(compteurs_facture('en_attente', montant_total, 0))
         db.session.commit()
         
         flash('Facture créée avec succès!', 'success')
         return redirect(url_for('detail_facture', id=facture.id))
     
-    patients = Patient.query.order_by(Patient.nom).all()
-    hospitalisations = Hospitalisation.query.filter_by(statut='hospitalise').all()
     chambres = Chambre.query.all()
     medicaments = Medicament.query.all()
-    return render_template('nouvelle_facture.html', patients=patients, hospitalisations=hospitalisations, chambres=chambres, medicaments=medicaments)
+    return render_template('nouvelle_facture.html', chambres=chambres, medicaments=medicaments)
 
 @app.route('/facturation/<int:id>')
 @login_required
 def detail_facture(id):
-    facture = Facture.query.get_or_404(id)
+    facture = Facture.query.options(
+        joinedload(Facture.patient), selectinload(Facture.details)
+    ).get_or_404(id)
     return render_template('detail_facture.html', facture=facture)
 
 @app.route('/facturation/<int:id>/paiement', methods=['POST'])
@@ -665,6 +3867,7 @@ def detail_facture(id):
 def enregistrer_paiement(id):
     facture = Facture.query.get_or_404(id)
     montant_paye = float(request.form['montant_paye'])
+    avant = compteurs_facture(facture.statut, facture.montant_total, facture.montant_paye)
     
     facture.montant_paye += montant_paye
     
@@ -673,6 +3876,7 @@ def enregistrer_paiement(id):
     elif facture.montant_paye > 0:
         facture.statut = 'partielle'
     
+    ajuster_compteurs(difference_compteurs(avant, compteurs_facture(facture.statut, facture.montant_total, facture.montant_paye)))
     db.session.commit()
     flash('Paiement enregistré avec succès!', 'success')
     return redirect(url_for('detail_facture', id=id))
@@ -690,6 +3894,8 @@ def modifier_patient(id):
         patient.email = request.form['email']
         patient.adresse = request.form['adresse']
         patient.numero_securite_sociale = request.form['numero_securite_sociale']
+        indexer_patients([patient])
+        indexer_cles_doublons([patient])
         db.session.commit()
         flash('Patient modifié avec succès!', 'success')
         return redirect(url_for('detail_patient', id=id))
@@ -699,8 +3905,15 @@ def modifier_patient(id):
 @role_required('admin')
 def supprimer_patient(id):
     patient = Patient.query.get_or_404(id)
+    desindexer_patient(patient.id)
+    db.session.execute(db.delete(CleDoublon).where(CleDoublon.patient_id == patient.id))
+    db.session.execute(db.delete(DoublonCandidat).where(db.or_(
+        DoublonCandidat.patient_a_id == patient.id, DoublonCandidat.patient_b_id == patient.id
+    )))
     db.session.delete(patient)
+    ajuster_compteurs({'patients': -1})
     db.session.commit()
+    invalider_stats_tableau_de_bord()
     flash('Patient supprimé avec succès!', 'success')
     return redirect(url_for('patients'))
 
@@ -726,10 +3939,37 @@ def modifier_personnel(id):
 def supprimer_personnel(id):
     personnel = Personnel.query.get_or_404(id)
     db.session.delete(personnel)
+    ajuster_compteurs({'personnel': -1})
     db.session.commit()
+    invalider_stats_tableau_de_bord()
     flash('Personnel supprimé avec succès!', 'success')
     return redirect(url_for('personnel'))
 
+@app.route('/personnel/<int:id>/horaires', methods=['GET', 'POST'])
+@role_required('admin')
+def horaires_personnel_route(id):
+    personnel = Personnel.query.get_or_404(id)
+    if request.method == 'POST':
+        try:
+            plages = {jour: lire_horaires_jour(request.form.get(f'jour_{jour}', '')) for jour in range(7)}
+        except ValueError:
+            flash('Horaires invalides : utilisez le format 08:00-12:00, 14:00-18:00', 'error')
+            return redirect(url_for('horaires_personnel_route', id=id))
+        personnel.horaires = [
+            HoraireTravail(jour_semaine=jour, heure_debut=heure_debut, heure_fin=heure_fin)
+            for jour, plages_jour in plages.items() for heure_debut, heure_fin in plages_jour
+        ]
+        personnel.horaires_configures = True
+        db.session.commit()
+        flash('Horaires mis à jour avec succès!', 'success')
+        return redirect(url_for('personnel'))
+    
+    horaires = horaires_personnel([personnel.id])[personnel.id]
+    jours = [(jour, nom, ', '.join(f"{d.strftime('%H:%M')}-{f.strftime('%H:%M')}" for d, f in horaires.get(jour, ())))
+             for jour, nom in enumerate(JOURS_SEMAINE)]
+    return render_template('horaires_personnel.html', personnel=personnel, jours=jours,
+                         par_defaut=not personnel.horaires_configures)
+
 # Routes CRUD pour les chambres
 @app.route('/chambres/<int:id>/modifier', methods=['GET', 'POST'])
 @role_required('admin')
@@ -739,7 +3979,9 @@ def modifier_chambre(id):
         chambre.numero = request.form['numero']
         chambre.type_chambre = request.form['type_chambre']
         chambre.prix_nuit = float(request.form['prix_nuit'])
+        ajuster_compteurs({'version_chambres': 1})
         db.session.commit()
+        carte_chambres.appliquer([chambre.id])
         flash('Chambre modifiée avec succès!', 'success')
         return redirect(url_for('chambres'))
     return render_template('modifier_chambre.html', chambre=chambre)
@@ -752,7 +3994,10 @@ def supprimer_chambre(id):
         flash('Impossible de supprimer une chambre occupée', 'error')
         return redirect(url_for('chambres'))
     db.session.delete(chambre)
+    ajuster_compteurs({'chambres_libres': -1 if chambre.statut == 'libre' else 0, 'version_chambres': 1})
     db.session.commit()
+    carte_chambres.appliquer([id])
+    invalider_stats_tableau_de_bord()
     flash('Chambre supprimée avec succès!', 'success')
     return redirect(url_for('chambres'))
 
@@ -762,15 +4007,15 @@ def supprimer_chambre(id):
 def modifier_medicament(id):
     medicament = Medicament.query.get_or_404(id)
     if request.method == 'POST':
+        avant = compteurs_medicament(medicament.quantite_stock, medicament.seuil_minimum)
         medicament.nom = request.form['nom']
         medicament.code_medicament = request.form['code_medicament']
         medicament.description = request.form['description']
         medicament.prix_unitaire = float(request.form['prix_unitaire'])
-        medicament.quantite_stock = int(request.form['quantite_stock'])
+        # Stock et péremption sont calculés à partir des lots
         medicament.seuil_minimum = int(request.form['seuil_minimum'])
         medicament.fournisseur = request.form['fournisseur']
-        if request.form['date_expiration']:
-            medicament.date_expiration = datetime.strptime(request.form['date_expiration'], '%Y-%m-%d').date()
+        ajuster_compteurs(difference_compteurs(avant, compteurs_medicament(medicament.quantite_stock, medicament.seuil_minimum)))
         db.session.commit()
         flash('Médicament modifié avec succès!', 'success')
         return redirect(url_for('medicaments'))
@@ -780,7 +4025,14 @@ def modifier_medicament(id):
 @role_required('pharmacien')
 def supprimer_medicament(id):
     medicament = Medicament.query.get_or_404(id)
+    historique = db.session.query(
+        db.exists().where(MouvementStock.medicament_id == id) | db.exists().where(Prescription.medicament_id == id)
+    ).scalar()
+    if historique:
+        flash('Ce médicament a un historique de stock ou des prescriptions et ne peut pas être supprimé', 'error')
+        return redirect(url_for('medicaments'))
     db.session.delete(medicament)
+    ajuster_compteurs(difference_compteurs(compteurs_medicament(medicament.quantite_stock, medicament.seuil_minimum), {}))
     db.session.commit()
     flash('Médicament supprimé avec succès!', 'success')
     return redirect(url_for('medicaments'))
@@ -822,28 +4074,137 @@ def supprimer_user(id):
 def modifier_rendez_vous(id):
     rdv = RendezVous.query.get_or_404(id)
     if request.method == 'POST':
+        ancien_jour = rdv.date_rdv.date()
         rdv.patient_id = request.form['patient_id']
         rdv.personnel_id = request.form['personnel_id']
         rdv.date_rdv = datetime.strptime(request.form['date_rdv'], '%Y-%m-%dT%H:%M')
+        rdv.duree = request.form.get('duree')
         rdv.type_consultation = request.form['type_consultation']
         rdv.statut = request.form['statut']
         rdv.notes = request.form['notes']
-        db.session.commit()
+        try:
+            enregistrer_rendez_vous(rdv, difference_compteurs({cle_rdv_jour(ancien_jour): 1}, {cle_rdv_jour(rdv.date_rdv.date()): 1}))
+        except ConflitRendezVous as e:
+            flash(message_conflit_rdv(e), 'error')
+            db.session.rollback()
+            # La saisie est réaffichée : seul l'horaire en conflit est à corriger
+            return render_template('modifier_rendez_vous.html', rdv=rdv, saisie=request.form)
+        invalider_stats_tableau_de_bord()
         flash('Rendez-vous modifié avec succès!', 'success')
-        return redirect(url_for('rendez_vous'))
-    patients = Patient.query.order_by(Patient.nom).all()
-    personnel = Personnel.query.order_by(Personnel.nom).all()
-    return render_template('modifier_rendez_vous.html', rdv=rdv, patients=patients, personnel=personnel)
+        return redirect(url_for('rendez_vous', date=rdv.date_rdv.date().isoformat()))
+    return render_template('modifier_rendez_vous.html', rdv=rdv)
 
 @app.route('/rendez-vous/<int:id>/supprimer', methods=['POST'])
 @login_required
 def supprimer_rendez_vous(id):
     rdv = RendezVous.query.get_or_404(id)
     db.session.delete(rdv)
+    ajuster_compteurs({cle_rdv_jour(rdv.date_rdv.date()): -1})
     db.session.commit()
+    invalider_stats_tableau_de_bord()
     flash('Rendez-vous supprimé avec succès!', 'success')
     return redirect(url_for('rendez_vous'))
 
+# Routes pour les séries de rendez-vous
+def message_conflits_serie(conflits):
+    dates = ', '.join(debut.strftime('%d/%m/%Y %H:%M') for debut, _ in conflits[:10])
+    suite = f" (et {len(conflits) - 10} autres)" if len(conflits) > 10 else ''
+    return f"{len(conflits)} occurrence(s) en conflit avec l'agenda du médecin : {dates}{suite}"
+
+@app.route('/rendez-vous/series/ajouter', methods=['GET', 'POST'])
+@login_required
+def ajouter_serie_rendez_vous():
+    def formulaire_serie():
+        return render_template('ajouter_serie_rendez_vous.html', durees=DUREES_TYPE_CONSULTATION, jours=JOURS_SEMAINE)
+    
+    if request.method == 'POST':
+        serie = SerieRendezVous(
+            patient_id=request.form['patient_id'],
+            personnel_id=request.form['personnel_id'],
+            jours_semaine=','.join(request.form.getlist('jours_semaine')),
+            intervalle=max(1, request.form.get('intervalle', 1, type=int)),
+            heure=datetime.strptime(request.form['heure'], '%H:%M').time(),
+            duree=lire_duree_rdv(request.form.get('duree')),
+            date_debut=datetime.strptime(request.form['date_debut'], '%Y-%m-%d').date(),
+            date_fin=datetime.strptime(request.form['date_fin'], '%Y-%m-%d').date(),
+            type_consultation=request.form['type_consultation'],
+            notes=request.form['notes']
+        )
+        if not serie.jours_semaine or serie.date_fin < serie.date_debut:
+            flash('Veuillez choisir au moins un jour et une période valide', 'error')
+            return formulaire_serie()
+        
+        ignorer_conflits = 'ignorer_conflits' in request.form
+        try:
+            crees, conflits = creer_serie_rendez_vous(serie, ignorer_conflits)
+            if conflits and not ignorer_conflits:
+                db.session.rollback()
+                flash(message_conflits_serie(conflits), 'error')
+                return formulaire_serie()
+            db.session.commit()
+        except SerieTropLongue:
+            db.session.rollback()
+            flash(f'La série dépasse {SERIE_OCCURRENCES_MAX} rendez-vous : raccourcissez la période ou espacez les séances', 'error')
+            return formulaire_serie()
+        except IntegrityError as e:
+            db.session.rollback()
+            if CONTRAINTE_CHEVAUCHEMENT_RDV not in str(e.orig):
+                raise
+            flash("La série chevauche un rendez-vous enregistré entre-temps, veuillez réessayer", 'error')
+            return formulaire_serie()
+        invalider_stats_tableau_de_bord()
+        
+        if conflits:
+            flash(f"{message_conflits_serie(conflits)}. Ces occurrences n'ont pas été créées.", 'warning')
+        flash(f'Série créée avec succès : {len(crees)} rendez-vous', 'success')
+        return redirect(url_for('serie_rendez_vous', id=serie.id))
+    
+    return formulaire_serie()
+
+@app.route('/rendez-vous/series/<int:id>')
+@login_required
+def serie_rendez_vous(id):
+    serie = SerieRendezVous.query.get_or_404(id)
+    occurrences = serie.rendez_vous.options(joinedload(RendezVous.personnel)).order_by(RendezVous.date_rdv).all()
+    return render_template('serie_rendez_vous.html',
+                         serie=serie,
+                         occurrences=occurrences,
+                         jours=[JOURS_SEMAINE[int(j)] for j in serie.jours_semaine.split(',')],
+                         aujourd_hui=date.today())
+
+@app.route('/rendez-vous/series/<int:id>/modifier', methods=['POST'])
+@login_required
+def modifier_serie_rendez_vous(id):
+    serie = SerieRendezVous.query.get_or_404(id)
+    a_partir_du = datetime.strptime(request.form['a_partir_du'], '%Y-%m-%d').date()
+    heure = datetime.strptime(request.form['heure'], '%H:%M').time()
+    personnel_id = request.form.get('personnel_id', type=int) or serie.personnel_id
+    try:
+        modifies, conflits = replanifier_serie(serie, a_partir_du, heure, lire_duree_rdv(request.form.get('duree')), personnel_id)
+        if conflits:
+            db.session.rollback()
+            flash(message_conflits_serie(conflits), 'error')
+            return redirect(url_for('serie_rendez_vous', id=id))
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        if CONTRAINTE_CHEVAUCHEMENT_RDV not in str(e.orig):
+            raise
+        flash("La série chevauche un rendez-vous enregistré entre-temps, veuillez réessayer", 'error')
+        return redirect(url_for('serie_rendez_vous', id=id))
+    flash(f'{modifies} rendez-vous replanifiés', 'success')
+    return redirect(url_for('serie_rendez_vous', id=id))
+
+@app.route('/rendez-vous/series/<int:id>/annuler', methods=['POST'])
+@login_required
+def annuler_serie_rendez_vous(id):
+    serie = SerieRendezVous.query.get_or_404(id)
+    a_partir_du = datetime.strptime(request.form['a_partir_du'], '%Y-%m-%d').date()
+    annules = annuler_serie(serie, a_partir_du)
+    db.session.commit()
+    flash(f'{annules} rendez-vous annulés', 'success')
+    return redirect(url_for('serie_rendez_vous', id=id))
+
 # Route pour le profil utilisateur
 @app.route('/profil')
 @login_required
@@ -879,9 +4240,110 @@ def modifier_profil():
     
     return render_template('modifier_profil.html', user=user)
 
+# Commandes CLI (flask --app app <commande>)
+@app.cli.command('migrer')
+@click.option('--simulation', is_flag=True, help='Lister les index manquants sans les créer')
+def migrer_commande(simulation):
+    """Met le schéma à jour (tables et index) sans verrouiller les tables"""
+    if simulation:
+        for index in index_manquants():
+            print(f"- {index.table.name}.{index.name}")
+        return
+    migrer_base(print)
+    print("✅ Schéma à jour")
+
+@app.cli.command('reindexer-patients')
+def reindexer_patients_commande():
+    """Crée l'index de recherche des patients et le reconstruit entièrement"""
+    initialiser_recherche()
+    total = reindexer_patients()
+    print(f"✅ {total} patients indexés")
+
+@app.cli.command('importer-patients')
+@click.argument('fichier', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format_fichier', type=click.Choice(['csv', 'ndjson']), help='Format du fichier (déduit de l\'extension par défaut)')
+@click.option('--lot', 'taille_lot', type=int, default=None, help='Nombre de lignes insérées par lot')
+@click.option('--rapport', type=click.Path(dir_okay=False, writable=True), help='Fichier CSV recevant les lignes rejetées')
+def importer_patients_commande(fichier, format_fichier, taille_lot, rapport):
+    """Importe des patients depuis un fichier CSV ou NDJSON"""
+    initialiser_recherche()
+    sortie = open(rapport, 'w', newline='', encoding='utf-8') if rapport else None
+    ecrivain = csv.writer(sortie) if sortie else None
+    if ecrivain:
+        ecrivain.writerow(['ligne', 'erreur'])
+    
+    def signaler_erreur(numero, message):
+        if ecrivain:
+            ecrivain.writerow([numero, message])
+        else:
+            click.echo(f"Ligne {numero} : {message}", err=True)
+    
+    debut = datetime.now()
+    try:
+        with open(fichier, 'rb') as flux:
+            resultat = importer_patients(
+                lire_fichier_import(flux, format_import(fichier, format_fichier)),
+                taille_lot or app.config['IMPORT_TAILLE_LOT'],
+                signaler_erreur
+            )
+    finally:
+        if sortie:
+            sortie.close()
+    duree = (datetime.now() - debut).total_seconds()
+    print(f"✅ {resultat['inserees']} patients importés sur {resultat['lues']} lignes "
+          f"({resultat['erreurs']} rejetées) en {duree:.1f} s")
+
+@app.cli.command('reconcilier-compteurs')
+def reconcilier_compteurs_commande():
+    """Recalcule les compteurs d'indicateurs et corrige les écarts (à planifier, ex. toutes les heures)"""
+    derives = reconcilier_compteurs()
+    for cle, (stocke, reel) in sorted(derives.items()):
+        if stocke is not None:
+            logger.warning(f"Compteur {cle} corrigé : {stocke} -> {reel}")
+    print(f"✅ Compteurs réconciliés ({len(derives)} valeur(s) corrigée(s) ou créée(s))")
+
+@app.cli.command('instantanes-stock')
+def instantanes_stock_commande():
+    """Prend les instantanés mensuels du stock des médicaments (à planifier, ex. chaque nuit)"""
+    total = prendre_instantanes()
+    print(f"✅ {total} instantané(s) de stock enregistré(s)")
+
+@app.cli.command('agreger-occupation')
+@click.option('--depuis', type=click.DateTime(formats=['%Y-%m-%d']), help='Recalculer les agrégats à partir de ce jour (séjours corrigés)')
+def agreger_occupation_commande(depuis):
+    """Agrège l'occupation des lits des jours clos (à planifier, ex. chaque nuit)"""
+    total = agreger_occupation(depuis=depuis.date() if depuis else None)
+    print(f"✅ {total} ligne(s) d'occupation agrégée(s)")
+
+@app.cli.command('facturer-sejours')
+@click.option('--jusqu-au', 'jusqu_au', type=click.DateTime(formats=['%Y-%m-%d']), help='Facturer les nuits avant cette date (aujourd\'hui par défaut)')
+@click.option('--nuits-minimum', type=int, default=None, help='Nuits non facturées avant une facture intermédiaire pour un séjour en cours')
+@click.option('--lot', 'taille_lot', type=int, default=None, help='Nombre de séjours traités par lot')
+def facturer_sejours_commande(jusqu_au, nuits_minimum, taille_lot):
+    """Facture les nuits d'hospitalisation pas encore facturées (à planifier, ex. chaque nuit)"""
+    debut = datetime.now()
+    resultat = facturer_sejours(jusqu_au.date() if jusqu_au else None, taille_lot, nuits_minimum)
+    duree = (datetime.now() - debut).total_seconds()
+    print(f"✅ {resultat['factures']} facture(s) créée(s) sur {resultat['sejours']} séjour(s) "
+          f"({resultat['montant']:,.0f} CDF) en {duree:.1f} s")
+
+@app.cli.command('detecter-doublons')
+@click.option('--seuil', type=float, default=SEUIL_DOUBLON, help='Score minimal pour proposer une paire')
+@click.option('--reindexer', is_flag=True, help='Recalculer d\'abord les clés de blocage de tous les patients')
+def detecter_doublons_commande(seuil, reindexer):
+    """Recherche les doublons probables parmi les patients"""
+    if reindexer:
+        for lot in parcourir_par_lots(Patient.query, Patient.id, TAILLE_LOT_DOUBLONS):
+            indexer_cles_doublons(lot)
+            db.session.commit()
+    debut = datetime.now()
+    total = detecter_doublons(seuil)
+    duree = (datetime.now() - debut).total_seconds()
+    print(f"✅ {total} paires de doublons probables détectées en {duree:.1f} s")
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        migrer_base()
         
         # Ajouter des données de test si la base est vide
         if User.query.count() == 0:
@@ -935,6 +4397,10 @@ if __name__ == '__main__':
                 numero_securite_sociale="1234567890123"
             )
             db.session.add(patient_test)
+            db.session.flush()
+            indexer_patients([patient_test])
+            indexer_cles_doublons([patient_test])
+            ajuster_compteurs({'patients': 1})
             
             # Ajouter du personnel de test
             medecin_test = Personnel(
@@ -946,6 +4412,7 @@ if __name__ == '__main__':
                 date_embauche=date(2020, 1, 15)
             )
             db.session.add(medecin_test)
+            ajuster_compteurs({'personnel': 1})
             
             # Ajouter des chambres de test
             chambre1 = Chambre(numero="101", type_chambre="simple", prix_nuit=50000.0)
@@ -953,6 +4420,7 @@ if __name__ == '__main__':
             chambre3 = Chambre(numero="201", type_chambre="VIP", prix_nuit=150000.0)
             
             db.session.add_all([chambre1, chambre2, chambre3])
+            ajuster_compteurs({'chambres_libres': 3, 'version_chambres': 3})
             
             # Ajouter des médicaments de test
             medicament1 = Medicament(
@@ -962,7 +4430,8 @@ if __name__ == '__main__':
                 prix_unitaire=500.0,
                 quantite_stock=100,
                 seuil_minimum=20,
-                fournisseur="Pharma Congo"
+                fournisseur="Pharma Congo",
+                lots=[LotMedicament(numero_lot="LOT-001", quantite_initiale=100, quantite=100, fournisseur="Pharma Congo")]
             )
             medicament2 = Medicament(
                 nom="Amoxicilline 1g",
@@ -971,7 +4440,8 @@ if __name__ == '__main__':
                 prix_unitaire=2500.0,
                 quantite_stock=50,
                 seuil_minimum=10,
-                fournisseur="MediCorp"
+                fournisseur="MediCorp",
+                lots=[LotMedicament(numero_lot="LOT-001", quantite_initiale=50, quantite=50, fournisseur="MediCorp")]
             )
             medicament3 = Medicament(
                 nom="Ibuprofène 400mg",
@@ -980,11 +4450,17 @@ if __name__ == '__main__':
                 prix_unitaire=800.0,
                 quantite_stock=75,
                 seuil_minimum=15,
-                fournisseur="Pharma Congo"
+                fournisseur="Pharma Congo",
+                lots=[LotMedicament(numero_lot="LOT-001", quantite_initiale=75, quantite=75, fournisseur="Pharma Congo")]
             )
             
+            for medicament in (medicament1, medicament2, medicament3):
+                lot = medicament.lots[0]
+                medicament.mouvements.append(MouvementStock(lot=lot, type_mouvement='reception', quantite=lot.quantite))
+                ajuster_compteurs(compteurs_medicament(medicament.quantite_stock, medicament.seuil_minimum))
             db.session.add_all([medicament1, medicament2, medicament3])
             db.session.commit()
+            carte_chambres.appliquer([chambre1.id, chambre2.id, chambre3.id])
     
     # Configuration pour le déploiement
     if __name__ == '__main__':
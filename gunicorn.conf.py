@@ -1,5 +1,6 @@
 # Configuration Gunicorn pour Render
 import multiprocessing
+import os
 
 # Nombre de workers
 workers = multiprocessing.cpu_count() * 2 + 1
@@ -10,8 +11,8 @@ worker_connections = 1000
 timeout = 30
 keepalive = 2
 
-# Configuration du serveur
-bind = '0.0.0.0:8000'
+# Configuration du serveur (port imposé par la plateforme s'il est fourni)
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
 backlog = 2048
 
 # Configuration des logs
@@ -32,3 +33,19 @@ preload_app = True
 # Configuration des timeouts
 graceful_timeout = 30
 worker_tmp_dir = '/dev/shm'
+
+# Migration du schéma (tables, colonnes, index, reprises de données) une fois
+# au démarrage du maître, avant le lancement des workers ; les connexions
+# ouvertes par le maître sont fermées pour ne pas être partagées après le fork
+def on_starting(server):
+    from app import app, db, migrer_base
+    with app.app_context():
+        migrer_base()
+        db.engine.dispose()
+
+# Chaque worker repart d'un pool vide, sans fermer les connexions héritées
+# (elles appartiennent au maître)
+def post_fork(server, worker):
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
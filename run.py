@@ -4,7 +4,7 @@ Script de lancement pour l'application Centre FLEM
 """
 import os
 import sys
-from app import app, db
+from app import app, migrer_base
 
 def main():
     print("=" * 50)
@@ -16,7 +16,7 @@ def main():
     if not os.path.exists('flem_hospital.db'):
         print("📊 Création de la base de données...")
         with app.app_context():
-            db.create_all()
+            migrer_base()
         print("✅ Base de données créée avec succès!")
         print()
     
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Script de test du nombre de requêtes SQL par page
+Vérifie que les pages de liste ne font pas une requête par ligne (N+1) :
+chaque page est chargée avec peu puis beaucoup de données, le nombre de
+requêtes doit rester identique. Vérifie ensuite les opérations qui doivent
+rester justes quand elles sont rejouées (double délivrance...)
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, date, timedelta, time as heure
+
+# Base SQLite temporaire, à définir avant l'import de l'application
+FICHIER_BASE = os.path.join(tempfile.mkdtemp(), 'test_requetes.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{FICHIER_BASE}'
+
+from sqlalchemy import event
+from app import (app, db, migrer_base, User, Patient, Personnel, RendezVous, Chambre, Medicament,
+                 LotMedicament, Prescription, Hospitalisation, Facture, DetailFacture, DoublonCandidat,
+                 SerieRendezVous, reconcilier_compteurs, carte_chambres, delivrer, delivrer_lot, admettre,
+                 facturer_sejours, allouer_numeros_facture)
+
+PAGES = [
+    '/',
+    '/patients',
+    '/personnel',
+    '/rendez-vous',
+    '/rendez-vous?vue=mois',
+    '/rendez-vous/series/1',
+    '/chambres',
+    '/pharmacie',
+    '/pharmacie/prescriptions',
+    '/hospitalisation',
+    '/facturation',
+    '/facturation/1',
+    '/admin/doublons',
+    '/api/rendez-vous',
+]
+
+def creer_donnees(debut, nombre):
+    """Ajouter `nombre` lignes liées dans chaque table"""
+    aujourd_hui = datetime.combine(date.today(), heure(8))
+    for i in range(debut, debut + nombre):
+        patient = Patient(nom=f'Nom{i}', prenom=f'Prenom{i}', date_naissance=date(1980, 1, 1),
+                          telephone=f'0{i:08d}', numero_securite_sociale=f'NSS{i}')
+        medecin = Personnel(nom=f'Medecin{i}', prenom='Dr', specialite='Generaliste',
+                            telephone=f'1{i:08d}', email=f'medecin{i}@flem.cd', date_embauche=date(2020, 1, 1))
+        utilisateur = User(username=f'medecin{i}', email=f'user{i}@flem.cd', role='medecin',
+                           nom=f'Medecin{i}', prenom='Dr')
+        utilisateur.set_password('test')
+        chambre = Chambre(numero=f'C{i}', type_chambre='simple', prix_nuit=50000, statut='occupee')
+        medicament = Medicament(nom=f'Medicament{i}', code_medicament=f'MED{i}', prix_unitaire=1000,
+                                quantite_stock=100)
+        db.session.add_all([patient, medecin, utilisateur, chambre, medicament])
+        db.session.flush()
+
+        db.session.add_all([
+            RendezVous(patient_id=patient.id, personnel_id=medecin.id, date_rdv=aujourd_hui + timedelta(hours=i % 8),
+                       type_consultation='Contrôle', serie_id=1),
+            Prescription(patient_id=patient.id, medecin_id=utilisateur.id, medicament_id=medicament.id,
+                         quantite=1, posologie='1 par jour'),
+            Hospitalisation(patient_id=patient.id, chambre_id=chambre.id, motif_admission='Test'),
+            Facture(numero_facture=f'TEST-{i}', patient_id=patient.id, montant_total=1000,
+                    type_facture='consultation', details=[
+                        DetailFacture(description='Consultation', quantite=1, prix_unitaire=1000, montant=1000,
+                                      type_service='consultation')
+                    ]),
+        ])
+        if i > 0:
+            db.session.add(DoublonCandidat(patient_a_id=patient.id - 1, patient_b_id=patient.id, score=0.9))
+    db.session.commit()
+
+def compter_requetes(client, url):
+    """Compter les requêtes SQL émises pendant le chargement d'une page"""
+    requetes = []
+
+    def enregistrer(*args):
+        requetes.append(args[2])
+
+    # Session vide, comme au début d'une vraie requête
+    db.session.remove()
+    event.listen(db.engine, 'before_cursor_execute', enregistrer)
+    try:
+        reponse = client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', enregistrer)
+    return reponse.status_code, len(requetes)
+
+def verifier_delivrance():
+    """Une prescription délivrée deux fois ne sort le stock qu'une fois"""
+    prescription = Prescription.query.filter_by(statut='en_attente').first()
+    medicament = db.session.get(Medicament, prescription.medicament_id)
+    stock = medicament.quantite_stock
+    resultats = [delivrer(prescription.id), delivrer(prescription.id)]
+    db.session.expire_all()
+    return [("Seconde délivrance d'une prescription : deja_traitee",
+             resultats == ['delivre', 'deja_traitee']
+             and medicament.quantite_stock == stock - prescription.quantite)]
+
+def verifier_delivrance_groupee():
+    """Tournée avec stock insuffisant : la prescription refusée reste en attente, son stock intact"""
+    medicament = Medicament(nom='Medicament lot', code_medicament='MEDLOT', prix_unitaire=1000, quantite_stock=3,
+                            lots=[LotMedicament(numero_lot='LOT-1', quantite_initiale=3, quantite=3)])
+    db.session.add(medicament)
+    db.session.flush()
+    medecin = User.query.filter_by(role='medecin').first()
+    prescriptions = [Prescription(patient_id=1, medecin_id=medecin.id, medicament_id=medicament.id, quantite=2,
+                                  posologie='1 par jour') for _ in range(2)]
+    db.session.add_all(prescriptions)
+    db.session.commit()
+    premiere, seconde = (prescription.id for prescription in prescriptions)
+
+    tournee = delivrer_lot([seconde, premiere])
+    reprise = delivrer_lot([seconde])
+    db.session.expire_all()
+    lot = medicament.lots[0]
+    return [
+        ("Tournée à stock insuffisant : la prescription en trop est refusée",
+         tournee == {premiere: 'delivre', seconde: 'stock_insuffisant'}
+         and [p.statut for p in prescriptions] == ['delivre', 'en_attente']),
+        ("Tournée refusée : stock et lot inchangés",
+         reprise == {seconde: 'stock_insuffisant'} and prescriptions[1].statut == 'en_attente'
+         and medicament.quantite_stock == 1 and lot.quantite == 1),
+    ]
+
+def verifier_admissions():
+    """Une chambre n'est attribuée qu'une fois, un patient n'est admis qu'une fois"""
+    chambre = Chambre(numero='C-ADM', type_chambre='simple', prix_nuit=50000)
+    patients = [Patient(nom=f'Admission{i}', prenom='Test', date_naissance=date(1980, 1, 1),
+                        telephone=f'2{i:08d}') for i in range(2)]
+    db.session.add_all([chambre] + patients)
+    db.session.commit()
+    chambre_id = chambre.id
+    premier, second = (patient.id for patient in patients)
+
+    resultats = [
+        admettre(premier, 'Test', chambre_id=chambre_id)[0],
+        admettre(second, 'Test', chambre_id=chambre_id)[0],
+        admettre(premier, 'Test')[0],
+    ]
+    db.session.expire_all()
+    return [("Chambre déjà prise et patient déjà hospitalisé refusés",
+             resultats == ['admis', 'chambre_indisponible', 'deja_hospitalise']
+             and Hospitalisation.query.filter_by(chambre_id=chambre_id).count() == 1)]
+
+def verifier_facturation_sejours():
+    """Deux passages de la facturation des séjours ne facturent pas deux fois les mêmes nuits"""
+    chambre = Chambre(numero='C-FACT', type_chambre='simple', prix_nuit=50000, statut='libre')
+    patient = Patient(nom='Facturation', prenom='Test', date_naissance=date(1980, 1, 1), telephone='300000000')
+    db.session.add_all([chambre, patient])
+    db.session.flush()
+    maintenant = datetime.utcnow()
+    sejour = Hospitalisation(patient_id=patient.id, chambre_id=chambre.id, motif_admission='Test', statut='sorti',
+                             date_admission=maintenant - timedelta(days=10), date_sortie=maintenant - timedelta(days=2))
+    db.session.add(sejour)
+    db.session.commit()
+    sejour_id = sejour.id
+
+    passages = [facturer_sejours()['factures'], facturer_sejours()['factures']]
+    # Séjour remis à zéro : l'index unique (séjour, début de période) empêche le doublon
+    sejour = db.session.get(Hospitalisation, sejour_id)
+    sejour.facture_jusqu_au = None
+    sejour.facturation_terminee = False
+    db.session.commit()
+    passages.append(facturer_sejours()['factures'])
+    return [("Facturation des séjours rejouée sans doublon",
+             passages == [1, 0, 0] and Facture.query.filter_by(hospitalisation_id=sejour_id).count() == 1)]
+
+def verifier_numeros_facture():
+    """Les numéros de facture d'un même jour se suivent sans trou ni doublon"""
+    numeros = allouer_numeros_facture(3) + allouer_numeros_facture() + allouer_numeros_facture(2)
+    suffixes = [int(numero.rsplit('-', 1)[1]) for numero in numeros]
+    prefixe = f"FLEM-{datetime.now():%Y%m%d}-"
+    return [("Numéros de facture consécutifs dans la journée",
+             all(numero.startswith(prefixe) for numero in numeros)
+             and suffixes == list(range(suffixes[0], suffixes[0] + 6)))]
+
+def main():
+    """Fonction principale"""
+    print("🔎 Test du nombre de requêtes SQL par page")
+    print("=" * 50)
+
+    app.config['TESTING'] = True
+    # Carte des chambres vérifiée à chaque lecture : même nombre de requêtes à chaque page
+    app.config['CARTE_CHAMBRES_VALIDATION'] = 0
+    with app.app_context():
+        migrer_base(lambda message: None)
+        admin = User(username='admin', email='admin@flem.cd', role='admin', nom='Admin', prenom='Test')
+        admin.set_password('test')
+        db.session.add(admin)
+        db.session.add(SerieRendezVous(patient_id=1, personnel_id=1, jours_semaine='0', heure=heure(8),
+                                       date_debut=date.today(), date_fin=date.today(), type_consultation='Contrôle'))
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+            session['username'] = 'admin'
+            session['role'] = 'admin'
+
+        creer_donnees(0, 3)
+        reconcilier_compteurs()
+        carte_chambres.reconstruire()
+        avant = {url: compter_requetes(client, url) for url in PAGES}
+        creer_donnees(3, 30)
+        reconcilier_compteurs()
+        carte_chambres.reconstruire()
+        apres = {url: compter_requetes(client, url) for url in PAGES}
+
+        verifications = (verifier_delivrance() + verifier_delivrance_groupee() + verifier_admissions()
+                         + verifier_facturation_sejours() + verifier_numeros_facture())
+
+    echecs = 0
+    for url in PAGES:
+        (statut_avant, nombre_avant), (statut_apres, nombre_apres) = avant[url], apres[url]
+        if statut_avant != 200 or statut_apres != 200:
+            print(f"❌ {url}: status {statut_avant}/{statut_apres}")
+            echecs += 1
+        elif nombre_avant != nombre_apres:
+            print(f"❌ {url}: {nombre_avant} requêtes avec 3 lignes, {nombre_apres} avec 33 lignes")
+            echecs += 1
+        else:
+            print(f"✅ {url}: {nombre_apres} requêtes")
+
+    for libelle, reussi in verifications:
+        print(f"{'✅' if reussi else '❌'} {libelle}")
+        echecs += not reussi
+
+    total = len(PAGES) + len(verifications)
+    print(f"\n🎯 SCORE: {total - echecs}/{total}")
+    os.remove(FICHIER_BASE)
+    for fichier in (carte_chambres.fichier(), carte_chambres.fichier() + '.lock'):
+        if os.path.exists(fichier):
+            os.remove(fichier)
+    sys.exit(1 if echecs else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Script de test de la limite des séries de rendez-vous
+Une série qui dépasse SERIE_OCCURRENCES_MAX occurrences doit être refusée
+avec un message d'erreur, sans aucun rendez-vous créé ; une série qui
+atteint exactement la limite est créée en entier ; la fusion de deux
+patients rattache les séries du doublon au patient conservé
+"""
+
+import os
+import sys
+import tempfile
+from datetime import date, timedelta, time as heure
+
+# Base SQLite temporaire, à définir avant l'import de l'application
+FICHIER_BASE = os.path.join(tempfile.mkdtemp(), 'test_series.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{FICHIER_BASE}'
+
+from app import (app, db, migrer_base, User, Patient, Personnel, RendezVous, SerieRendezVous,
+                 DoublonCandidat, SERIE_OCCURRENCES_MAX, carte_chambres)
+
+def formulaire(date_debut, date_fin, patient_id=1, heure_rdv='08:00'):
+    """Série quotidienne (tous les jours de la semaine) entre deux dates"""
+    return {
+        'patient_id': str(patient_id),
+        'personnel_id': '1',
+        'jours_semaine': [str(jour) for jour in range(7)],
+        'intervalle': '1',
+        'heure': heure_rdv,
+        'duree': '30',
+        'date_debut': date_debut.isoformat(),
+        'date_fin': date_fin.isoformat(),
+        'type_consultation': 'Contrôle',
+        'notes': ''
+    }
+
+def main():
+    """Fonction principale"""
+    print("🔎 Test de la limite des séries de rendez-vous")
+    print("=" * 50)
+
+    app.config['TESTING'] = True
+    resultats = []
+    with app.app_context():
+        migrer_base(lambda message: None)
+        admin = User(username='admin', email='admin@flem.cd', role='admin', nom='Admin', prenom='Test')
+        admin.set_password('test')
+        db.session.add_all([
+            admin,
+            Patient(nom='Nom', prenom='Prenom', date_naissance=date(1980, 1, 1), telephone='000000000'),
+            Personnel(nom='Medecin', prenom='Dr', specialite='Generaliste', telephone='111111111',
+                      email='medecin@flem.cd', date_embauche=date(2020, 1, 1)),
+        ])
+        db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = admin.id
+            session['username'] = 'admin'
+            session['role'] = 'admin'
+
+        # Une occurrence de trop : refus explicite, rien n'est créé
+        debut = date.today() + timedelta(days=1)
+        reponse = client.post('/rendez-vous/series/ajouter',
+                              data=formulaire(debut, debut + timedelta(days=SERIE_OCCURRENCES_MAX)))
+        resultats.append(("Série au-delà de la limite refusée",
+                          reponse.status_code == 200 and f'dépasse {SERIE_OCCURRENCES_MAX}' in reponse.data.decode()))
+        resultats.append(("Aucun rendez-vous ni série créés",
+                          RendezVous.query.count() == 0 and SerieRendezVous.query.count() == 0))
+
+        # Exactement la limite : la série est créée en entier
+        fin = debut + timedelta(days=SERIE_OCCURRENCES_MAX - 1)
+        reponse = client.post('/rendez-vous/series/ajouter', data=formulaire(debut, fin))
+        serie = SerieRendezVous.query.first()
+        resultats.append(("Série à la limite créée", reponse.status_code == 302 and serie is not None))
+        resultats.append((f"{SERIE_OCCURRENCES_MAX} rendez-vous créés",
+                          RendezVous.query.count() == SERIE_OCCURRENCES_MAX))
+        dernier = db.session.query(db.func.max(RendezVous.date_rdv)).scalar()
+        resultats.append(("Date de fin de la série = dernier rendez-vous",
+                          serie is not None and dernier is not None and serie.date_fin == dernier.date()
+                          and dernier.time() == heure(8)))
+
+        # Fusion d'un doublon qui a sa propre série : la série et ses rendez-vous
+        # passent au patient conservé
+        doublon = Patient(nom='Nom', prenom='Prenom', date_naissance=date(1980, 1, 1), telephone='000000000')
+        db.session.add(doublon)
+        db.session.commit()
+        client.post('/rendez-vous/series/ajouter',
+                    data=formulaire(debut, debut + timedelta(days=2), patient_id=doublon.id, heure_rdv='10:00'))
+        candidat = DoublonCandidat(patient_a_id=1, patient_b_id=doublon.id, score=0.99)
+        db.session.add(candidat)
+        db.session.commit()
+        doublon_id = doublon.id
+        reponse = client.post(f'/admin/doublons/{candidat.id}/fusionner', data={'garder': 'a'})
+        db.session.expire_all()
+        resultats.append(("Fusion d'un patient ayant une série",
+                          reponse.status_code == 302 and db.session.get(Patient, doublon_id) is None))
+        resultats.append(("Séries et rendez-vous rattachés au patient conservé",
+                          SerieRendezVous.query.count() == 2
+                          and SerieRendezVous.query.filter_by(patient_id=1).count() == 2
+                          and RendezVous.query.filter_by(patient_id=1).count() == SERIE_OCCURRENCES_MAX + 3))
+
+    echecs = 0
+    for libelle, reussi in resultats:
+        print(f"{'✅' if reussi else '❌'} {libelle}")
+        echecs += not reussi
+
+    print(f"\n🎯 SCORE: {len(resultats) - echecs}/{len(resultats)}")
+    os.remove(FICHIER_BASE)
+    for fichier in (carte_chambres.fichier(), carte_chambres.fichier() + '.lock'):
+        if os.path.exists(fichier):
+            os.remove(fichier)
+    sys.exit(1 if echecs else 0)
+
+if __name__ == "__main__":
+    main()